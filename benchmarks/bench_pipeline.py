@@ -0,0 +1,286 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from deconto21_ais.AssignFP import AssignFP
+from deconto21_ais.deconto21_ais_postprocess import dp21_postprocess_icesheet
+from deconto21_ais.deconto21_ais_preprocess import dp21_preprocess_icesheet
+from deconto21_ais.deconto21_ais_project import (
+    dp21_project_icesheet,
+    dp21_project_icesheet_temperaturedriven,
+)
+from deconto21_ais.metrics import PeakRSS, ResetPeakRSS
+from synthetic import write_inputs
+
+""" bench_pipeline.py
+
+Times each stage of the DP21 ice sheet workflow on synthetic inputs written by
+synthetic.py, at the given numbers of ensemble members, data years, samples,
+sites and climate ensemble members.
+
+For each stage the best wall time over the repetitions, the throughput in
+stage-specific units and the peak resident memory are printed, and with
+--results-file also written to a JSON file, so runs of two versions can be
+compared.
+
+"""
+
+PROJECTION = dict(
+    pipeline_id="bench",
+    replace=True,
+    rngseed=1342,
+)
+
+
+def projection_years(nyears):
+    # Every 10 years from 2020 to 2150, cut to the data years of the synthetic
+    # ensembles, which run every 5 years from 1995
+    last_year = 1995 + 5 * (nyears - 1)
+    pyear_end = min(2150, last_year - last_year % 10)
+    return dict(
+        pyear_start=min(2020, pyear_end),
+        pyear_end=pyear_end,
+        pyear_step=10,
+    )
+
+
+def time_call(func, repeat):
+    best = np.inf
+    peak = 0
+    for _ in range(repeat):
+        ResetPeakRSS()
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+        peak = max(peak, PeakRSS())
+    return best, peak, result
+
+
+def report(results, stage, seconds, peak, items, unit):
+    results.append(
+        {
+            "stage": stage,
+            "wall_s": seconds,
+            "throughput": items / seconds,
+            "unit": unit,
+            "peak_rss_mb": peak / 1024**2,
+        }
+    )
+    print(
+        "{:<38s} {:9.4f}s  {:12.4g} {:<20s} peak={:8.1f} MB".format(
+            stage, seconds, items / seconds, unit, peak / 1024**2
+        )
+    )
+
+
+def gslr_files(workdir, tag):
+    return {
+        "output_{}_gslr_file".format(ice): os.path.join(
+            workdir, "{}_{}_gslr.nc".format(tag, ice)
+        )
+        for ice in ("ais", "eais", "wais")
+    }
+
+
+def lslr_files(workdir, tag):
+    return {
+        "out_{}_lslr_file".format(ice): os.path.join(
+            workdir, "{}_{}_lslr.nc".format(tag, ice)
+        )
+        for ice in ("ais", "eais", "wais")
+    }
+
+
+def bench_pipeline(args, workdir):
+    t0 = time.perf_counter()
+    inputs = write_inputs(
+        os.path.join(workdir, "inputs"),
+        args.members,
+        args.nyears,
+        args.sites,
+        args.climate_members,
+        args.fp_resolution,
+    )
+    print("Wrote synthetic inputs in {:.1f}s".format(time.perf_counter() - t0))
+
+    results = []
+    member_years = args.members * args.nyears
+
+    # Preprocessing: one scenario, or all three for temperature-driven runs
+    seconds, peak, preprocessed = time_call(
+        lambda: dp21_preprocess_icesheet(
+            scenario="rcp85",
+            baseyear=args.baseyear,
+            pipeline_id="bench",
+            climate_data_file="",
+            input_paths_dict=inputs["input_paths_dict"],
+        ),
+        args.repeat,
+    )
+    report(results, "preprocess", seconds, peak, member_years, "member-years/s")
+
+    seconds, peak, preprocessed_temp = time_call(
+        lambda: dp21_preprocess_icesheet(
+            scenario="ssp585",
+            baseyear=args.baseyear,
+            pipeline_id="bench",
+            climate_data_file=inputs["climate_data_file"],
+            input_paths_dict=inputs["input_paths_dict"],
+        ),
+        args.repeat,
+    )
+    report(
+        results,
+        "preprocess (temperature-driven)",
+        seconds,
+        peak,
+        3 * member_years,
+        "member-years/s",
+    )
+
+    # Projection, including the global output writes
+    seconds, peak, projected = time_call(
+        lambda: dp21_project_icesheet(
+            nsamps=args.nsamps,
+            preprocess_dict=preprocessed,
+            **PROJECTION,
+            **projection_years(args.nyears),
+            **gslr_files(workdir, "project"),
+        ),
+        args.repeat,
+    )
+    nyears_out = projected["targyears"].size
+    report(
+        results, "project", seconds, peak, args.nsamps * nyears_out, "sample-years/s"
+    )
+
+    seconds, peak, _ = time_call(
+        lambda: dp21_project_icesheet_temperaturedriven(
+            climate_data_file=inputs["climate_data_file"],
+            preprocess_dict=preprocessed_temp,
+            **PROJECTION,
+            **projection_years(args.nyears),
+            **gslr_files(workdir, "project_temp"),
+        ),
+        args.repeat,
+    )
+    report(
+        results,
+        "project (temperature-driven)",
+        seconds,
+        peak,
+        args.climate_members * nyears_out,
+        "sample-years/s",
+    )
+
+    # Fingerprint interpolation at the sites
+    site_table = np.loadtxt(inputs["location_file"], usecols=(2, 3), ndmin=2)
+    seconds, peak, _ = time_call(
+        lambda: AssignFP(
+            os.path.join(inputs["fingerprint_dir"], "fprint_wais.nc"),
+            site_table[:, 0],
+            site_table[:, 1],
+        ),
+        args.repeat,
+    )
+    report(results, "AssignFP", seconds, peak, args.sites, "sites/s")
+
+    # Localisation, including the local output writes
+    seconds, peak, _ = time_call(
+        lambda: dp21_postprocess_icesheet(
+            chunksize=args.chunksize,
+            pipeline_id="bench",
+            projected_dict=projected,
+            locationfile=inputs["location_file"],
+            fpdir=inputs["fingerprint_dir"],
+            **lslr_files(workdir, "postprocess"),
+        ),
+        args.repeat,
+    )
+    report(
+        results,
+        "postprocess",
+        seconds,
+        peak,
+        args.nsamps * nyears_out * args.sites,
+        "sample-year-sites/s",
+    )
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the DP21 ice sheet workflow stages on synthetic data."
+    )
+    parser.add_argument(
+        "--members",
+        help="Ensemble members in each DP21 file [default=2000]",
+        type=int,
+        default=2000,
+    )
+    parser.add_argument(
+        "--nyears",
+        help="Data years in each DP21 file, every 5 years from 1995; projections run every 10 years from 2020 to 2150, or to the last data year [default=62]",
+        type=int,
+        default=62,
+    )
+    parser.add_argument(
+        "--nsamps", help="Samples to project [default=2000]", type=int, default=2000
+    )
+    parser.add_argument(
+        "--sites", help="Sites to localize to [default=1000]", type=int, default=1000
+    )
+    parser.add_argument(
+        "--climate-members",
+        help="Members of the climate ensemble [default=2000]",
+        type=int,
+        default=2000,
+    )
+    parser.add_argument(
+        "--fp-resolution",
+        help="Fingerprint grid spacing in degrees [default=0.5]",
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "--baseyear", help="Base year [default=2005]", type=int, default=2005
+    )
+    parser.add_argument(
+        "--chunksize",
+        help="Locations per localisation chunk [default=50]",
+        type=int,
+        default=50,
+    )
+    parser.add_argument(
+        "--repeat", help="Repetitions per timing [default=3]", type=int, default=3
+    )
+    parser.add_argument(
+        "--workdir",
+        help="Directory for the inputs and outputs [default=a temporary directory]",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--results-file",
+        help="Also write the results to this JSON file",
+        type=str,
+        default=None,
+    )
+    args = parser.parse_args()
+    if args.nyears < 2:
+        parser.error("--nyears must be at least 2, to reach the year 2000")
+
+    if args.workdir is None:
+        with tempfile.TemporaryDirectory() as workdir:
+            results = bench_pipeline(args, workdir)
+    else:
+        results = bench_pipeline(args, args.workdir)
+
+    if args.results_file is not None:
+        with open(args.results_file, "w") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=2)
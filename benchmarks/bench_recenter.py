@@ -0,0 +1,73 @@
+import argparse
+import time
+
+import numpy as np
+
+from deconto21_ais.deconto21_ais_preprocess import FindRefVals, FindRefValsVectorized
+
+""" bench_recenter.py
+
+Compares the per-member np.apply_along_axis base-year re-centering against the
+vectorized FindRefValsVectorized on synthetic (years, members) ensembles.
+
+"""
+
+
+def time_call(func, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+
+def bench_recenter(members, nyears, baseyear, repeat):
+    rng = np.random.default_rng(1234)
+    years = np.arange(2000, 2000 + 5 * nyears, 5)
+    samps = np.cumsum(rng.gamma(2.0, 2.0, (nyears, members)), axis=0).astype(np.float32)
+
+    t_loop, ref_loop = time_call(
+        lambda: np.apply_along_axis(
+            FindRefVals, axis=0, arr=samps, years=years, baseyear=baseyear
+        ),
+        repeat,
+    )
+    t_vec, ref_vec = time_call(
+        lambda: FindRefValsVectorized(samps, years, baseyear), repeat
+    )
+
+    if not np.array_equal(ref_loop, ref_vec):
+        raise RuntimeError("Vectorized reference values differ from FindRefVals")
+
+    print(
+        "members={:>8d}  apply_along_axis={:9.4f}s  vectorized={:9.6f}s  speedup={:8.1f}x".format(
+            members, t_loop, t_vec, t_loop / t_vec
+        )
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark base-year re-centering of DP21 ensembles."
+    )
+    parser.add_argument(
+        "--members",
+        help="Ensemble sizes to benchmark",
+        type=int,
+        nargs="+",
+        default=[2000, 20000, 200000],
+    )
+    parser.add_argument(
+        "--nyears", help="Number of data years [default=61]", type=int, default=61
+    )
+    parser.add_argument(
+        "--baseyear", help="Base year [default=2003]", type=int, default=2003
+    )
+    parser.add_argument(
+        "--repeat", help="Repetitions per timing [default=3]", type=int, default=3
+    )
+    args = parser.parse_args()
+
+    for members in args.members:
+        bench_recenter(members, args.nyears, args.baseyear, args.repeat)
@@ -0,0 +1,73 @@
+import argparse
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+""" bench_startup.py
+
+Times the start-up of the deconto21-ais command in fresh interpreters: loading
+the CLI module, answering --help, and rejecting a bad argument, against
+importing the workflow modules the CLI used to load up front.
+
+"""
+
+EAGER_IMPORTS = (
+    "import deconto21_ais.deconto21_ais_preprocess, "
+    "deconto21_ais.deconto21_ais_project, "
+    "deconto21_ais.deconto21_ais_postprocess"
+)
+
+HEAVY_MODULES = ("xarray", "dask", "scipy", "h5py", "netCDF4")
+
+
+def time_command(args, repeat):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run(args, capture_output=True)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def check_cli_imports():
+    # The CLI module itself must not load any of the heavy dependencies
+    code = "import sys, deconto21_ais.cli; print(','.join(m for m in {} if m in sys.modules))".format(
+        HEAVY_MODULES
+    )
+    loaded = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout.strip()
+    if loaded:
+        raise RuntimeError("deconto21_ais.cli imports {}".format(loaded))
+
+
+def bench_startup(repeat):
+    check_cli_imports()
+
+    cli = [sys.executable, "-c", "from deconto21_ais.cli import main; main()"]
+    commands = (
+        ("python (no imports)", [sys.executable, "-c", "pass"]),
+        (
+            "import deconto21_ais.cli",
+            [sys.executable, "-c", "import deconto21_ais.cli"],
+        ),
+        ("deconto21-ais --help", cli + ["--help"]),
+        ("deconto21-ais (missing options)", cli),
+        ("import workflow modules", [sys.executable, "-c", EAGER_IMPORTS]),
+    )
+    for label, args in commands:
+        print("{:<34s} {:8.3f}s".format(label, time_command(args, repeat)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark start-up time of the deconto21-ais command."
+    )
+    parser.add_argument(
+        "--repeat", help="Repetitions per timing [default=5]", type=int, default=5
+    )
+    args = parser.parse_args()
+
+    bench_startup(args.repeat)
@@ -0,0 +1,120 @@
+import os
+
+import h5py
+import numpy as np
+from netCDF4 import Dataset
+
+""" synthetic.py
+
+Writes synthetic inputs shaped like the real ones for the benchmarks:
+
+    dp21_{eais,wais}_{rcp26,rcp45,rcp85}.nc - DP21 ensembles, "samps" shaped
+                                              (years, members) every 5 years
+                                              from 1995
+    FPRINT/fprint_{eais,wais}.nc            - global fingerprint grids
+    location.lst                            - tab-separated site table
+    climate.h5                              - FAIR-style surface temperatures,
+                                              "<scenario>/surface_temperature"
+                                              shaped (years, members) for
+                                              1750-2300
+
+Values are smooth, monotonic or bounded like the real data, so every code path
+(re-centering, scenario picking, interpolation) does representative work.
+
+"""
+
+SCENARIOS = ("rcp26", "rcp45", "rcp85")
+CLIMATE_SCENARIOS = ("ssp126", "ssp245", "ssp585")
+
+
+def write_ensemble_files(outdir, members, nyears, rng):
+    years = 1995 + 5 * np.arange(nyears)
+    paths = {}
+    for ii, scenario in enumerate(SCENARIOS):
+        paths[scenario] = {}
+        for ice in ("eais", "wais"):
+            filename = os.path.join(outdir, "dp21_{}_{}.nc".format(ice, scenario))
+            with Dataset(filename, "w") as nc:
+                nc.createDimension("years", nyears)
+                nc.createDimension("samples", members)
+                nc.createVariable("years", "i4", ("years",))[:] = years
+                samps = nc.createVariable(
+                    "samps", "f4", ("years", "samples"), zlib=True
+                )
+                samps[:] = np.cumsum(
+                    rng.gamma(1.0 + ii, 2.0, (nyears, members)), axis=0
+                ).astype(np.float32)
+            paths[scenario][ice] = filename
+
+    return paths
+
+
+def write_fingerprint_files(outdir, resolution):
+    fpdir = os.path.join(outdir, "FPRINT")
+    os.makedirs(fpdir, exist_ok=True)
+
+    lats = np.linspace(90.0, -90.0, int(round(180.0 / resolution)) + 1)
+    lons = np.arange(0.0, 360.0, resolution)
+    for ii, ice in enumerate(("eais", "wais")):
+        fp = (
+            np.cos(np.deg2rad(lats))[:, np.newaxis]
+            * np.sin(np.deg2rad(lons + 90.0 * ii))[np.newaxis, :]
+            + 1.0
+        ) / 1000.0
+        with Dataset(os.path.join(fpdir, "fprint_{}.nc".format(ice)), "w") as nc:
+            nc.createDimension("lat", lats.size)
+            nc.createDimension("lon", lons.size)
+            nc.createVariable("lat", "f8", ("lat",))[:] = lats
+            nc.createVariable("lon", "f8", ("lon",))[:] = lons
+            nc.createVariable("fp", "f8", ("lat", "lon"), zlib=True)[:] = fp
+
+    return fpdir
+
+
+def write_location_file(outdir, sites, rng):
+    filename = os.path.join(outdir, "location.lst")
+    lats = rng.uniform(-80.0, 80.0, sites)
+    lons = rng.uniform(-180.0, 180.0, sites)
+    with open(filename, "w") as f:
+        f.write("# name\tid\tlat\tlon\n")
+        for ii in range(sites):
+            f.write(
+                "site{}\t{}\t{:.2f}\t{:.2f}\n".format(ii, ii + 1, lats[ii], lons[ii])
+            )
+
+    return filename
+
+
+def write_climate_file(outdir, climate_members, rng):
+    filename = os.path.join(outdir, "climate.h5")
+    years = np.arange(1750, 2301)
+    ramp = np.clip((years - 1900) / 100.0, 0.0, None)[:, np.newaxis]
+    with h5py.File(filename, "w") as h5:
+        h5["year"] = years
+        for ii, scenario in enumerate(CLIMATE_SCENARIOS):
+            warming = rng.uniform(0.5, 1.5, (1, climate_members)) * (1.0 + ii)
+            noise = rng.normal(0.0, 0.1, (years.size, climate_members))
+            h5.create_dataset(
+                "{}/surface_temperature".format(scenario),
+                data=ramp * warming + noise,
+                chunks=(years.size, min(climate_members, 256)),
+            )
+
+    return filename
+
+
+def write_inputs(
+    outdir, members, nyears, sites, climate_members, fp_resolution, seed=1234
+):
+    """
+    Write a full set of synthetic inputs to outdir and return their paths.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    return {
+        "input_paths_dict": write_ensemble_files(outdir, members, nyears, rng),
+        "fingerprint_dir": write_fingerprint_files(outdir, fp_resolution),
+        "location_file": write_location_file(outdir, sites, rng),
+        "climate_data_file": write_climate_file(outdir, climate_members, rng),
+    }
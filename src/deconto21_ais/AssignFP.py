@@ -1,12 +1,17 @@
 import numpy as np
-from deconto21_ais.ReadFingerprint import ReadFingerprint as readfp
-from scipy import interpolate as interp
+from deconto21_ais.ReadFingerprint import ReadFingerprintAxes, ReadFingerprintWindow
 
 """ AssignFP.py
 
 Assigns interpolated fingerprint coefficients to sites identified by the vectors
 of lats and lons provided.
 
+Interpolation is bilinear on the fingerprint grid, with sites outside the grid
+clamped to its edge. The corner indices and weights for a list of sites only
+depend on the grid, so they are computed once as a stencil and then applied to
+any number of fingerprint grids sharing it. Only the part of each grid the
+stencil touches is read from disk.
+
 Parameters:
 fp_filename = Fingerprint file passed to ReadFingerprint
 qlats = Vector of latitudes of sites of interest [-90, 90]
@@ -19,18 +24,148 @@ fp_sites = Vector of fingerprint coefficients for the sites of interest
 """
 
 
+def AxisWeights(grid, q):
+    # Clamp to the grid, find the lower node and its linear weights. The weights
+    # are formed as in FITPACK's fpbspl, so results match RectBivariateSpline
+    # with kx=ky=1 exactly.
+    q = np.clip(q, grid[0], grid[-1])
+    lower = np.clip(np.searchsorted(grid, q, side="right") - 1, 0, grid.size - 2)
+    fac = 1.0 / (grid[lower + 1] - grid[lower])
+
+    return lower, fac * (grid[lower + 1] - q), fac * (q - grid[lower])
+
+
+def FingerprintStencil(fp_lats, fp_lons, qlats, qlons):
+    """
+    Compute the bilinear interpolation stencil of a fingerprint grid at sites.
+
+    Parameters
+    ----------
+    fp_lats, fp_lons : array-like
+            Latitudes (any order) and ascending longitudes [0, 360) of the grid.
+    qlats, qlons : array-like
+            Latitudes and longitudes of the sites of interest.
+
+    Returns
+    -------
+    dict
+            Flat indices of the four corner nodes of each site into the
+            (lat, lon) grid, the latitude and longitude weights, and the grid
+            shape the stencil applies to.
+    """
+    fp_lats = np.ma.getdata(fp_lats)
+    fp_lons = np.ma.getdata(fp_lons)
+
+    lat_sort = np.argsort(fp_lats)
+    ilat, wlat0, wlat1 = AxisWeights(fp_lats[lat_sort], np.asarray(qlats))
+    ilon, wlon0, wlon1 = AxisWeights(fp_lons, np.mod(qlons, 360))
+
+    # Map the sorted latitude nodes back to the rows of the grid as stored
+    row0 = lat_sort[ilat] * fp_lons.size
+    row1 = lat_sort[ilat + 1] * fp_lons.size
+
+    return {
+        "index": np.stack((row0 + ilon, row0 + ilon + 1, row1 + ilon, row1 + ilon + 1)),
+        "wlat": (wlat0, wlat1),
+        "wlon": (wlon0, wlon1),
+        "shape": (fp_lats.size, fp_lons.size),
+    }
+
+
+def ApplyStencil(stencil, fp):
+    """
+    Interpolate a fingerprint grid to the sites of a stencil [mm per m of GSL].
+    """
+    fp = np.ma.getdata(fp)
+    if fp.shape != stencil["shape"]:
+        raise ValueError(
+            "Fingerprint grid shape {} does not match the stencil grid {}".format(
+                fp.shape, stencil["shape"]
+            )
+        )
+
+    # Gather the corner values, summed in the same order as FITPACK
+    corners = fp.ravel()[stencil["index"]]
+    (wlat0, wlat1), (wlon0, wlon1) = stencil["wlat"], stencil["wlon"]
+    fp_sites = corners[0] * wlat0 * wlon0
+    fp_sites += corners[1] * wlat0 * wlon1
+    fp_sites += corners[2] * wlat1 * wlon0
+    fp_sites += corners[3] * wlat1 * wlon1
+
+    return fp_sites * 1000
+
+
+def WindowStencil(stencil, rows, cols):
+    """
+    Re-index a stencil onto a window holding the given grid rows and columns.
+    """
+    (nlat, nlon) = stencil["shape"]
+    row_pos = np.full(nlat, -1)
+    row_pos[rows] = np.arange(len(rows))
+    col_pos = np.full(nlon, -1)
+    col_pos[cols] = np.arange(len(cols))
+
+    index = stencil["index"]
+    return dict(
+        stencil,
+        index=row_pos[index // nlon] * len(cols) + col_pos[index % nlon],
+        shape=(len(rows), len(cols)),
+    )
+
+
+def ReadStencilGrid(fp_filename, stencil):
+    # Read the window of the grid covering the stencil and re-index onto it
+    nlon = stencil["shape"][1]
+    (fp, rows, cols) = ReadFingerprintWindow(
+        fp_filename, stencil["index"] // nlon, stencil["index"] % nlon
+    )
+
+    return (fp, WindowStencil(stencil, rows, cols))
+
+
+def AssignFPs(fp_filenames, qlats, qlons):
+    """
+    Assign coefficients from several fingerprint files to the same sites.
+
+    The stencil is computed once and reused for every file on the same grid,
+    and only the window of each grid around the sites is read.
+
+    Returns
+    -------
+    list of numpy.ndarray
+            Fingerprint coefficients for the sites, one array per file.
+    """
+    stencils = []
+    fp_sites = []
+    for fp_filename in fp_filenames:
+        (fp_lats, fp_lons) = ReadFingerprintAxes(fp_filename)
+
+        # Reuse a stencil from an earlier file with the same grid
+        stencil = None
+        for lats, lons, known in stencils:
+            if np.array_equal(lats, fp_lats) and np.array_equal(lons, fp_lons):
+                stencil = known
+                break
+        if stencil is None:
+            stencil = FingerprintStencil(fp_lats, fp_lons, qlats, qlons)
+            stencils.append((fp_lats, fp_lons, stencil))
+
+        (fp, window_stencil) = ReadStencilGrid(fp_filename, stencil)
+        fp_sites.append(ApplyStencil(window_stencil, fp))
+
+    return fp_sites
+
+
 def AssignFP(fp_filename, qlats, qlons):
-    ## Read in the fitted parameters from parfile
+    ## Read in the fingerprint grid around the sites
     try:
-        (fp, fp_lats, fp_lons) = readfp(fp_filename)
+        (fp_lats, fp_lons) = ReadFingerprintAxes(fp_filename)
     except Exception as e:
         print(f"Cannot open fingerprint file, {e}")
 
     # Interpolate the fingerprint to these locations
-    lat_sort = np.argsort(fp_lats)
-    fp_interp = interp.RectBivariateSpline(
-        fp_lats[lat_sort], fp_lons, fp[lat_sort, :], kx=1, ky=1
-    )
-    fp_sites = fp_interp.ev(qlats, np.mod(qlons, 360)) * 1000
+    stencil = FingerprintStencil(fp_lats, fp_lons, qlats, qlons)
+    (fp, window_stencil) = ReadStencilGrid(fp_filename, stencil)
+    fp_sites = ApplyStencil(window_stencil, fp)
 
     return fp_sites
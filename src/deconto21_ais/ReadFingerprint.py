@@ -1,3 +1,4 @@
+import numpy as np
 from netCDF4 import Dataset
 
 """ ReadFingerprint.py
@@ -13,6 +14,9 @@ f = The fingerprint coefficient along a lat/lon grid [nlat x nlon]
 lat = Vector of latitudes
 lon = Vector of longitudes
 
+ReadFingerprintWindow reads only the rows and columns of the grid around a set
+of sites, which avoids decompressing the global grid for a handful of sites.
+
 """
 
 
@@ -30,3 +34,64 @@ def ReadFingerprint(fname):
     fp_lons = nc_fid.variables["lon"][:]
 
     return (fp, fp_lats, fp_lons)
+
+
+def ReadFingerprintAxes(fname):
+    # Read only the latitude and longitude vectors of a fingerprint file
+    with Dataset(fname, "r") as nc_fid:
+        return (nc_fid.variables["lat"][:], nc_fid.variables["lon"][:])
+
+
+def CircularRanges(idx, n):
+    # Smallest set of (start, stop) index ranges on a periodic axis of length n
+    # covering idx, splitting in two where the span wraps around the axis end
+    idx = np.unique(idx)
+    gaps = np.diff(np.append(idx, idx[0] + n))
+    wrap = np.argmax(gaps)
+    if wrap == idx.size - 1:
+        return [(idx[0], idx[-1] + 1)]
+
+    return [(idx[wrap + 1], n), (0, idx[wrap] + 1)]
+
+
+def ReadFingerprintWindow(fname, lat_idx, lon_idx, max_fraction=0.5):
+    """
+    Read a fingerprint only over the grid rows and columns covering the sites.
+
+    Parameters
+    ----------
+    fname : str
+            Fingerprint file name.
+    lat_idx, lon_idx : array-like
+            Grid row and column indices that must be read.
+    max_fraction : float
+            Read the full grid when the window would cover more than this
+            fraction of it, e.g. for sites spread around the globe.
+
+    Returns
+    -------
+    tuple
+            The fingerprint window, and the grid rows and columns it holds.
+    """
+    with Dataset(fname, "r") as nc_fid:
+        fp_var = nc_fid.variables["fp"]
+        (nlat, nlon) = fp_var.shape
+
+        if np.size(lat_idx) > 0:
+            row_range = (np.min(lat_idx), np.max(lat_idx) + 1)
+            col_ranges = CircularRanges(lon_idx, nlon)
+            ncells = (row_range[1] - row_range[0]) * sum(b - a for a, b in col_ranges)
+        else:
+            ncells = nlat * nlon
+
+        if ncells > max_fraction * nlat * nlon:
+            return (fp_var[:, :], np.arange(nlat), np.arange(nlon))
+
+        # One hyperslab per column range, two when the window crosses the seam
+        fp = np.ma.concatenate(
+            [fp_var[row_range[0] : row_range[1], a:b] for a, b in col_ranges], axis=1
+        )
+        rows = np.arange(*row_range)
+        cols = np.concatenate([np.arange(a, b) for a, b in col_ranges])
+
+    return (fp, rows, cols)
@@ -0,0 +1,223 @@
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import dask
+
+from deconto21_ais.deconto21_ais_preprocess import (
+    MapScenario,
+    dp21_preprocess_icesheet,
+)
+from deconto21_ais.deconto21_ais_postprocess import LoadSiteFingerprints
+from deconto21_ais.pipeline import (
+    RUN_REQUIRED,
+    InputPathsDict,
+    RunConfig,
+    run_dp21,
+)
+from deconto21_ais.validation import SCHEDULERS, DistributedAvailable, ZarrAvailable
+
+""" batch.py
+
+Runs many configurations of the DP21 ice sheet workflow in one process.
+
+The manifest is a JSON (or, with PyYAML installed, YAML) file holding a list of
+runs, optionally with shared "defaults":
+
+    {
+        "defaults": {"baseyear": 2000, "input_eais_rcp26_file": "...", ...},
+        "runs": [
+            {"scenario": "ssp585", "rngseed": 1, "output_ais_lslr_file": "..."},
+            ...
+        ]
+    }
+
+Run keys are the deconto21-ais option names with underscores, as for run_dp21.
+Preprocessed ensembles and site fingerprints are computed once for all runs
+that share them, and the projection and postprocessing of each run is
+scheduled on a process pool.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Data shared by every run, set in each worker by InitWorker
+_shared = {}
+
+
+def LoadManifest(manifest_file):
+    """
+    Read a batch manifest and return the fully specified list of runs.
+    """
+    with open(manifest_file, "r") as f:
+        if manifest_file.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise click.UsageError(
+                    "PyYAML is required to read YAML manifests; use JSON instead"
+                )
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+
+    if isinstance(manifest, list):
+        manifest = {"runs": manifest}
+
+    defaults = manifest.get("defaults", {})
+    runs = []
+    for ii, entry in enumerate(manifest["runs"]):
+        try:
+            run = RunConfig(dict(defaults, **entry))
+        except ValueError as e:
+            raise click.UsageError("Run {}: {}".format(ii, e))
+        if run["output_format"] not in ("netcdf", "zarr"):
+            raise click.UsageError(
+                "Run {} has unknown output_format '{}'".format(ii, run["output_format"])
+            )
+        if run["scheduler"] is not None and run["scheduler"] not in SCHEDULERS:
+            raise click.UsageError(
+                "Run {} has unknown scheduler '{}'".format(ii, run["scheduler"])
+            )
+        if run["scheduler"] == "distributed" and not DistributedAvailable():
+            raise click.UsageError(
+                "The distributed scheduler needs the distributed package; install deconto21-ais[distributed]"
+            )
+        if run["output_format"] == "zarr" and not ZarrAvailable():
+            raise click.UsageError(
+                "Zarr output needs the zarr package; install deconto21-ais[zarr]"
+            )
+        runs.append(run)
+
+    return runs
+
+
+def PreprocessKey(run):
+    # Runs with the same key can share one preprocessed ensemble
+    temperature_driven = len(run["climate_data_file"]) > 0
+    return (
+        tuple(run[k] for k in RUN_REQUIRED[:6]),
+        run["baseyear"],
+        None if temperature_driven else MapScenario(run["scenario"]),
+        run["lazy_read"],
+        run["cache_dir"],
+        run["ensemble_store"],
+        run["precision"],
+    )
+
+
+def SitesKey(run):
+    return (run["location_file"], run["fingerprint_dir"])
+
+
+def PrepareShared(runs):
+    """
+    Preprocess each distinct ensemble and load each distinct site table once.
+    """
+    shared = {"preprocessed": {}, "sites": {}}
+    for run in runs:
+        pre_key = PreprocessKey(run)
+        if pre_key not in shared["preprocessed"]:
+            logger.info(
+                "Preprocessing ensemble for scenario {}".format(run["scenario"])
+            )
+            shared["preprocessed"][pre_key] = dp21_preprocess_icesheet(
+                scenario=run["scenario"],
+                baseyear=run["baseyear"],
+                pipeline_id=run["pipeline_id"],
+                climate_data_file=run["climate_data_file"],
+                input_paths_dict=InputPathsDict(run),
+                lazy=run["lazy_read"],
+                cache_dir=run["cache_dir"],
+                cache_max_mb=run["cache_max_mb"],
+                ensemble_store=run["ensemble_store"],
+                precision=run["precision"],
+            )
+
+        sites_key = SitesKey(run)
+        if sites_key not in shared["sites"]:
+            logger.info("Loading site fingerprints for {}".format(run["location_file"]))
+            shared["sites"][sites_key] = LoadSiteFingerprints(
+                run["location_file"],
+                run["fingerprint_dir"],
+                run["fingerprint_cache_dir"],
+            )
+
+    return shared
+
+
+def InitWorker(shared, serial_dask):
+    _shared.update(shared)
+
+    # Keep each worker on one core when the pool already uses all of them
+    if serial_dask:
+        dask.config.set(scheduler="synchronous")
+
+
+def RunProjection(ii, run):
+    """
+    Run the projection and postprocessing stages for one manifest entry.
+    """
+    # Reuse the shared ensemble, labelled with this run's scenario
+    preprocess_dict = dict(
+        _shared["preprocessed"][PreprocessKey(run)], scenario=run["scenario"]
+    )
+    site_fingerprints = _shared["sites"][SitesKey(run)]
+
+    logger.info("Run {}: starting".format(ii))
+    results = run_dp21(
+        run, preprocess_dict=preprocess_dict, site_fingerprints=site_fingerprints
+    )
+
+    # Release the output files read back by run_dp21 before the next run
+    for ds in results.values():
+        ds.close()
+
+    return ii
+
+
+@click.command()
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--workers",
+    type=int,
+    help="Number of worker processes running the projection and postprocessing of the runs",
+    envvar="DP21_WORKERS",
+    default=1,
+    show_default=True,
+)
+@click.option(
+    "--debug/--no-debug",
+    default=False,
+    envvar="DP21_DEBUG",
+)
+def main(manifest, workers, debug):
+    """Run a manifest of DP21 ice sheet workflow configurations."""
+
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+
+    runs = LoadManifest(manifest)
+    logger.info("Loaded {} runs from {}".format(len(runs), manifest))
+
+    logger.info("Starting shared preprocessing step...")
+    shared = PrepareShared(runs)
+    logger.info("Finished shared preprocessing step")
+
+    workers = max(1, min(workers, len(runs)))
+    if workers == 1:
+        InitWorker(shared, serial_dask=False)
+        for ii, run in enumerate(runs):
+            RunProjection(ii, run)
+            logger.info("Finished run {}".format(ii))
+        return
+
+    # Shared data is handed to each worker once, not with every run
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=InitWorker,
+        initargs=(shared, True),
+    ) as pool:
+        futures = [pool.submit(RunProjection, ii, run) for ii, run in enumerate(runs)]
+        for future in futures:
+            logger.info("Finished run {}".format(future.result()))
@@ -1,15 +1,46 @@
-from deconto21_ais.deconto21_ais_preprocess import dp21_preprocess_icesheet
-from deconto21_ais.deconto21_ais_project import (
-    dp21_project_icesheet,
-    dp21_project_icesheet_temperaturedriven,
-)
-from deconto21_ais.deconto21_ais_postprocess import dp21_postprocess_icesheet
+import logging
+import time
 
 import click
-import logging
+
+from deconto21_ais.metrics import MeasureStage, StartMetrics, WriteMetrics
+from deconto21_ais.validation import (
+    PRECISIONS,
+    SCHEDULERS,
+    DistributedAvailable,
+    ParseDiskChunks,
+    ParseQuantiles,
+    ParseSitePartition,
+    ValidateInputs,
+    ZarrAvailable,
+)
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
+
+
+def ParseChunksOption(value):
+    try:
+        return ParseDiskChunks(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def ParseQuantilesOption(value):
+    if value is None:
+        return None
+    try:
+        return ParseQuantiles(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+def ParsePartitionOption(value):
+    if value is None:
+        return None
+    try:
+        return ParseSitePartition(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
 
 @click.command()
@@ -125,6 +156,12 @@ logging.basicConfig(level=logging.INFO)
     default=1342,
     show_default=True,
 )
+@click.option(
+    "--sample-batch",
+    type=click.IntRange(min=1),
+    help="Gather, write and localize the samples in batches of this size, bounding memory for large sample counts",
+    envvar="DP21_SAMPLE_BATCH",
+)
 @click.option(
     "--location-file",
     type=str,
@@ -140,6 +177,50 @@ logging.basicConfig(level=logging.INFO)
     default=50,
     show_default=True,
 )
+@click.option(
+    "--max-chunk-mb",
+    type=int,
+    help="Memory budget for each (samples, years, locations) chunk of the localized projections, in MB",
+    envvar="DP21_MAX_CHUNK_MB",
+    default=64,
+    show_default=True,
+)
+@click.option(
+    "--lslr-chunks",
+    type=str,
+    help="On-disk 'samples,years,locations' chunk shape of the local sea level rise files; 0 spans the whole axis, except samples, where it spans at most 4 MB of values per chunk",
+    envvar="DP21_LSLR_CHUNKS",
+    default="0,0,1",
+    show_default=True,
+    callback=lambda ctx, param, value: ParseChunksOption(value),
+)
+@click.option(
+    "--site-partition",
+    type=str,
+    help="Localize only partition 'i/N' (0 <= i < N) of the sites, writing lslr shard files for deconto21-ais-merge",
+    envvar="DP21_SITE_PARTITION",
+    callback=lambda ctx, param, value: ParsePartitionOption(value),
+)
+@click.option(
+    "--scheduler",
+    type=click.Choice(SCHEDULERS),
+    help="Dask scheduler computing the localized projections",
+    envvar="DP21_SCHEDULER",
+    default="threads",
+    show_default=True,
+)
+@click.option(
+    "--dask-workers",
+    type=click.IntRange(min=1),
+    help="Number of dask threads or worker processes for the localized projections; one per core if not given",
+    envvar="DP21_DASK_WORKERS",
+)
+@click.option(
+    "--memory-limit",
+    type=str,
+    help="Memory limit per worker of the distributed scheduler, e.g. '4GB'",
+    envvar="DP21_MEMORY_LIMIT",
+)
 @click.option(
     "--pipeline-id",
     type=str,
@@ -153,6 +234,12 @@ logging.basicConfig(level=logging.INFO)
     envvar="DP21_FINGERPRINT_DIR",
     required=True,
 )
+@click.option(
+    "--fingerprint-cache-dir",
+    type=str,
+    help="Directory for caching fingerprint coefficients at sites between runs; it is never pruned",
+    envvar="DP21_FINGERPRINT_CACHE_DIR",
+)
 @click.option(
     "--output-ais-gslr-file",
     type=str,
@@ -189,6 +276,69 @@ logging.basicConfig(level=logging.INFO)
     help="Output file for WAIS local sea level rise projections",
     envvar="DP21_OUTPUT_WAIS_LSLR_FILE",
 )
+@click.option(
+    "--output-format",
+    type=click.Choice(["netcdf", "zarr"]),
+    help="Format of the global and local sea level rise outputs",
+    envvar="DP21_OUTPUT_FORMAT",
+    default="netcdf",
+    show_default=True,
+)
+@click.option(
+    "--summary-quantiles",
+    type=str,
+    help="Also write per-site quantiles of the local sea level rise, as comma-separated percentiles, e.g. '5,17,50,83,95'",
+    envvar="DP21_SUMMARY_QUANTILES",
+    callback=lambda ctx, param, value: ParseQuantilesOption(value),
+)
+@click.option(
+    "--summary-only/--no-summary-only",
+    help="Write only the quantile summaries instead of the full local sea level rise samples",
+    envvar="DP21_SUMMARY_ONLY",
+    default=False,
+    show_default=True,
+)
+@click.option(
+    "--lazy-read/--no-lazy-read",
+    help="Read only the sampled ensemble members and target years from the input files; takes precedence over --cache-dir",
+    envvar="DP21_LAZY_READ",
+    default=False,
+    show_default=True,
+)
+@click.option(
+    "--cache-dir",
+    type=str,
+    help="Directory for caching preprocessed ice sheet ensembles between runs; not used with --lazy-read",
+    envvar="DP21_CACHE_DIR",
+)
+@click.option(
+    "--cache-max-mb",
+    type=int,
+    help="Size cap for the preprocessed ensemble cache, in MB",
+    envvar="DP21_CACHE_MAX_MB",
+    default=4096,
+    show_default=True,
+)
+@click.option(
+    "--ensemble-store",
+    type=str,
+    help="Directory of a memory-mapped float32 store of the preprocessed ensembles; written on first use and used in place of --lazy-read",
+    envvar="DP21_ENSEMBLE_STORE",
+)
+@click.option(
+    "--precision",
+    type=click.Choice(PRECISIONS),
+    help="Precision of the computation; native keeps the ensembles in the type they are stored in, and float64 or float32 converts them once when read and computes in that type",
+    envvar="DP21_PRECISION",
+    default="native",
+    show_default=True,
+)
+@click.option(
+    "--metrics-file",
+    type=str,
+    help="Write the wall time, CPU time, peak memory and I/O of each stage to this JSON file",
+    envvar="DP21_METRICS_FILE",
+)
 @click.option(
     "--debug/--no-debug",
     default=False,
@@ -210,85 +360,96 @@ def main(
     pyear_step,
     replace,
     rngseed,
+    sample_batch,
     pipeline_id,
     location_file,
     chunksize,
+    max_chunk_mb,
+    lslr_chunks,
+    site_partition,
+    scheduler,
+    dask_workers,
+    memory_limit,
     fingerprint_dir,
+    fingerprint_cache_dir,
     output_ais_gslr_file,
     output_eais_gslr_file,
     output_wais_gslr_file,
     output_ais_lslr_file,
     output_eais_lslr_file,
     output_wais_lslr_file,
+    lazy_read,
+    cache_dir,
+    cache_max_mb,
+    ensemble_store,
+    output_format,
+    summary_quantiles,
+    summary_only,
+    precision,
+    metrics_file,
     debug,
 ):
     """Run the DP21 ice sheet workflow."""
 
     click.echo("Hello from deconto21-ais!")
-    if debug:
-        logging.root.setLevel(logging.DEBUG)
-    else:
-        logging.root.setLevel(logging.INFO)
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
 
-    input_data_dict = {
-        "rcp26": {"eais": input_eais_rcp26_file, "wais": input_wais_rcp26_file},
-        "rcp45": {"eais": input_eais_rcp45_file, "wais": input_wais_rcp45_file},
-        "rcp85": {"eais": input_eais_rcp85_file, "wais": input_wais_rcp85_file},
-    }
-    # Run the preprocessing stage
-    logger.info("Starting preprocessing step...")
-    dp21_preprocessed_data = dp21_preprocess_icesheet(
-        scenario=scenario,
-        baseyear=baseyear,
-        input_paths_dict=input_data_dict,
-        pipeline_id=pipeline_id,
-        climate_data_file=climate_data_file,
-    )
-    logger.info("Finished preprocessing step")
-
-    # Run the projection stage
-    logger.info("Starting projection step...")
-    if climate_data_file is not None:
-        dp21_projected_data = dp21_project_icesheet_temperaturedriven(
-            climate_data_file=climate_data_file,
-            pyear_start=pyear_start,
-            pyear_end=pyear_end,
-            pyear_step=pyear_step,
-            pipeline_id=pipeline_id,
-            replace=replace,
-            rngseed=rngseed,
-            preprocess_dict=dp21_preprocessed_data,
-            output_ais_gslr_file=output_ais_gslr_file,
-            output_eais_gslr_file=output_eais_gslr_file,
-            output_wais_gslr_file=output_wais_gslr_file,
+    if output_format == "zarr" and not ZarrAvailable():
+        raise click.UsageError(
+            "Zarr output needs the zarr package; install deconto21-ais[zarr]"
         )
-    # if climate_data_file is None:
-    else:
-        dp21_projected_data = dp21_project_icesheet(
-            nsamps=nsamps,
-            pyear_start=pyear_start,
-            pyear_end=pyear_end,
-            pyear_step=pyear_step,
-            replace=replace,
-            rngseed=rngseed,
-            pipeline_id=pipeline_id,
-            preprocess_dict=dp21_preprocessed_data,
-            output_ais_gslr_file=output_ais_gslr_file,
-            output_eais_gslr_file=output_eais_gslr_file,
-            output_wais_gslr_file=output_wais_gslr_file,
+    if summary_only and summary_quantiles is None:
+        raise click.UsageError("--summary-only needs --summary-quantiles")
+    if scheduler == "distributed" and not DistributedAvailable():
+        raise click.UsageError(
+            "The distributed scheduler needs the distributed package; install deconto21-ais[distributed]"
+        )
+
+    try:
+        ValidateInputs(
+            scenario,
+            climate_data_file,
+            [
+                input_eais_rcp26_file,
+                input_eais_rcp45_file,
+                input_eais_rcp85_file,
+                input_wais_rcp26_file,
+                input_wais_rcp45_file,
+                input_wais_rcp85_file,
+            ],
+            location_file,
+            fingerprint_dir,
+            pyear_start,
+            pyear_end,
+            pyear_step,
         )
-    logger.info("Finished projection step")
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+    if metrics_file is not None:
+        StartMetrics()
+
+    # The workflow modules pull in xarray, dask, scipy, h5py and netCDF4, so
+    # they are only imported once the arguments and inputs check out
+    with MeasureStage("import modules"):
+        from deconto21_ais.pipeline import run_dp21
 
-    # Run the post-processing stage
-    logger.info("Starting postprocessing step...")
-    dp21_postprocess_icesheet(
-        locationfile=location_file,
-        chunksize=chunksize,
-        pipeline_id=pipeline_id,
-        projected_dict=dp21_projected_data,
-        fpdir=fingerprint_dir,
-        out_ais_lslr_file=output_ais_lslr_file,
-        out_eais_lslr_file=output_eais_lslr_file,
-        out_wais_lslr_file=output_wais_lslr_file,
+    # The options are the run configuration, named as the run keys
+    params = click.get_current_context().params
+    results = run_dp21(
+        {k: v for k, v in params.items() if k not in ("metrics_file", "debug")}
     )
-    logger.info("Finished postprocessing step")
+
+    # Only the files matter here, so release the outputs read back from them
+    for ds in results.values():
+        ds.close()
+
+    if metrics_file is not None:
+        WriteMetrics(
+            metrics_file,
+            command="deconto21-ais",
+            pipeline_id=pipeline_id,
+            scenario=scenario,
+            created=time.ctime(time.time()),
+        )
+        logger.info("Wrote stage metrics to {}".format(metrics_file))
@@ -3,10 +3,24 @@ import os
 import time
 import argparse
 from deconto21_ais.read_locationfile import ReadLocationFile
-from deconto21_ais.AssignFP import AssignFP
+from deconto21_ais.AssignFP import AssignFPs
+from deconto21_ais.fingerprint_cache import CachedAssignFPs
+from deconto21_ais.metrics import MeasureStage
+from deconto21_ais.scheduler import DaskScheduler, SchedulerInProcess
+from deconto21_ais.validation import PrecisionDtype
+from deconto21_ais.localized_writer import (
+    DEFAULT_DISK_CHUNKS,
+    ResolveDiskChunks,
+    ShardFilename,
+    StoreLocalized,
+    SummaryFilename,
+    WriteSummaries,
+    make_localized_ds,
+)
 
-import xarray as xr
+import dask
 import dask.array as da
+import xarray as xr
 
 """ dp21_postprocess_icesheet.py
 
@@ -22,8 +36,234 @@ pipeline_id = Unique identifer for the pipeline running this code
 
 Output: NetCDF file containing local contributions from ice sheets
 
+dp21_postprocess_icesheet also returns the localized projections as lazy,
+dask-backed datasets laid out like the output files, keyed "wais_lslr",
+"eais_lslr" and "ais_lslr", plus "<key>_quantiles" for the quantile summaries,
+which are taken in the same pass as the lslr files are written. Projections
+written to files are read back from them, and stay open until the caller
+closes them; only the others are localized when computed. Without lslr files,
+summaries of all three are kept in memory.
+
+With sample_batch, the localized projections are chunked, and by default laid
+out on disk, one sample batch at a time, so each on-disk chunk is finished by
+one block and the HDF5 chunk cache is held to max_chunk_mb, however large
+nsamps is.
+
 """
 
+ICE_SOURCES = ("wais", "eais", "ais")
+
+
+def PartitionSlice(nlocs, site_partition):
+    # Contiguous slice of the sites for partition (index, count), with the
+    # sites split as evenly as possible and in location file order
+    (index, count) = site_partition
+    part = slice(nlocs * index // count, nlocs * (index + 1) // count)
+    if part.start == part.stop:
+        raise ValueError(
+            "Site partition {}/{} of {} sites is empty".format(index, count, nlocs)
+        )
+
+    return part
+
+
+def PartitionSites(site_fingerprints, site_partition):
+    # Restrict precomputed site fingerprints to one partition of the sites
+    part = PartitionSlice(len(site_fingerprints["site_ids"]), site_partition)
+
+    return {key: values[part] for key, values in site_fingerprints.items()}
+
+
+def LoadSiteFingerprints(locationfile, fpdir, fp_cache_dir=None, site_partition=None):
+    """
+    Read the site table and interpolate the ice sheet fingerprints to the sites.
+
+    The result only depends on the location file and fingerprint directory, so
+    it can be computed once and passed to several dp21_postprocess_icesheet
+    calls through their site_fingerprints argument. With fp_cache_dir, the
+    coefficients at each site are also cached on disk across runs. With
+    site_partition, given as (index, count), only that partition of the sites
+    is loaded.
+
+    Returns
+    -------
+    dict
+            Site ids, lats and lons, and the WAIS and EAIS fingerprint
+            coefficients at each site.
+    """
+    # Load the site locations
+    with MeasureStage("read locations"):
+        (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
+    if site_partition is not None:
+        part = PartitionSlice(len(site_ids), site_partition)
+        (site_ids, site_lats, site_lons) = (
+            site_ids[part],
+            site_lats[part],
+            site_lons[part],
+        )
+
+    # Get the fingerprints for all sites from all ice sheets
+    fp_files = [
+        os.path.join(fpdir, "fprint_wais.nc"),
+        os.path.join(fpdir, "fprint_eais.nc"),
+    ]
+    # Both ice sheets share one grid, so the stencil is computed once, also
+    # for the sites missing from the cache
+    with MeasureStage("assign fingerprints"):
+        if fp_cache_dir is None:
+            (waisfp, eaisfp) = AssignFPs(fp_files, site_lats, site_lons)
+        else:
+            (waisfp, eaisfp) = CachedAssignFPs(
+                fp_files, site_lats, site_lons, fp_cache_dir
+            )
+
+    return {
+        "site_ids": site_ids,
+        "site_lats": site_lats,
+        "site_lons": site_lons,
+        "waisfp": waisfp,
+        "eaisfp": eaisfp,
+    }
+
+
+def LocalizedChunks(
+    nsamps,
+    nyears,
+    nlocs,
+    chunksize,
+    max_chunk_mb,
+    itemsize=8,
+    align=None,
+    sample_chunk=None,
+):
+    """
+    Pick (samples, years, locations) chunk shapes for the localized projections.
+
+    Locations are chunked by chunksize, then samples, and only if needed years
+    and locations, are reduced until one chunk fits in max_chunk_mb. Samples
+    are chunked by at most sample_chunk if given, e.g. the sample batch.
+
+    If align gives an on-disk chunk shape, chunks are instead made of whole
+    on-disk chunks, so no on-disk chunk is written by more than one block:
+    locations are chunked by chunksize rounded down to whole on-disk chunks,
+    then locations, years and samples are reduced in that order, in whole
+    on-disk chunks, until one chunk fits. Only if a single on-disk chunk does
+    not fit is it split, samples first.
+
+    Returns
+    -------
+    tuple of int
+            Chunk lengths along samples, years and locations.
+    """
+    max_items = max(1, int(max_chunk_mb * 1024**2) // itemsize)
+
+    if align is None:
+        loc_chunk = max(1, min(chunksize, nlocs))
+        year_chunk = max(1, nyears)
+
+        # Shrink locations, then years, if a single sample does not fit
+        while year_chunk * loc_chunk > max_items and loc_chunk > 1:
+            loc_chunk = max(1, loc_chunk // 2)
+        while year_chunk * loc_chunk > max_items and year_chunk > 1:
+            year_chunk = max(1, year_chunk // 2)
+
+        samp_chunk = max(1, min(nsamps, max_items // (year_chunk * loc_chunk)))
+        if sample_chunk is not None:
+            samp_chunk = min(samp_chunk, sample_chunk)
+
+        return (samp_chunk, year_chunk, loc_chunk)
+
+    chunks = [
+        max(1, nsamps if sample_chunk is None else min(nsamps, sample_chunk)),
+        max(1, nyears),
+        max(align[2], min(chunksize, nlocs) // align[2] * align[2]),
+    ]
+
+    # Shrink locations, then years, then samples, in whole on-disk chunks
+    for axis in (2, 1, 0):
+        while np.prod(chunks) > max_items and chunks[axis] > align[axis]:
+            chunks[axis] = max(
+                align[axis], chunks[axis] // 2 // align[axis] * align[axis]
+            )
+
+    # Split the on-disk chunk only if it does not fit on its own
+    if np.prod(chunks) > max_items:
+        chunks[0] = max(1, max_items // (chunks[1] * chunks[2]))
+        for axis in (2, 1):
+            while np.prod(chunks) > max_items and chunks[axis] > 1:
+                chunks[axis] = max(1, chunks[axis] // 2)
+
+    return tuple(int(c) for c in chunks)
+
+
+def SummaryChunks(
+    nsamps, nyears, nlocs, chunksize, max_chunk_mb, itemsize=8, align=None
+):
+    """
+    Pick (samples, years, locations) chunk shapes holding every sample.
+
+    Locations are chunked by chunksize, then locations and, if needed, years
+    are reduced until one chunk fits in max_chunk_mb, down to a single site
+    and year.
+
+    If align gives an on-disk chunk shape, locations and years are kept to
+    whole on-disk chunks for as long as one still fits, as in
+    LocalizedChunks.
+
+    Returns
+    -------
+    tuple of int
+            Chunk lengths along samples, years and locations.
+    """
+    max_items = max(1, int(max_chunk_mb * 1024**2) // itemsize)
+    align = (1, 1, 1) if align is None else align
+
+    chunks = [
+        max(1, nsamps),
+        max(1, nyears),
+        max(align[2], min(chunksize, nlocs) // align[2] * align[2]),
+    ]
+
+    # Shrink locations, then years, in whole on-disk chunks, and then below
+    for step in (align, (1, 1, 1)):
+        for axis in (2, 1):
+            while np.prod(chunks) > max_items and chunks[axis] > step[axis]:
+                chunks[axis] = max(
+                    step[axis], chunks[axis] // 2 // step[axis] * step[axis]
+                )
+
+    return tuple(int(c) for c in chunks)
+
+
+def LocalizeSamples(waissamps, eaissamps, site_fingerprints, chunks, dtype=None):
+    """
+    Apply the site fingerprints to the samples as dask arrays with the given
+    (samples, years, locations) chunks, computed in dtype if given.
+
+    Returns
+    -------
+    tuple of dask.array.Array
+            WAIS, EAIS and AIS localized projections.
+    """
+    # Samples may already be dask arrays when they are gathered in batches
+    waissamps = da.asarray(waissamps).rechunk(chunks[:2])
+    eaissamps = da.asarray(eaissamps).rechunk(chunks[:2])
+    waisfp = da.from_array(site_fingerprints["waisfp"], chunks=chunks[2])
+    eaisfp = da.from_array(site_fingerprints["eaisfp"], chunks=chunks[2])
+    if dtype is not None:
+        (waissamps, eaissamps, waisfp, eaisfp) = (
+            x.astype(dtype) for x in (waissamps, eaissamps, waisfp, eaisfp)
+        )
+
+    # Apply the fingerprints to the projections
+    waissl = np.multiply.outer(waissamps, waisfp)
+    eaissl = np.multiply.outer(eaissamps, eaisfp)
+
+    # Add up the east and west components for AIS total
+    aissl = waissl + eaissl
+
+    return (waissl, eaissl, aissl)
+
 
 def dp21_postprocess_icesheet(
     chunksize,
@@ -34,6 +274,19 @@ def dp21_postprocess_icesheet(
     out_ais_lslr_file,
     out_eais_lslr_file,
     out_wais_lslr_file,
+    site_fingerprints=None,
+    max_chunk_mb=64,
+    disk_chunks=DEFAULT_DISK_CHUNKS,
+    output_format="netcdf",
+    fp_cache_dir=None,
+    site_partition=None,
+    scheduler=None,
+    dask_workers=None,
+    memory_limit=None,
+    summary_quantiles=None,
+    summary_only=False,
+    precision="native",
+    sample_batch=None,
 ):
     waissamps = projected_dict["wais_samps"]
     eaissamps = projected_dict["eais_samps"]
@@ -41,37 +294,47 @@ def dp21_postprocess_icesheet(
     scenario = projected_dict["scenario"]
     baseyear = projected_dict["baseyear"]
 
-    # Load the site locations
-    (_, site_ids, site_lats, site_lons) = ReadLocationFile(locationfile)
+    # Load the site locations and their fingerprints unless they were given
+    if site_fingerprints is None:
+        site_fingerprints = LoadSiteFingerprints(
+            locationfile, fpdir, fp_cache_dir, site_partition
+        )
+    elif site_partition is not None:
+        site_fingerprints = PartitionSites(site_fingerprints, site_partition)
+    site_ids = site_fingerprints["site_ids"]
+    site_lats = site_fingerprints["site_lats"]
+    site_lons = site_fingerprints["site_lons"]
 
     # Get some dimension data from the loaded data structures
-    nsamps = eaissamps.shape[0]
+    nsamps, nyears = eaissamps.shape
 
-    # Get the fingerprints for all sites from all ice sheets
-    waisfp = da.from_array(
-        AssignFP(os.path.join(fpdir, "fprint_wais.nc"), site_lats, site_lons),
-        chunks=chunksize,
-    )
-    eaisfp = da.from_array(
-        AssignFP(os.path.join(fpdir, "fprint_eais.nc"), site_lats, site_lons),
-        chunks=chunksize,
-    )
-
-    # Rechunk the fingerprints for memory
-    # waisfp = waisfp.rechunk(chunksize)
-    # eaisfp = eaisfp.rechunk(chunksize)
-
-    # Apply the fingerprints to the projections
-    waissl = np.multiply.outer(waissamps, waisfp)
-    eaissl = np.multiply.outer(eaissamps, eaisfp)
-
-    # Add up the east and west components for AIS total
-    aissl = waissl + eaissl
+    # Localize in the precision asked for, or as promoted by the float64
+    # fingerprints
+    dtype = PrecisionDtype(precision)
+    itemsize = 8 if dtype is None else dtype.itemsize
 
-    # Define the missing value for the netCDF files
-    nc_missing_value = np.nan  # np.iinfo(np.int16).min
+    # Chunk all three axes of the localized projections to fit the memory
+    # budget, keeping every sample in one chunk if quantiles are taken, and
+    # otherwise one sample batch, whose on-disk chunks it then fills
+    nlocs = len(site_ids)
+    align = ResolveDiskChunks(disk_chunks, (nsamps, nyears, nlocs), sample_batch)
+    if summary_quantiles is None:
+        chunks = LocalizedChunks(
+            nsamps,
+            nyears,
+            nlocs,
+            chunksize,
+            max_chunk_mb,
+            itemsize,
+            align,
+            sample_chunk=sample_batch,
+        )
+    else:
+        chunks = SummaryChunks(
+            nsamps, nyears, nlocs, chunksize, max_chunk_mb, itemsize, align
+        )
 
-    # Create the xarray data structures for the localized projections
+    # Attributes for the localized projection files
     ncvar_attributes = {
         "description": "Local SLR contributions from icesheets according to DP21 workflow",
         "history": "Created " + time.ctime(time.time()),
@@ -80,97 +343,202 @@ def dp21_postprocess_icesheet(
         "baseyear": baseyear,
     }
 
-    wais_out = xr.Dataset(
-        {
-            "sea_level_change": (
-                ("samples", "years", "locations"),
-                waissl,
-                {"units": "mm", "missing_value": nc_missing_value},
-            ),
-            "lat": (("locations"), site_lats),
-            "lon": (("locations"), site_lons),
-        },
-        coords={
-            "years": targyears,
-            "locations": site_ids,
-            "samples": np.arange(nsamps),
-        },
-        attrs=ncvar_attributes,
-    )
+    # Output files for the ICE_SOURCES, skipping those not set
+    out_files = [
+        (ii, out_file)
+        for ii, out_file in enumerate(
+            (out_wais_lslr_file, out_eais_lslr_file, out_ais_lslr_file)
+        )
+        if out_file is not None
+    ]
+    # Summaries are written next to the lslr files, or only kept in memory
+    # if no lslr file is set
+    if summary_quantiles is None:
+        summary_files = []
+    elif len(out_files) > 0:
+        summary_files = [(ii, SummaryFilename(f)) for ii, f in out_files]
+    else:
+        summary_files = [(ii, None) for ii in range(len(ICE_SOURCES))]
+    if summary_only:
+        out_files = []
 
-    eais_out = xr.Dataset(
-        {
-            "sea_level_change": (
-                ("samples", "years", "locations"),
-                eaissl,
-                {"units": "mm", "missing_value": nc_missing_value},
-            ),
-            "lat": (("locations"), site_lats),
-            "lon": (("locations"), site_lons),
-        },
-        coords={
-            "years": targyears,
-            "locations": site_ids,
-            "samples": np.arange(nsamps),
-        },
-        attrs=ncvar_attributes,
-    )
+    # A partition of the sites is written to shard files for dp21_merge_lslr_shards
+    if site_partition is not None:
+        out_files = [(ii, ShardFilename(f, *site_partition)) for ii, f in out_files]
+        summary_files = [
+            (ii, f if f is None else ShardFilename(f, *site_partition))
+            for ii, f in summary_files
+        ]
 
-    ais_out = xr.Dataset(
-        {
-            "sea_level_change": (
-                ("samples", "years", "locations"),
-                aissl,
-                {"units": "mm", "missing_value": nc_missing_value},
-            ),
-            "lat": (("locations"), site_lats),
-            "lon": (("locations"), site_lons),
-        },
-        coords={
-            "years": targyears,
-            "locations": site_ids,
-            "samples": np.arange(nsamps),
-        },
+    coords = dict(
+        targyears=targyears,
+        site_ids=site_ids,
+        site_lats=site_lats,
+        site_lons=site_lons,
         attrs=ncvar_attributes,
     )
 
-    # Write the netcdf output files
-    wais_out.to_netcdf(
-        out_wais_lslr_file,
-        engine="netcdf4",
-        encoding={
-            "sea_level_change": {
-                "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
-                "_FillValue": nc_missing_value,
-            }
-        },
-    )
-    eais_out.to_netcdf(
-        out_eais_lslr_file,
-        engine="netcdf4",
-        encoding={
-            "sea_level_change": {
-                "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
-                "_FillValue": nc_missing_value,
-            }
-        },
-    )
-    ais_out.to_netcdf(
-        out_ais_lslr_file,
-        engine="netcdf4",
-        encoding={
-            "sea_level_change": {
-                "dtype": "f4",
-                "zlib": True,
-                "complevel": 4,
-                "_FillValue": nc_missing_value,
-            }
-        },
-    )
+    # All blocks are computed on the requested dask scheduler
+    with DaskScheduler(scheduler, dask_workers, memory_limit):
+        # Out-of-process workers gather the sample batches once for every
+        # block and the deferred gslr writes
+        gslr_writes = projected_dict.get("gslr_writes", [])
+        if not SchedulerInProcess() and isinstance(waissamps, da.Array):
+            (waissamps, eaissamps, *gslr_sources) = dask.persist(
+                waissamps, eaissamps, *[source for source, _ in gslr_writes]
+            )
+            gslr_writes = [
+                (source, writer)
+                for source, (_, writer) in zip(gslr_sources, gslr_writes)
+            ]
+
+        # Stream the output files, the summaries and any deferred gslr writes
+        # in a single pass, so each sample batch and each WAIS and EAIS block
+        # is computed once and shared with the AIS total and the summaries
+        localsl = LocalizeSamples(
+            waissamps, eaissamps, site_fingerprints, chunks, dtype
+        )
+        if len(out_files) > 0 or len(summary_files) > 0 or len(gslr_writes) > 0:
+            with MeasureStage("localize"):
+                summaries = StoreLocalized(
+                    sources=[localsl[ii] for ii, _ in out_files],
+                    filenames=[f for _, f in out_files],
+                    disk_chunks=align,
+                    output_format=output_format,
+                    summary_sources=[localsl[ii] for ii, _ in summary_files],
+                    quantiles=summary_quantiles,
+                    projections=gslr_writes,
+                    # Batched blocks finish their on-disk chunks, so the chunk
+                    # cache need not grow with nsamps
+                    cache_mb=None if sample_batch is None else max_chunk_mb,
+                    **coords,
+                )
+
+        ds_summaries = []
+        if len(summary_files) > 0:
+            with MeasureStage("quantile summaries"):
+                ds_summaries = WriteSummaries(
+                    summaries,
+                    filenames=[f for _, f in summary_files],
+                    quantiles=summary_quantiles,
+                    output_format=output_format,
+                    **coords,
+                )
+
+    # Hand back the localized projections as lazy datasets laid out like the
+    # lslr files: those written are read back from their files, so using them
+    # does not repeat the localisation, and the others come from its graph
+    output = {
+        "{}_lslr".format(ice): make_localized_ds(source.astype(np.float32), **coords)
+        for ice, source in zip(ICE_SOURCES, localsl)
+    }
+    engine = "zarr" if output_format == "zarr" else "netcdf4"
+    for ii, out_file in out_files:
+        output["{}_lslr".format(ICE_SOURCES[ii])] = xr.open_dataset(
+            out_file, engine=engine, chunks={}
+        )
+    for (ii, _), ds_summary in zip(summary_files, ds_summaries):
+        output["{}_lslr_quantiles".format(ICE_SOURCES[ii])] = ds_summary
+
+    return output
+
+
+def dp21_merge_lslr_shards(
+    out_lslr_file,
+    count,
+    chunksize=50,
+    max_chunk_mb=64,
+    disk_chunks=DEFAULT_DISK_CHUNKS,
+    output_format="netcdf",
+):
+    """
+    Concatenate the shards of a site-partitioned lslr output along locations.
+
+    Works for the full lslr outputs and their quantile summaries.
+
+    Parameters
+    ----------
+    out_lslr_file : str
+            Local sea level rise output given to the partitioned runs; the
+            shards are found next to it and the merged file written to it.
+    count : int
+            Number of site partitions.
+    chunksize, max_chunk_mb, disk_chunks, output_format
+            As for dp21_postprocess_icesheet.
+    """
+    shard_files = [ShardFilename(out_lslr_file, ii, count) for ii in range(count)]
+    missing = [f for f in shard_files if not os.path.exists(f)]
+    if missing:
+        raise FileNotFoundError(
+            "Missing lslr shards for {}: {}".format(out_lslr_file, ", ".join(missing))
+        )
+
+    engine = "zarr" if output_format == "zarr" else "netcdf4"
+    shards = [xr.open_dataset(f, engine=engine) for f in shard_files]
+    try:
+        # Quantile summaries are small, so they are concatenated in memory
+        if "quantiles" in shards[0].dims:
+            merged = xr.concat([shard.load() for shard in shards], dim="locations")
+            if output_format == "zarr":
+                merged.to_zarr(out_lslr_file, mode="w")
+            else:
+                merged.to_netcdf(out_lslr_file)
+            return None
+
+        targyears = shards[0]["years"].values
+        for shard_file, shard in zip(shard_files[1:], shards[1:]):
+            if not (
+                np.array_equal(shard["years"].values, targyears)
+                and shard.sizes["samples"] == shards[0].sizes["samples"]
+            ):
+                raise ValueError(
+                    "Shard {} does not match the samples and years of {}".format(
+                        shard_file, shard_files[0]
+                    )
+                )
+
+        # Read the shards lazily in blocks of the merged chunk shape
+        nsamps = shards[0].sizes["samples"]
+        nlocs = sum(shard.sizes["locations"] for shard in shards)
+        chunks = LocalizedChunks(
+            nsamps,
+            len(targyears),
+            nlocs,
+            chunksize,
+            max_chunk_mb,
+            itemsize=4,
+            align=ResolveDiskChunks(disk_chunks, (nsamps, len(targyears), nlocs)),
+        )
+        localsl = da.concatenate(
+            [
+                shard["sea_level_change"]
+                .chunk(dict(zip(("samples", "years", "locations"), chunks)))
+                .data
+                for shard in shards
+            ],
+            axis=2,
+        ).rechunk(chunks)
+
+        merged = dict(
+            sources=[localsl],
+            filenames=[out_lslr_file],
+            targyears=targyears,
+            site_ids=np.concatenate([shard["locations"].values for shard in shards]),
+            site_lats=np.concatenate([shard["lat"].values for shard in shards]),
+            site_lons=np.concatenate([shard["lon"].values for shard in shards]),
+            attrs=dict(shards[0].attrs),
+        )
+        if output_format == "zarr":
+            StoreLocalized(output_format=output_format, **merged)
+        else:
+            # Shard reads and merged writes go through the same non-thread-safe
+            # netCDF/HDF5 library, so blocks are copied one at a time
+            with dask.config.set(scheduler="synchronous"):
+                StoreLocalized(disk_chunks=disk_chunks, **merged)
+    finally:
+        for shard in shards:
+            shard.close()
+
     return None
 
 
@@ -1,6 +1,20 @@
 import numpy as np
 import argparse
+import logging
 from netCDF4 import Dataset
+from xarray.backends.locks import HDF5_LOCK
+from deconto21_ais.ensemble_cache import (
+    EnsembleCacheKey,
+    LoadCachedEnsemble,
+    StoreCachedEnsemble,
+)
+from deconto21_ais.ensemble_store import (
+    EnsembleStoreExists,
+    OpenEnsembleStore,
+    WriteEnsembleStore,
+)
+from deconto21_ais.metrics import MeasureStage
+from deconto21_ais.validation import SCENARIO_MAP, PrecisionDtype
 
 """ dp_preprocess_icesheet.py
 
@@ -8,34 +22,118 @@ Preprocess data for use in the dp21 icesheet module.
 
 Parameters:
 scenario - Emissions scenario of interest
+precision - 'float64' or 'float32' converts the ensembles to that type as
+            they are read; 'native' (default) keeps them as stored, e.g.
+            float32 in the DP21 files and ensemble stores
 
 Note: 'pipeline_id' is a unique identifier that distinguishes it among other instances
 of this module within the same workflow.
 
 """
 
+logger = logging.getLogger(__name__)
+
 
 def dp21_preprocess_icesheet(
-    scenario, baseyear, pipeline_id, climate_data_file, input_paths_dict
+    scenario,
+    baseyear,
+    pipeline_id,
+    climate_data_file,
+    input_paths_dict,
+    lazy=False,
+    cache_dir=None,
+    cache_max_mb=4096,
+    ensemble_store=None,
+    precision="native",
 ):
+    # Ensembles are converted to this type once, as they are read
+    dtype = PrecisionDtype(precision)
+
     # keeping f1 approach.
     if len(climate_data_file) > 0:
         scens = ["rcp26", "rcp45", "rcp85"]
-        years, eais_samps, wais_samps = ReadScenarioFile(
-            scenario=scens[0], baseyear=baseyear, paths_dict=input_paths_dict
+    else:
+        scens = [scenario]
+
+    # An ensemble store is used in place of lazy reads, and lazy reads in
+    # place of the cache
+    if lazy and cache_dir is not None and ensemble_store is None:
+        logger.warning(
+            "Lazy reads do not go through the preprocessed ensemble cache; ignoring cache_dir {}".format(
+                cache_dir
+            )
         )
-        eais_samps = eais_samps[:, :, np.newaxis]
-        wais_samps = wais_samps[:, :, np.newaxis]
-        for ii in range(1, len(scens)):
-            years, e, w = ReadScenarioFile(
-                scenario=scens[ii], baseyear=baseyear, paths_dict=input_paths_dict
+
+    store_scens = [MapScenario(s) for s in scens]
+    store_files = [f for s in scens for f in MapScenarioPaths(s, input_paths_dict)]
+    if ensemble_store is not None and EnsembleStoreExists(ensemble_store):
+        logger.info("Using ensemble store {}".format(ensemble_store))
+        with MeasureStage("open ensemble store"):
+            years, eais_samps, wais_samps = OpenEnsembleStore(
+                ensemble_store, store_scens, baseyear, store_files
             )
-            eais_samps = np.append(eais_samps, e[:, :, np.newaxis], axis=2)
-            wais_samps = np.append(wais_samps, w[:, :, np.newaxis], axis=2)
+    elif lazy and ensemble_store is None:
+        # Hand back file-backed handles; only the hyperslabs the projection
+        # stage indexes are ever read
+        eais_files, wais_files = zip(
+            *[MapScenarioPaths(s, input_paths_dict) for s in scens]
+        )
+        if len(scens) == 1:
+            eais_files, wais_files = eais_files[0], wais_files[0]
+        eais_samps = LazyEnsemble(eais_files, baseyear, dtype=dtype)
+        wais_samps = LazyEnsemble(wais_files, baseyear, dtype=dtype)
+        years = eais_samps.years
+    elif cache_dir is not None:
+        years, eais_samps, wais_samps = ReadCachedScenarioFiles(
+            scenarios=scens,
+            baseyear=baseyear,
+            paths_dict=input_paths_dict,
+            cache_dir=cache_dir,
+            cache_max_mb=cache_max_mb,
+            dtype=dtype,
+        )
+    elif len(scens) > 1:
+        years, eais_samps, wais_samps = ReadScenarioFiles(
+            scenarios=scens,
+            baseyear=baseyear,
+            paths_dict=input_paths_dict,
+            dtype=dtype,
+        )
     else:
         years, eais_samps, wais_samps = ReadScenarioFile(
-            scenario, baseyear, input_paths_dict
+            scenario, baseyear, input_paths_dict, dtype
+        )
+
+    if ensemble_store is not None and not EnsembleStoreExists(ensemble_store):
+        # Write the store once, from ensembles read in full even for lazy
+        # reads, then work from the mapped copy so the in-memory ensembles
+        # can be released
+        logger.info("Writing ensemble store {}".format(ensemble_store))
+        with MeasureStage("write ensemble store"):
+            WriteEnsembleStore(
+                ensemble_store,
+                years,
+                eais_samps,
+                wais_samps,
+                store_scens,
+                baseyear,
+                store_files,
+            )
+        years, eais_samps, wais_samps = OpenEnsembleStore(
+            ensemble_store, store_scens, baseyear, store_files
         )
+
+    # The store holds float32 ensembles, so any other precision asked for is
+    # converted in memory, in place of the mapped copy
+    if ensemble_store is not None and dtype is not None and eais_samps.dtype != dtype:
+        logger.warning(
+            "Converting ensemble store {} to {} in memory".format(
+                ensemble_store, dtype.name
+            )
+        )
+        eais_samps = np.asarray(eais_samps, dtype=dtype)
+        wais_samps = np.asarray(wais_samps, dtype=dtype)
+
     output = {
         "years": years,
         "eais_samps": eais_samps,
@@ -47,39 +145,121 @@ def dp21_preprocess_icesheet(
     return output
 
 
-def ReadScenarioFile(scenario, baseyear, paths_dict):
-    # Dictionary for mapping scenario names
-    scen_dict = {
-        "rcp85": "rcp85",
-        "rcp45": "rcp45",
-        "rcp26": "rcp26",
-        "ssp585": "rcp85",
-        "ssp245": "rcp45",
-        "ssp126": "rcp26",
-    }
-    mapped_scenario = scen_dict[scenario]
+def MapScenario(scenario):
+    # Map scenario names to those of the DP21 input files
+    return SCENARIO_MAP[scenario]
+
+
+def MapScenarioPaths(scenario, paths_dict):
+    mapped_scenario = MapScenario(scenario)
 
     eais_filepath = paths_dict[mapped_scenario]["eais"]
     wais_filepath = paths_dict[mapped_scenario]["wais"]
 
-    # Get the years
-    years = LoadNetCDF(eais_filepath, "years")
+    return eais_filepath, wais_filepath
 
-    # Get the actual data
-    eais_samps = LoadNetCDF(eais_filepath, "samps")
-    wais_samps = LoadNetCDF(wais_filepath, "samps")
 
-    # Get the values for the baseyear of interest
-    eais_refs = np.apply_along_axis(
-        FindRefVals, axis=0, arr=eais_samps, years=years, baseyear=baseyear
-    )
-    wais_refs = np.apply_along_axis(
-        FindRefVals, axis=0, arr=wais_samps, years=years, baseyear=baseyear
-    )
+def ReadScenarioFile(scenario, baseyear, paths_dict, dtype=None):
+    eais_filepath, wais_filepath = MapScenarioPaths(scenario, paths_dict)
+
+    with MeasureStage("read ensembles"):
+        # Get the years
+        years = LoadNetCDF(eais_filepath, "years")
+
+        # Get the actual data, converted to dtype if given
+        eais_samps = LoadNetCDF(eais_filepath, "samps")
+        wais_samps = LoadNetCDF(wais_filepath, "samps")
+        if dtype is not None:
+            eais_samps = eais_samps.astype(dtype, copy=False)
+            wais_samps = wais_samps.astype(dtype, copy=False)
+
+    with MeasureStage("re-center"):
+        # Get the values for the baseyear of interest
+        eais_refs = FindRefValsVectorized(eais_samps, years, baseyear)
+        wais_refs = FindRefValsVectorized(wais_samps, years, baseyear)
 
-    # Center the samples to the base year
-    eais_samps -= eais_refs
-    wais_samps -= wais_refs
+        # Center the samples to the base year
+        eais_samps -= eais_refs
+        wais_samps -= wais_refs
+
+    return years, eais_samps, wais_samps
+
+
+def ReadScenarioFiles(scenarios, baseyear, paths_dict, dtype=None):
+    """
+    Read and re-center several scenarios into (years, members, scenarios) cubes.
+
+    The year axis and pool size are read once from the first EAIS file, both
+    cubes are preallocated, and each scenario is written into its slice and
+    re-centered in place, so peak memory is the two cubes plus a single
+    scenario's worth of file data. The cubes have the type of the files, or
+    dtype if given.
+    """
+    eais_filepath, _ = MapScenarioPaths(scenarios[0], paths_dict)
+    years, pool_size, file_dtype = ReadEnsembleShape(eais_filepath)
+    dtype = file_dtype if dtype is None else dtype
+    cube_shape = (years.size, pool_size, len(scenarios))
+
+    eais_samps = np.empty(cube_shape, dtype=dtype)
+    wais_samps = np.empty(cube_shape, dtype=dtype)
+
+    for ii, scenario in enumerate(scenarios):
+        eais_filepath, wais_filepath = MapScenarioPaths(scenario, paths_dict)
+        for filepath, samps in (
+            (eais_filepath, eais_samps),
+            (wais_filepath, wais_samps),
+        ):
+            with MeasureStage("read ensembles"):
+                these_years = LoadNetCDF(filepath, "years")
+                if not np.array_equal(these_years, years):
+                    raise ValueError(
+                        "Years in {} do not match those in the other scenario files".format(
+                            filepath
+                        )
+                    )
+
+                # Fill this scenario's slice, then center it to the base year in place
+                samps[:, :, ii] = np.ma.getdata(LoadNetCDF(filepath, "samps"))
+
+            with MeasureStage("re-center"):
+                samps[:, :, ii] -= FindRefValsVectorized(
+                    samps[:, :, ii], years, baseyear
+                )
+
+    return years, eais_samps, wais_samps
+
+
+def ReadCachedScenarioFiles(
+    scenarios, baseyear, paths_dict, cache_dir, cache_max_mb, dtype=None
+):
+    # Key the cache on the contents of every input file, the base year and
+    # the type the ensembles are converted to
+    filepaths = [f for s in scenarios for f in MapScenarioPaths(s, paths_dict)]
+    key = EnsembleCacheKey(filepaths, baseyear, dtype)
+
+    with MeasureStage("read ensemble cache"):
+        cached = LoadCachedEnsemble(cache_dir, key)
+    if cached is not None:
+        logger.info("Using cached preprocessed ensemble {}".format(key))
+        return cached["years"], cached["eais_samps"], cached["wais_samps"]
+
+    logger.info("Preprocessed ensemble not cached, reading input files")
+    if len(scenarios) > 1:
+        years, eais_samps, wais_samps = ReadScenarioFiles(
+            scenarios, baseyear, paths_dict, dtype
+        )
+    else:
+        years, eais_samps, wais_samps = ReadScenarioFile(
+            scenarios[0], baseyear, paths_dict, dtype
+        )
+
+    with MeasureStage("write ensemble cache"):
+        StoreCachedEnsemble(
+            cache_dir,
+            key,
+            {"years": years, "eais_samps": eais_samps, "wais_samps": wais_samps},
+            max_bytes=cache_max_mb * 1024**2,
+        )
 
     return years, eais_samps, wais_samps
 
@@ -97,6 +277,202 @@ def FindRefVals(timeseries, years, baseyear):
     return ref_val
 
 
+def FindRefWeights(years, baseyear):
+    """
+    Locate the rows of a (years, members) ensemble needed to interpolate every
+    member to the base year, reproducing np.interp(baseyear, years, ts, left=0.0).
+
+    Returns
+    -------
+    rows : tuple of int
+            Row indices into the year axis. Empty if the base year precedes the
+            data (reference value is 0.0), a single row for an exact hit or a base
+            year past the last data year, and two bracketing rows otherwise.
+    span : tuple of float or None
+            (baseyear - years[lo], years[hi] - years[lo]) for the two-row case.
+    """
+    years = np.asarray(np.ma.getdata(years), dtype=np.float64)
+    x = np.float64(baseyear)
+
+    if x < years[0]:
+        return (), None
+
+    lo = int(np.searchsorted(years, x, side="right")) - 1
+    if lo >= years.size - 1 or years[lo] == x:
+        return (min(lo, years.size - 1),), None
+
+    return (lo, lo + 1), (x - years[lo], years[lo + 1] - years[lo])
+
+
+def ApplyRefWeights(ref_rows, span, nmembers):
+    """
+    Compute the base-year reference value of every ensemble member from the
+    rows selected by FindRefWeights, with the same arithmetic as np.interp.
+    """
+    if len(ref_rows) == 0:
+        return np.zeros(nmembers)
+
+    y0 = np.asarray(np.ma.getdata(ref_rows[0]), dtype=np.float64)
+    if len(ref_rows) == 1:
+        return y0
+
+    y1 = np.asarray(np.ma.getdata(ref_rows[1]), dtype=np.float64)
+    offset, width = span
+    with np.errstate(invalid="ignore"):
+        slope = (y1 - y0) / width
+        ref_vals = slope * offset + y0
+
+        # np.interp retries from the upper point when the result is not a number
+        nan_idx = np.isnan(ref_vals)
+        if nan_idx.any():
+            alt = slope * (offset - width) + y1
+            alt = np.where(np.isnan(alt) & (y0 == y1), y0, alt)
+            ref_vals = np.where(nan_idx, alt, ref_vals)
+
+    return ref_vals
+
+
+def FindRefValsVectorized(samps, years, baseyear):
+    # Interpolation weights only depend on the years, so find them once
+    rows, span = FindRefWeights(years, baseyear)
+
+    # Apply them to all ensemble members at once
+    return ApplyRefWeights([samps[i] for i in rows], span, samps.shape[1])
+
+
+def ReadEnsembleShape(filename):
+    # Read the year axis and the shape of the ensemble without loading it
+    nc = Dataset(filename, "r")
+    years = nc.variables["years"][...]
+    samps = nc.variables["samps"]
+    pool_size = samps.shape[1]
+    dtype = samps.dtype
+    nc.close()
+
+    return years, pool_size, dtype
+
+
+def CoalesceIndices(idx, max_gap):
+    """
+    Group sorted, unique indices into contiguous read ranges.
+
+    Neighbouring indices are merged into the same range when they are at most
+    max_gap apart, trading a few unused values for fewer hyperslab reads.
+
+    Returns
+    -------
+    list of tuple
+            (start, stop, first, last) where idx[first:last] lie in [start, stop).
+    """
+    if idx.size == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(idx) > max_gap + 1) + 1
+    firsts = np.concatenate(([0], breaks))
+    lasts = np.concatenate((breaks, [idx.size]))
+
+    return [
+        (int(idx[first]), int(idx[last - 1]) + 1, int(first), int(last))
+        for first, last in zip(firsts, lasts)
+    ]
+
+
+class LazyEnsemble:
+    """
+    File-backed stand-in for a re-centered (years, members[, scenarios]) ensemble.
+
+    Indexing with integer arrays reads only the requested years and members,
+    sorted and deduplicated into coalesced hyperslabs, together with the rows
+    needed to re-center them to the base year. The result matches indexing the
+    fully loaded and re-centered array.
+
+    Parameters
+    ----------
+    filepaths : str or sequence of str
+            DP21 ensemble file, or one file per scenario for a 3-D ensemble.
+    baseyear : int
+            Year the samples are centered on.
+    max_gap : int
+            Largest run of unrequested indices read through to merge two ranges.
+    dtype : numpy.dtype, optional
+            Type of the samples returned; the type of the files if not given.
+    """
+
+    def __init__(self, filepaths, baseyear, max_gap=16, dtype=None):
+        self.squeeze = isinstance(filepaths, str)
+        self.filepaths = [filepaths] if self.squeeze else list(filepaths)
+        self.baseyear = baseyear
+        self.max_gap = max_gap
+
+        years, pool_size, file_dtype = ReadEnsembleShape(self.filepaths[0])
+        self.years = years
+        self.dtype = file_dtype if dtype is None else np.dtype(dtype)
+        self.ref_rows, self.ref_span = FindRefWeights(years, baseyear)
+
+        self.shape = (years.size, pool_size)
+        if not self.squeeze:
+            self.shape += (len(self.filepaths),)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (len(self.shape) - len(key))
+
+        year_idx = np.asarray(key[0])
+        member_idx = np.asarray(key[1])
+
+        # Read each year and member only once, in file order
+        years_needed, year_inv = np.unique(year_idx, return_inverse=True)
+        members, member_inv = np.unique(member_idx, return_inverse=True)
+        rows = np.union1d(years_needed, self.ref_rows).astype(int)
+        year_pos = np.searchsorted(rows, years_needed)[year_inv].reshape(year_idx.shape)
+        member_inv = member_inv.reshape(member_idx.shape)
+        ref_pos = np.searchsorted(rows, self.ref_rows)
+
+        if self.squeeze:
+            block = self._read_recentered(self.filepaths[0], rows, members, ref_pos)
+            return block[year_pos, member_inv]
+
+        if isinstance(key[2], slice):
+            scenarios = np.arange(len(self.filepaths))[key[2]]
+            scen_pos = slice(None)
+        else:
+            scen_idx = np.asarray(key[2])
+            scenarios, scen_pos = np.unique(scen_idx, return_inverse=True)
+            scen_pos = scen_pos.reshape(scen_idx.shape)
+
+        block = np.empty((rows.size, members.size, scenarios.size), dtype=self.dtype)
+        for ii, scen in enumerate(scenarios):
+            block[:, :, ii] = self._read_recentered(
+                self.filepaths[scen], rows, members, ref_pos
+            )
+
+        return block[year_pos, member_inv, scen_pos]
+
+    def _read_recentered(self, filepath, rows, members, ref_pos):
+        block = np.empty((rows.size, members.size), dtype=self.dtype)
+
+        # Batched samples are gathered from dask threads, which share the
+        # non-thread-safe netCDF/HDF5 library with the output writers
+        with HDF5_LOCK:
+            nc = Dataset(filepath, "r")
+            var = nc.variables["samps"]
+            for r0, r1, rfirst, rlast in CoalesceIndices(rows, self.max_gap):
+                for m0, m1, mfirst, mlast in CoalesceIndices(members, self.max_gap):
+                    slab = np.ma.getdata(var[r0:r1, m0:m1])
+                    block[rfirst:rlast, mfirst:mlast] = slab[
+                        np.ix_(rows[rfirst:rlast] - r0, members[mfirst:mlast] - m0)
+                    ]
+            nc.close()
+
+        # Center the samples to the base year using the rows read alongside them
+        block -= ApplyRefWeights(
+            [block[i] for i in ref_pos], self.ref_span, members.size
+        )
+
+        return block
+
+
 def LoadNetCDF(filename, variable):
     # Open the file
     nc = Dataset(filename, "r")
@@ -5,6 +5,13 @@ import xarray as xr
 import os
 import h5py
 import time
+from functools import partial
+
+import dask.array as da
+from netCDF4 import Dataset
+
+from deconto21_ais.localized_writer import BlockWriter, StoreWriters
+from deconto21_ais.metrics import MeasureStage
 
 """ dp21_project_icesheet.py
 
@@ -15,10 +22,21 @@ nsamps              Number of samples to produce
 replace             Allow sampling with replacement
 rngseed             Seed for the random number generator
 pipeline_id         Unique identifier to attach to this pipeline
+sample_batch        Gather and write the samples lazily in batches of this size
+defer_writes        With sample_batch, set up the gslr files but leave writing them
+                    to the caller, returned under 'gslr_writes'
 
 Note: 'pipeline_id' is a unique identifier that distinguishes it among other instances
 of this module within the same workflow.
 
+With sample_batch, the sample indices are still drawn in full from the seeded
+generator, so the results match a run without it, but the samples are returned
+as dask arrays with one block per batch. The global outputs and the localized
+projections downstream are then computed and written batch by batch, keeping
+memory bounded however large nsamps is. With defer_writes, the postprocessing
+stage writes the global outputs in its localisation pass, so each batch is
+gathered once for both.
+
 """
 
 
@@ -56,7 +74,10 @@ def make_projection_ds(
     - Latitude and longitude are set to NaN (np.inf) for global projections.
     """
 
-    data = np.asarray(global_samps, dtype=np.float32)[:, :, np.newaxis]
+    if isinstance(global_samps, da.Array):
+        data = global_samps.astype(np.float32)[:, :, np.newaxis]
+    else:
+        data = np.asarray(global_samps, dtype=np.float32)[:, :, np.newaxis]
 
     ds = xr.Dataset(
         data_vars={
@@ -89,6 +110,104 @@ def make_projection_ds(
     return ds
 
 
+def write_projection_ds(ds, filename, output_format="netcdf", compute=True):
+    """
+    Write a projection Dataset as a NetCDF file or a Zarr store.
+
+    Parameters
+    ----------
+    ds : xarray.Dataset
+            Dataset to write.
+    filename : str
+            Output path.
+    output_format : str
+            'netcdf' or 'zarr'.
+    compute : bool
+            If False, only set up the file, with sea_level_change left empty,
+            and return its dask-backed data and a BlockWriter to write it with,
+            e.g. in one StoreWriters pass with other outputs of the same
+            samples.
+    """
+    label = os.path.basename(filename.rstrip("/"))
+    if compute:
+        with MeasureStage("write {}".format(label)):
+            if output_format == "zarr":
+                return ds.to_zarr(filename, mode="w")
+
+            return ds.to_netcdf(filename)
+
+    source = ds["sea_level_change"].data
+    if output_format == "zarr":
+        import zarr
+
+        # Only the metadata and coordinates are written here
+        ds.to_zarr(filename, mode="w", compute=False)
+        var = zarr.open_array(filename, path="sea_level_change", mode="r+")
+        # Zarr arrays are written from plain arrays, as by xarray
+        return (da.ma.getdata(source), BlockWriter(var, label, source.npartitions))
+
+    ds.drop_vars("sea_level_change").to_netcdf(filename)
+    nc = Dataset(filename, "a")
+    var = nc.createVariable(
+        "sea_level_change",
+        "f4",
+        ds["sea_level_change"].dims,
+        fill_value=np.float32(np.nan),
+    )
+    var.setncatts(ds["sea_level_change"].attrs)
+
+    return (source, BlockWriter(var, label, source.npartitions, nc))
+
+
+def GatherSamples(ensemble, datayr_idx, sample_idx, useScenario=None):
+    """
+    Gather the sampled members of an ensemble at the data years.
+
+    Parameters
+    ----------
+    ensemble : array-like
+            Ensemble shaped (years, members), or (years, members, scenarios)
+            when useScenario is given.
+    datayr_idx : numpy.ndarray
+            Data year rows to gather.
+    sample_idx : numpy.ndarray
+            Ensemble member of each sample.
+    useScenario : numpy.ndarray, optional
+            Scenario of each sample.
+
+    Returns
+    -------
+    numpy.ndarray
+            Samples shaped (samples, years).
+    """
+    if useScenario is None:
+        return ensemble[datayr_idx[:, np.newaxis], sample_idx[np.newaxis, :]].T
+
+    # Read one (year, member, scenario) element per sample and year
+    return ensemble[
+        datayr_idx[:, np.newaxis], sample_idx[np.newaxis, :], useScenario[np.newaxis, :]
+    ].T
+
+
+def LazySamples(ensemble, datayr_idx, sample_idx, sample_batch, useScenario=None):
+    """
+    GatherSamples as a dask array, with one block per batch of samples.
+    """
+    gather = partial(GatherSamples, ensemble, datayr_idx)
+    sample_idx = da.from_array(sample_idx, chunks=sample_batch)
+    args = [sample_idx]
+    if useScenario is not None:
+        args.append(da.from_array(useScenario, chunks=sample_batch))
+
+    return da.map_blocks(
+        gather,
+        *args,
+        new_axis=1,
+        chunks=(sample_idx.chunks[0], (datayr_idx.size,)),
+        dtype=ensemble.dtype,
+    )
+
+
 def dp21_project_icesheet(
     nsamps,
     pyear_start,
@@ -101,6 +220,9 @@ def dp21_project_icesheet(
     output_ais_gslr_file,
     output_eais_gslr_file,
     output_wais_gslr_file,
+    output_format="netcdf",
+    sample_batch=None,
+    defer_writes=False,
 ):
     years = preprocess_dict["years"]
     wais = preprocess_dict["wais_samps"]
@@ -123,14 +245,15 @@ def dp21_project_icesheet(
     rng = np.random.default_rng(rngseed)
     sample_idx = rng.choice(pool_size, size=nsamps, replace=replace)
 
-    # Store the samples
-    wais_samps = wais[datayr_idx[:, np.newaxis], sample_idx[np.newaxis, :]]
-    eais_samps = eais[datayr_idx[:, np.newaxis], sample_idx[np.newaxis, :]]
-
-    # Transpose the samples to fit the output data structure
-    wais_samps = wais_samps.T
-    eais_samps = eais_samps.T
-    ais_samps = wais_samps + eais_samps
+    # Store the samples, transposed to fit the output data structure
+    with MeasureStage("sample"):
+        if sample_batch is None:
+            wais_samps = GatherSamples(wais, datayr_idx, sample_idx)
+            eais_samps = GatherSamples(eais, datayr_idx, sample_idx)
+        else:
+            wais_samps = LazySamples(wais, datayr_idx, sample_idx, sample_batch)
+            eais_samps = LazySamples(eais, datayr_idx, sample_idx, sample_batch)
+        ais_samps = wais_samps + eais_samps
 
     output = {
         "eais_samps": eais_samps,
@@ -145,6 +268,12 @@ def dp21_project_icesheet(
     samples = np.arange(nsamps, dtype=np.int64)
     locations = np.array([-1], dtype=np.int64)  # single “location”, value -1
 
+    # Batched samples are written in one pass once all files are set up, so
+    # each batch is gathered once for the three outputs; with defer_writes,
+    # the pass is left to the caller to share with the localisation
+    compute = sample_batch is None
+    writes = []
+
     if output_eais_gslr_file is not None:
         ds_eais = make_projection_ds(
             ice_source="EAIS",
@@ -155,7 +284,9 @@ def dp21_project_icesheet(
             scenario=scenario,
             baseyear=baseyear,
         )
-        ds_eais.to_netcdf(output_eais_gslr_file)
+        writes.append(
+            write_projection_ds(ds_eais, output_eais_gslr_file, output_format, compute)
+        )
 
     if output_wais_gslr_file is not None:
         ds_wais = make_projection_ds(
@@ -167,7 +298,9 @@ def dp21_project_icesheet(
             scenario=scenario,
             baseyear=baseyear,
         )
-        ds_wais.to_netcdf(output_wais_gslr_file)
+        writes.append(
+            write_projection_ds(ds_wais, output_wais_gslr_file, output_format, compute)
+        )
     if output_ais_gslr_file is not None:
         ds_ais = make_projection_ds(
             ice_source="AIS",
@@ -178,7 +311,17 @@ def dp21_project_icesheet(
             scenario=scenario,
             baseyear=baseyear,
         )
-        ds_ais.to_netcdf(output_ais_gslr_file)
+        writes.append(
+            write_projection_ds(ds_ais, output_ais_gslr_file, output_format, compute)
+        )
+    if defer_writes and not compute:
+        output["gslr_writes"] = writes
+    elif not compute:
+        # Batches are gathered as they are written
+        with MeasureStage("sample and write gslr"):
+            StoreWriters(
+                [source for source, _ in writes], [writer for _, writer in writes]
+            )
 
     return output
 
@@ -195,6 +338,9 @@ def dp21_project_icesheet_temperaturedriven(
     output_ais_gslr_file,
     output_eais_gslr_file,
     output_wais_gslr_file,
+    output_format="netcdf",
+    sample_batch=None,
+    defer_writes=False,
 ):
     # Load the data file
     years = preprocess_dict["years"]
@@ -206,7 +352,8 @@ def dp21_project_icesheet_temperaturedriven(
     rng = np.random.default_rng(rngseed)
 
     # identify which samples to draw from which scenario
-    useScenario = pickScenario(climate_data_file, scenario, rng)
+    with MeasureStage("pick scenarios"):
+        useScenario = pickScenario(climate_data_file, scenario, rng)
     nsamps = useScenario.size
 
     # Define the target projection years
@@ -223,22 +370,20 @@ def dp21_project_icesheet_temperaturedriven(
     # Generate the sample indices
     sample_idx = rng.choice(pool_size, size=nsamps, replace=replace)
 
-    # Store the samples
-    wais_samps0 = wais[datayr_idx[:, np.newaxis], sample_idx[np.newaxis, :], :]
-    eais_samps0 = eais[datayr_idx[:, np.newaxis], sample_idx[np.newaxis, :], :]
-
-    # Store the samples for AIS components
-    eais_samps = eais_samps0[:, :, 0]
-    wais_samps = wais_samps0[:, :, 0]
-
-    for ii in range(1, 3):
-        eais_samps[:, useScenario == ii] = eais_samps0[:, useScenario == ii, ii]
-        wais_samps[:, useScenario == ii] = wais_samps0[:, useScenario == ii, ii]
-
-    # Transpose the samples to fit the output data structure
-    wais_samps = wais_samps.T
-    eais_samps = eais_samps.T
-    ais_samps = wais_samps + eais_samps
+    # Store the samples for AIS components, each drawn from its scenario and
+    # transposed to fit the output data structure
+    with MeasureStage("sample"):
+        if sample_batch is None:
+            wais_samps = GatherSamples(wais, datayr_idx, sample_idx, useScenario)
+            eais_samps = GatherSamples(eais, datayr_idx, sample_idx, useScenario)
+        else:
+            wais_samps = LazySamples(
+                wais, datayr_idx, sample_idx, sample_batch, useScenario
+            )
+            eais_samps = LazySamples(
+                eais, datayr_idx, sample_idx, sample_batch, useScenario
+            )
+        ais_samps = wais_samps + eais_samps
 
     output = {
         "eais_samps": eais_samps,
@@ -253,6 +398,12 @@ def dp21_project_icesheet_temperaturedriven(
     samples = np.arange(nsamps, dtype=np.int64)
     locations = np.array([-1], dtype=np.int64)  # single “location”, value -1
 
+    # Batched samples are written in one pass once all files are set up, so
+    # each batch is gathered once for the three outputs; with defer_writes,
+    # the pass is left to the caller to share with the localisation
+    compute = sample_batch is None
+    writes = []
+
     if output_eais_gslr_file is not None:
         ds_eais = make_projection_ds(
             ice_source="EAIS",
@@ -263,7 +414,9 @@ def dp21_project_icesheet_temperaturedriven(
             scenario=scenario,
             baseyear=baseyear,
         )
-        ds_eais.to_netcdf(output_eais_gslr_file)
+        writes.append(
+            write_projection_ds(ds_eais, output_eais_gslr_file, output_format, compute)
+        )
 
     if output_wais_gslr_file is not None:
         ds_wais = make_projection_ds(
@@ -275,7 +428,9 @@ def dp21_project_icesheet_temperaturedriven(
             scenario=scenario,
             baseyear=baseyear,
         )
-        ds_wais.to_netcdf(output_wais_gslr_file)
+        writes.append(
+            write_projection_ds(ds_wais, output_wais_gslr_file, output_format, compute)
+        )
     if output_ais_gslr_file is not None:
         ds_ais = make_projection_ds(
             ice_source="AIS",
@@ -286,59 +441,99 @@ def dp21_project_icesheet_temperaturedriven(
             scenario=scenario,
             baseyear=baseyear,
         )
-        ds_ais.to_netcdf(output_ais_gslr_file)
+        writes.append(
+            write_projection_ds(ds_ais, output_ais_gslr_file, output_format, compute)
+        )
+    if defer_writes and not compute:
+        output["gslr_writes"] = writes
+    elif not compute:
+        # Batches are gathered as they are written
+        with MeasureStage("sample and write gslr"):
+            StoreWriters(
+                [source for source, _ in writes], [writer for _, writer in writes]
+            )
 
     return output
 
 
-def GetSATData(
+def IntegratedSAT(
     fname,
     scenario,
     refyear_start=1850,
     refyear_end=1900,
-    year_start=1900,
-    year_end=2300,
+    intyear_start=2000,
+    intyear_end=2100,
+    max_chunk_mb=64,
 ):
-    # Open the file
-    df_ssp = h5py.File(fname, "r")
-    # Extract the surface temperature for this scenario
-    if scenario not in df_ssp.keys():
-        raise ValueError("Scenario {} not found in {}".format(scenario, fname))
-    ssp_folder = df_ssp.get(scenario)
-    sat_ssp = ssp_folder.get("surface_temperature")
-    # Get the number of ensemble members from the data
-    _, nens = sat_ssp.shape
+    """
+    Integrate each member's surface temperature over a window of years.
 
-    # Extract the years available
-    sat_years = df_ssp["year"][()]
+    Reads only the reference and integration windows of the temperature
+    record, in hyperslabs of whole on-disk chunks of members, and reduces each
+    before reading the next, so memory does not grow with the ensemble size.
+    Matches summing the temperatures read in full over the same window.
 
-    # Which indices align with the reference and trim years
-    refyear_start_idx = np.flatnonzero(sat_years == refyear_start)[0]
-    refyear_end_idx = np.flatnonzero(sat_years == refyear_end)[0]  # + 1
-    year_start_idx = np.flatnonzero(sat_years == year_start)[0]
-    year_end_idx = np.flatnonzero(sat_years == year_end)[0] + 1
+    Parameters
+    ----------
+    fname : str
+            NetCDF4/HDF5 file with "<scenario>/surface_temperature" shaped
+            (years, members) and a "year" vector.
+    scenario : str
+            Scenario group to read.
+    refyear_start, refyear_end : int
+            Reference period [start, end) the temperatures are relative to.
+    intyear_start, intyear_end : int
+            Integration period [start, end).
+    max_chunk_mb : float
+            Memory budget for the rows of one hyperslab of members, in MB.
 
-    # Normalize and crop temperature series
-    Time = np.arange(year_start, year_end + 1)
-    SATave = np.mean(sat_ssp[refyear_start_idx:refyear_end_idx, :], axis=0)
-    SAT = sat_ssp[year_start_idx:year_end_idx, :] - SATave
+    Returns
+    -------
+    numpy.ndarray
+            Integrated temperature for each member [C*yr].
+    """
+    with h5py.File(fname, "r", rdcc_nbytes=int(2 * max_chunk_mb * 1024**2)) as df_ssp:
+        if scenario not in df_ssp.keys():
+            raise ValueError("Scenario {} not found in {}".format(scenario, fname))
+        sat_ssp = df_ssp[scenario]["surface_temperature"]
+        sat_years = df_ssp["year"][()]
+        nens = sat_ssp.shape[1]
+
+        # Rows of the reference and integration windows
+        ref_rows = np.flatnonzero(
+            (sat_years >= refyear_start) & (sat_years < refyear_end)
+        )
+        int_rows = np.flatnonzero(
+            (sat_years >= intyear_start) & (sat_years < intyear_end)
+        )
+        ref = slice(ref_rows[0], ref_rows[-1] + 1)
+        window = slice(int_rows[0], int_rows[-1] + 1)
 
-    # Close the h5 file
-    df_ssp.close()
+        # Members per hyperslab, a whole number of on-disk chunks if chunked
+        row_bytes = (ref_rows.size + int_rows.size) * sat_ssp.dtype.itemsize
+        step = max(2, int(max_chunk_mb * 1024**2) // row_bytes)
+        if sat_ssp.chunks is not None:
+            align = sat_ssp.chunks[1]
+            step = max(align, step // align * align)
 
-    # Done
-    return (SAT, Time, nens)
+        # numpy sums a single column pairwise instead of row by row, so keep
+        # every hyperslab at least two members wide to match a full read
+        edges = list(range(0, nens, step)) + [nens]
+        if len(edges) > 2 and edges[-1] - edges[-2] == 1:
+            del edges[-2]
 
+        iSAT = np.empty(nens)
+        for m0, m1 in zip(edges[:-1], edges[1:]):
+            members = slice(m0, m1)
+            SATave = np.mean(sat_ssp[ref, members], axis=0)
+            iSAT[members] = (sat_ssp[window, members] - SATave).sum(axis=0)
 
-def pickScenario(climate_data_file, scenario, rng):
-    # Load the temperature data
+    return iSAT
 
-    SAT, Time, _ = GetSATData(climate_data_file, scenario)
 
+def pickScenario(climate_data_file, scenario, rng):
     # find integrated SAT over 2000-2099
-    x2 = np.where((Time[:] < 2100) * (Time[:] >= 2000))
-    SAT2 = SAT[x2]
-    iSAT = SAT2.sum(axis=0)
+    iSAT = IntegratedSAT(climate_data_file, scenario)
     selector = rng.random(iSAT.size)
 
     # convert integrated temperature into a normalized variable between low and high scenarios
@@ -0,0 +1,125 @@
+import hashlib
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+""" ensemble_cache.py
+
+On-disk cache for the output of the dp21 icesheet preprocessing stage.
+
+Each entry is a directory of .npy files (years, eais_samps, wais_samps) that can
+be memory-mapped on load. Entries are keyed on the content hashes of the DP21
+input files and the base year, and the cache is kept under a size cap by
+evicting the least recently used entries.
+
+"""
+
+CACHE_ARRAYS = ("years", "eais_samps", "wais_samps")
+
+# Bump when the layout or content of cache entries changes
+CACHE_VERSION = 1
+
+
+def HashFile(filename, blocksize=1 << 20):
+    # Hash the file contents in blocks to keep memory flat
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def EnsembleCacheKey(filepaths, baseyear, dtype=None):
+    """
+    Build the cache key for a preprocessed ensemble.
+
+    Parameters
+    ----------
+    filepaths : sequence of str
+            DP21 input files in the order they were stacked (EAIS then WAIS for
+            each scenario).
+    baseyear : int
+            Year the samples are centered on.
+    dtype : numpy.dtype, optional
+            Type the ensembles were converted to, if not kept as read.
+
+    Returns
+    -------
+    str
+            Hex digest identifying the entry.
+    """
+    digest = hashlib.sha256()
+    digest.update("v{}:baseyear={}".format(CACHE_VERSION, baseyear).encode())
+    if dtype is not None:
+        digest.update(":dtype={}".format(np.dtype(dtype).name).encode())
+    for filepath in filepaths:
+        digest.update(HashFile(filepath).encode())
+
+    return digest.hexdigest()
+
+
+def LoadCachedEnsemble(cache_dir, key):
+    # Return the memory-mapped arrays for this entry, or None on a miss
+    entry_dir = os.path.join(cache_dir, key)
+    try:
+        arrays = {
+            name: np.load(os.path.join(entry_dir, name + ".npy"), mmap_mode="r")
+            for name in CACHE_ARRAYS
+        }
+    except (FileNotFoundError, ValueError):
+        return None
+
+    # Mark the entry as recently used
+    os.utime(entry_dir)
+
+    return arrays
+
+
+def StoreCachedEnsemble(cache_dir, key, arrays, max_bytes):
+    """
+    Write an entry to the cache and evict old entries to stay under max_bytes.
+
+    The entry is written to a temporary directory and renamed into place, so
+    concurrent runs never see a partially written entry.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = os.path.join(cache_dir, key)
+    tmp_dir = os.path.join(cache_dir, ".tmp-{}".format(uuid.uuid4().hex))
+
+    os.makedirs(tmp_dir)
+    for name in CACHE_ARRAYS:
+        np.save(os.path.join(tmp_dir, name + ".npy"), np.ma.getdata(arrays[name]))
+
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another run stored this entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    EvictCacheEntries(cache_dir, max_bytes, keep=key)
+
+
+def EvictCacheEntries(cache_dir, max_bytes, keep=None):
+    # Gather the entries with their last-use time and size
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry_dir = os.path.join(cache_dir, name)
+        if name.startswith(".") or not os.path.isdir(entry_dir):
+            continue
+        size = sum(
+            os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir)
+        )
+        entries.append((os.path.getmtime(entry_dir), size, name))
+
+    # Drop the least recently used entries until the cache fits
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= max_bytes:
+            break
+        if name == keep:
+            continue
+        shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+        total -= size
@@ -0,0 +1,153 @@
+import json
+import os
+
+import numpy as np
+
+""" ensemble_store.py
+
+Memory-mapped store for re-centered dp21 icesheet ensembles.
+
+A store is a directory holding one contiguous little-endian float32 array per
+ice sheet ("eais.f32", "wais.f32") with axes ordered (scenario, year, member),
+and a small JSON header ("header.json") describing the shape, years, scenarios,
+base year and input files. Opening a store maps the arrays read-only, so the
+projection stage can fancy-index them without loading the ensemble into RAM
+and every process on a node shares one page-cache copy. A store is only
+opened while its input files keep the path, size and modification time
+recorded in the header, so it is never reused for changed inputs.
+
+"""
+
+STORE_VERSION = 2
+STORE_DTYPE = "<f4"
+STORE_HEADER = "header.json"
+STORE_ICESHEETS = ("eais", "wais")
+
+
+def EnsembleStoreExists(store_dir):
+    return os.path.isfile(os.path.join(store_dir, STORE_HEADER))
+
+
+def StoreInputs(filepaths):
+    # Identify the input files by absolute path, size and modification time
+    inputs = []
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        inputs.append(
+            {
+                "path": os.path.abspath(filepath),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+        )
+
+    return inputs
+
+
+def WriteEnsembleStore(
+    store_dir, years, eais_samps, wais_samps, scenarios, baseyear, filepaths
+):
+    """
+    Write re-centered ensembles to a memory-mapped store.
+
+    Parameters
+    ----------
+    store_dir : str
+            Directory to write the store to.
+    years : array-like
+            Data years of the ensembles.
+    eais_samps, wais_samps : array-like
+            Ensembles shaped (years, members) for a single scenario or
+            (years, members, scenarios).
+    scenarios : sequence of str
+            Scenario name for each slice of the scenario axis.
+    baseyear : int
+            Year the samples are centered on.
+    filepaths : sequence of str
+            DP21 input files the ensembles were read from.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    shape = (len(scenarios), len(years), eais_samps.shape[1])
+
+    for icesheet, samps in zip(STORE_ICESHEETS, (eais_samps, wais_samps)):
+        samps = np.ma.getdata(samps)
+        if samps.ndim == 2:
+            samps = samps[:, :, np.newaxis]
+
+        # Fill one scenario at a time, then move the array into place
+        tmp_path = os.path.join(store_dir, icesheet + ".f32.tmp")
+        mm = np.memmap(tmp_path, dtype=STORE_DTYPE, mode="w+", shape=shape)
+        for ii in range(shape[0]):
+            mm[ii] = samps[:, :, ii]
+        mm.flush()
+        del mm
+        os.replace(tmp_path, os.path.join(store_dir, icesheet + ".f32"))
+
+    # The header is written last, so a store without one is incomplete
+    header = {
+        "version": STORE_VERSION,
+        "dtype": STORE_DTYPE,
+        "shape": list(shape),
+        "axes": ["scenario", "year", "member"],
+        "years": [int(y) for y in np.ma.getdata(years)],
+        "scenarios": list(scenarios),
+        "baseyear": int(baseyear),
+        "inputs": StoreInputs(filepaths),
+    }
+    tmp_path = os.path.join(store_dir, STORE_HEADER + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp_path, os.path.join(store_dir, STORE_HEADER))
+
+
+def OpenEnsembleStore(store_dir, scenarios, baseyear, filepaths):
+    """
+    Map a store's ensembles read-only.
+
+    Returns the years and the EAIS/WAIS ensembles as views in the layout the
+    projection stage indexes: (years, members) for a single scenario, otherwise
+    (years, members, scenarios).
+
+    Raises
+    ------
+    ValueError
+            If the store was written by another version, for other scenarios
+            or base year, or from input files other than filepaths or since
+            changed.
+    """
+    with open(os.path.join(store_dir, STORE_HEADER), "r") as f:
+        header = json.load(f)
+
+    if header["version"] != STORE_VERSION:
+        raise ValueError(
+            "Unsupported ensemble store version {} in {}".format(
+                header["version"], store_dir
+            )
+        )
+    if header["scenarios"] != list(scenarios) or header["baseyear"] != baseyear:
+        raise ValueError(
+            "Ensemble store {} holds scenarios {} for base year {}, not {} for base year {}".format(
+                store_dir, header["scenarios"], header["baseyear"], scenarios, baseyear
+            )
+        )
+    if header["inputs"] != StoreInputs(filepaths):
+        raise ValueError(
+            "Ensemble store {} was written from input files that have since changed or moved; remove it to rewrite it".format(
+                store_dir
+            )
+        )
+
+    shape = tuple(header["shape"])
+    views = []
+    for icesheet in STORE_ICESHEETS:
+        mm = np.memmap(
+            os.path.join(store_dir, icesheet + ".f32"),
+            dtype=header["dtype"],
+            mode="r",
+            shape=shape,
+        )
+        views.append(mm[0] if shape[0] == 1 else mm.transpose(1, 2, 0))
+
+    years = np.array(header["years"])
+
+    return years, views[0], views[1]
@@ -0,0 +1,106 @@
+import os
+import uuid
+
+import numpy as np
+
+from deconto21_ais.AssignFP import AssignFPs
+from deconto21_ais.ensemble_cache import HashFile
+
+""" fingerprint_cache.py
+
+Caches fingerprint coefficients interpolated to sites, so they are reused across
+runs instead of re-interpolating the global fingerprint grid every time.
+
+There is one entry per fingerprint file, named after the hash of its contents,
+holding the site latitudes, longitudes and coefficients computed so far. Sites
+missing from the entry of any file are interpolated for every file in one
+AssignFPs call, sharing its stencil and grid windows, and appended to the
+entries.
+
+Entries only grow, by 24 bytes per site, and are never evicted; the cache
+holds one entry for each version of the fingerprint files it has seen, so
+remove the directory to reclaim the space of old ones.
+
+"""
+
+
+def SiteKeys(lats, lons):
+    # Complex numbers sort by real then imaginary part, giving a (lat, lon) key
+    return np.asarray(lats, dtype=np.float64) + 1j * np.asarray(lons, dtype=np.float64)
+
+
+def LoadFingerprintEntry(entry_file):
+    try:
+        with np.load(entry_file) as entry:
+            return entry["keys"], entry["fp"]
+    except (FileNotFoundError, ValueError, KeyError):
+        return np.empty(0, dtype=np.complex128), np.empty(0)
+
+
+def FindSites(keys, qkeys):
+    # Whether each site key is among the sorted keys of an entry
+    if keys.size == 0:
+        return np.zeros(qkeys.size, dtype=bool)
+    pos = np.minimum(np.searchsorted(keys, qkeys), keys.size - 1)
+
+    return keys[pos] == qkeys
+
+
+def CachedAssignFPs(fp_filenames, qlats, qlons, cache_dir):
+    """
+    AssignFPs with an on-disk cache of the coefficients at each site.
+
+    Parameters
+    ----------
+    fp_filenames : list of str
+            Fingerprint files passed to AssignFPs.
+    qlats, qlons : array-like
+            Latitudes and longitudes of the sites of interest.
+    cache_dir : str
+            Directory holding the cache entries.
+
+    Returns
+    -------
+    list of numpy.ndarray
+            Fingerprint coefficients for the sites, one array per file, as
+            returned by AssignFPs.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_files = [
+        os.path.join(cache_dir, "fp_{}.npz".format(HashFile(fp_filename)))
+        for fp_filename in fp_filenames
+    ]
+
+    # Entries are kept sorted by site key so lookups are a binary search
+    entries = [LoadFingerprintEntry(entry_file) for entry_file in entry_files]
+    qkeys = SiteKeys(qlats, qlons)
+    missing = ~np.logical_and.reduce([FindSites(keys, qkeys) for keys, _ in entries])
+
+    if missing.any():
+        # Interpolate only the sites not in every entry yet, for all files at
+        # once so they share the stencil
+        new_keys, new_idx = np.unique(qkeys[missing], return_index=True)
+        new_fps = AssignFPs(
+            fp_filenames,
+            np.asarray(qlats)[missing][new_idx],
+            np.asarray(qlons)[missing][new_idx],
+        )
+
+        for ii, (entry_file, new_fp) in enumerate(zip(entry_files, new_fps)):
+            (keys, fp) = entries[ii]
+            new = ~FindSites(keys, new_keys)
+            if not new.any():
+                continue
+
+            keys = np.concatenate((keys, new_keys[new]))
+            fp = np.concatenate((fp, new_fp[new]))
+            order = np.argsort(keys)
+            entries[ii] = (keys[order], fp[order])
+
+            # Replace the entry atomically so concurrent runs never read a
+            # partial one
+            tmp_file = os.path.join(cache_dir, ".tmp-{}.npz".format(uuid.uuid4().hex))
+            np.savez(tmp_file, keys=entries[ii][0], fp=entries[ii][1])
+            os.replace(tmp_file, entry_file)
+
+    return [fp[np.searchsorted(keys, qkeys)] for keys, fp in entries]
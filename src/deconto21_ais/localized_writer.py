@@ -0,0 +1,568 @@
+import logging
+import os
+import threading
+import time
+
+import dask
+import dask.array as da
+import numpy as np
+import xarray as xr
+from netCDF4 import Dataset
+from xarray.backends.locks import HDF5_LOCK
+
+from deconto21_ais.metrics import RecordSubstage
+from deconto21_ais.scheduler import SchedulerInProcess
+
+""" localized_writer.py
+
+Streams localized ice sheet projections into netCDF files or Zarr stores.
+
+The netCDF output files and their sea_level_change variables are created up
+front with explicit on-disk chunking, then dask writes each computed (samples,
+years, locations) block straight into its slot in the file. By default every
+on-disk chunk holds the samples x years block of a single location, which is
+what downstream per-site readers pull, split along samples into chunks of at
+most DISK_CHUNK_MB.
+
+Zarr stores are chunked like the dask blocks, so every block is written to its
+own chunk objects in parallel, without a global lock.
+
+Quantile summaries of the samples at each site and year are taken from the
+same blocks as they are written, so the full projections and their summaries
+come out of one pass. They are written to small files named after the full
+outputs with SummaryFilename.
+
+Runs over a partition of the sites write shard files, named after the final
+output with ShardFilename, which are then concatenated along locations.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+# Chunks are given as (samples, years, locations); 0 spans the whole axis
+DEFAULT_DISK_CHUNKS = (0, 0, 1)
+
+# 0 on the samples axis spans at most this many MB of float32 values, so each
+# compressed on-disk chunk stays small however many samples there are
+DISK_CHUNK_MB = 4
+
+
+def ShardFilename(filename, index, count):
+    # e.g. ais_lslr.nc -> ais_lslr.shard-03-of-16.nc for partition 3/16
+    (root, ext) = os.path.splitext(filename.rstrip("/"))
+    width = len(str(count))
+
+    return "{}.shard-{:0{w}d}-of-{:0{w}d}{}".format(root, index, count, ext, w=width)
+
+
+def SummaryFilename(filename):
+    # e.g. ais_lslr.nc -> ais_lslr.quantiles.nc
+    (root, ext) = os.path.splitext(filename.rstrip("/"))
+
+    return "{}.quantiles{}".format(root, ext)
+
+
+def ResolveDiskChunks(disk_chunks, shape, sample_batch=None):
+    # Replace 0 with the full axis length and clip to the variable shape; 0 on
+    # the samples axis spans at most DISK_CHUNK_MB of values, and at most one
+    # sample batch, so each on-disk chunk is finished within a batch
+    chunks = [max(1, n if c == 0 else min(c, n)) for c, n in zip(disk_chunks, shape)]
+    if disk_chunks[0] == 0:
+        max_samples = DISK_CHUNK_MB * 1024**2 // (4 * chunks[1] * chunks[2])
+        if sample_batch is not None:
+            max_samples = min(max_samples, sample_batch)
+        chunks[0] = max(1, min(chunks[0], max_samples))
+
+    return tuple(chunks)
+
+
+class BlockWriter:
+    """
+    dask.array.store target that writes blocks into a netCDF variable or Zarr
+    array and logs progress as each block lands. The time spent in the writes
+    and the bytes handed to them are tallied for the stage metrics.
+
+    A netCDF variable is given with its open file, which close() closes once
+    every block is written.
+    """
+
+    def __init__(self, var, label, nblocks, dataset=None):
+        self.var = var
+        self.label = label
+        self.nblocks = nblocks
+        self.dataset = dataset
+        self.nwritten = 0
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.nbytes = 0
+        # Zarr blocks are written from several threads at once
+        self.tally_lock = threading.Lock()
+
+    def __setitem__(self, key, value):
+        wall0 = time.perf_counter()
+        cpu0 = time.thread_time()
+        self.var[key] = value
+        with self.tally_lock:
+            self.wall_s += time.perf_counter() - wall0
+            self.cpu_s += time.thread_time() - cpu0
+            self.nbytes += value.nbytes
+            self.nwritten += 1
+            nwritten = self.nwritten
+        logger.info(
+            "Wrote block {}/{} to {}".format(nwritten, self.nblocks, self.label)
+        )
+
+    def close(self):
+        if self.dataset is not None:
+            self.dataset.close()
+
+
+def CreateLocalizedNetCDF(
+    filename,
+    nsamps,
+    targyears,
+    site_ids,
+    site_lats,
+    site_lons,
+    attrs,
+    chunksizes,
+    missing_value=np.nan,
+):
+    """
+    Create a localized projection file with an empty, chunked sea_level_change.
+
+    Returns
+    -------
+    netCDF4.Dataset
+            The open file, to be closed by the caller once written.
+    """
+    nc = Dataset(filename, "w", format="NETCDF4")
+    nc.setncatts(attrs)
+
+    nc.createDimension("samples", nsamps)
+    nc.createDimension("years", len(targyears))
+    nc.createDimension("locations", len(site_ids))
+
+    slc = nc.createVariable(
+        "sea_level_change",
+        "f4",
+        ("samples", "years", "locations"),
+        zlib=True,
+        complevel=4,
+        shuffle=True,
+        chunksizes=chunksizes,
+        fill_value=missing_value,
+    )
+    slc.setncatts({"units": "mm", "missing_value": np.float32(missing_value)})
+
+    for name, values in (("lat", site_lats), ("lon", site_lons)):
+        values = np.asarray(values)
+        var = nc.createVariable(name, values.dtype, ("locations",), fill_value=np.nan)
+        var[:] = values
+
+    for name, values in (
+        ("years", targyears),
+        ("locations", site_ids),
+        ("samples", np.arange(nsamps)),
+    ):
+        values = np.asarray(values)
+        nc.createVariable(name, values.dtype, (name,))[:] = values
+
+    return nc
+
+
+def CreateLocalizedWriters(
+    sources,
+    filenames,
+    targyears,
+    site_ids,
+    site_lats,
+    site_lons,
+    attrs,
+    disk_chunks=DEFAULT_DISK_CHUNKS,
+    cache_mb=None,
+):
+    """
+    Create localized projection netCDF files and a BlockWriter for each, to be
+    closed by the caller once written. The HDF5 chunk cache of each file holds
+    the on-disk chunks under a location chunk of the sources, or cache_mb if
+    given.
+    """
+    shape = sources[0].shape
+    chunksizes = ResolveDiskChunks(disk_chunks, shape)
+
+    # Keep every on-disk chunk touched by one location-chunk column of dask
+    # blocks in the HDF5 cache, so chunks are compressed and written once
+    loc_block = max(sources[0].chunks[2])
+    column_chunks = [
+        -(-shape[0] // chunksizes[0]),
+        -(-shape[1] // chunksizes[1]),
+        -(-loc_block // chunksizes[2]) + 1,
+    ]
+    chunk_bytes = 4 * int(np.prod(chunksizes))
+    cache_chunks = 2 * int(np.prod(column_chunks))
+    if cache_mb is not None:
+        # Blocks then finish their on-disk chunks on their own, e.g. a batch
+        # of samples at a time, so only the chunks in flight need caching
+        cache_chunks = max(1, int(cache_mb * 1024**2) // chunk_bytes)
+
+    writers = []
+    for source, filename in zip(sources, filenames):
+        nc = CreateLocalizedNetCDF(
+            filename,
+            shape[0],
+            targyears,
+            site_ids,
+            site_lats,
+            site_lons,
+            attrs,
+            chunksizes,
+        )
+        var = nc.variables["sea_level_change"]
+        var.set_var_chunk_cache(
+            size=cache_chunks * chunk_bytes,
+            nelems=max(521, 10 * cache_chunks + 1),
+            preemption=0.75,
+        )
+        writers.append(
+            BlockWriter(var, os.path.basename(filename), source.npartitions, nc)
+        )
+
+    return writers
+
+
+def CreateLocalizedZarrWriters(
+    sources, filenames, targyears, site_ids, site_lats, site_lons, attrs
+):
+    """
+    Create localized projection Zarr stores, chunked like their dask sources,
+    and a BlockWriter for each.
+    """
+    import zarr
+
+    writers = []
+    for source, filename in zip(sources, filenames):
+        ds_out = make_localized_ds(
+            source.astype(np.float32),
+            targyears,
+            site_ids,
+            site_lats,
+            site_lons,
+            attrs,
+        )
+        # Only the metadata and coordinates are written here; the projections
+        # are written block by block into the empty array
+        ds_out.to_zarr(
+            filename,
+            mode="w",
+            encoding={
+                "sea_level_change": {
+                    "chunks": tuple(c[0] for c in source.chunks),
+                    "_FillValue": np.nan,
+                }
+            },
+            compute=False,
+        )
+        var = zarr.open_array(filename, path="sea_level_change", mode="r+")
+        writers.append(
+            BlockWriter(var, os.path.basename(filename.rstrip("/")), source.npartitions)
+        )
+
+    return writers
+
+
+def StoreLocalized(
+    sources,
+    filenames,
+    targyears,
+    site_ids,
+    site_lats,
+    site_lons,
+    attrs,
+    disk_chunks=DEFAULT_DISK_CHUNKS,
+    output_format="netcdf",
+    summary_sources=(),
+    quantiles=None,
+    projections=(),
+    cache_mb=None,
+):
+    """
+    Stream localized projections into netCDF files or Zarr stores, and take
+    their quantile summaries, in a single dask pass.
+
+    Parameters
+    ----------
+    sources : list of dask.array.Array
+            Localized projections shaped (samples, years, locations). Arrays
+            sharing graph inputs (e.g. WAIS, EAIS and their AIS sum) are
+            computed together, so shared blocks are only computed once.
+    filenames : list of str
+            Output file for each source.
+    targyears, site_ids, site_lats, site_lons : array-like
+            Coordinates written alongside the projections.
+    attrs : dict
+            Global attributes for the files.
+    disk_chunks : tuple of int
+            On-disk (samples, years, locations) chunk shape of netCDF files;
+            0 spans the axis, up to DISK_CHUNK_MB along samples. Zarr stores
+            are chunked like their dask source.
+    output_format : str
+            'netcdf' or 'zarr'.
+    summary_sources : list of dask.array.Array
+            Localized projections to take quantiles over the samples of, with
+            all samples in one chunk. They are computed in the same pass as
+            the sources, so a block of a projection both written and
+            summarized is computed once, and only the small summaries are
+            gathered here.
+    quantiles : array-like, optional
+            Quantiles in [0, 1], needed with summary_sources.
+    projections : list of tuple
+            (dask.array.Array, BlockWriter) pairs of other arrays to write in
+            the same pass, e.g. the global projections gathered from the same
+            sample batches, as set up by write_projection_ds.
+    cache_mb : float, optional
+            Fixed HDF5 chunk cache of each netCDF file, in MB, for sources
+            whose blocks each fill whole on-disk chunks, e.g. a sample batch.
+
+    Returns
+    -------
+    list of numpy.ndarray
+            Quantiles of each summary source, shaped (quantiles, years,
+            locations).
+    """
+    writers = []
+    if len(sources) > 0 and output_format == "zarr":
+        writers = CreateLocalizedZarrWriters(
+            sources, filenames, targyears, site_ids, site_lats, site_lons, attrs
+        )
+        # Zarr arrays are written from plain arrays, as by xarray
+        sources = [da.ma.getdata(source) for source in sources]
+    elif len(sources) > 0:
+        writers = CreateLocalizedWriters(
+            sources,
+            filenames,
+            targyears,
+            site_ids,
+            site_lats,
+            site_lons,
+            attrs,
+            disk_chunks,
+            cache_mb,
+        )
+
+    summaries = [
+        np.empty((len(quantiles),) + source.shape[1:]) for source in summary_sources
+    ]
+    StoreWriters(
+        [source.astype(np.float32) for source in sources]
+        + [
+            source.map_blocks(
+                QuantileBlock,
+                quantiles=quantiles,
+                chunks=((len(quantiles),),) + source.chunks[1:],
+                dtype=np.float64,
+            )
+            for source in summary_sources
+        ]
+        + [source for source, _ in projections],
+        writers + summaries + [writer for _, writer in projections],
+    )
+
+    return summaries
+
+
+def StoreWriters(sources, targets):
+    """
+    Compute the sources and write them into their targets in a single dask
+    pass, then close the BlockWriters among the targets and record their
+    writes in the stage metrics. Other targets, e.g. in-memory arrays for the
+    quantile summaries, are filled in place.
+    """
+    writers = [target for target in targets if isinstance(target, BlockWriter)]
+
+    # The netCDF/HDF5 library is not thread-safe, so the lock xarray holds for
+    # its netCDF reads and writes also covers these files
+    if any(writer.dataset is not None for writer in writers):
+        lock = HDF5_LOCK
+    else:
+        lock = False
+
+    try:
+        StoreBlocks(sources, targets, lock)
+    finally:
+        for writer in writers:
+            writer.close()
+
+    # Writes are interleaved with computing the blocks, so they are recorded
+    # from the writers' own tallies
+    for writer in writers:
+        RecordSubstage(
+            "write {}".format(writer.label),
+            writer.wall_s,
+            writer.cpu_s,
+            writer.nbytes,
+        )
+
+
+def StoreBlocks(sources, targets, lock=False):
+    """
+    Compute the sources block by block and write each block into its target.
+
+    In-process schedulers write the blocks as they are computed, from a
+    single graph. Out-of-process ones compute them on the workers and hand
+    them back here, with StoreGathered, since neither open netCDF files nor
+    in-memory targets can be shared with other processes; sources are then
+    gathered in groups with the same blocks.
+    """
+    if len(sources) == 0:
+        return
+
+    if SchedulerInProcess():
+        da.store(sources, targets, lock=lock)
+        return
+
+    groups = {}
+    for source, target in zip(sources, targets):
+        groups.setdefault(source.numblocks, []).append((source, target))
+    for group in groups.values():
+        StoreGathered(
+            [source for source, _ in group],
+            [target for _, target in group],
+            dask.config.get("num_workers", None),
+        )
+
+
+def StoreGathered(sources, writers, batch=None):
+    """
+    Compute blocks on out-of-process workers and write them from this process.
+
+    Blocks at the same position in every source are computed together, so the
+    blocks they share are only computed once, and a batch of block positions
+    is in flight at a time to bound the memory held here.
+    """
+    batch = max(1, batch or os.cpu_count() or 1)
+    slices = [list(da.core.slices_from_chunks(source.chunks)) for source in sources]
+    blocks = [source.to_delayed(optimize_graph=False).ravel() for source in sources]
+
+    for start in range(0, len(blocks[0]), batch):
+        stop = min(start + batch, len(blocks[0]))
+        results = dask.compute(
+            *[
+                [source_blocks[ii] for source_blocks in blocks]
+                for ii in range(start, stop)
+            ]
+        )
+        for ii, values in zip(range(start, stop), results):
+            for writer, source_slices, value in zip(writers, slices, values):
+                writer[source_slices[ii]] = value
+
+
+def make_localized_ds(localsl, targyears, site_ids, site_lats, site_lons, attrs):
+    """
+    Wrap localized projections in an xarray Dataset with the lslr file layout.
+    """
+    return xr.Dataset(
+        {
+            "sea_level_change": (
+                ("samples", "years", "locations"),
+                localsl,
+                {"units": "mm", "missing_value": np.nan},
+            ),
+            "lat": (("locations"), site_lats),
+            "lon": (("locations"), site_lons),
+        },
+        coords={
+            "years": targyears,
+            "locations": site_ids,
+            "samples": np.arange(localsl.shape[0]),
+        },
+        attrs=attrs,
+    )
+
+
+def QuantileBlock(block, quantiles):
+    # Quantiles over the samples of a block holding every sample
+    return np.quantile(np.ma.getdata(block), quantiles, axis=0)
+
+
+def make_summary_ds(
+    summary, quantiles, targyears, site_ids, site_lats, site_lons, attrs
+):
+    """
+    Wrap quantiles of localized projections in an xarray Dataset.
+    """
+    return xr.Dataset(
+        {
+            "sea_level_change": (
+                ("quantiles", "years", "locations"),
+                summary,
+                {"units": "mm", "missing_value": np.nan},
+            ),
+            "lat": (("locations"), site_lats),
+            "lon": (("locations"), site_lons),
+        },
+        coords={
+            "quantiles": quantiles,
+            "years": targyears,
+            "locations": site_ids,
+        },
+        attrs=attrs,
+    )
+
+
+def WriteSummaries(
+    summaries,
+    filenames,
+    quantiles,
+    targyears,
+    site_ids,
+    site_lats,
+    site_lons,
+    attrs,
+    output_format="netcdf",
+):
+    """
+    Wrap per-site quantiles of localized projections in Datasets and write
+    them to files.
+
+    Parameters
+    ----------
+    summaries : list of numpy.ndarray
+            Quantiles shaped (quantiles, years, locations), as returned by
+            StoreLocalized.
+    filenames : list of str or None
+            Summary output file for each summary; None keeps it in memory only.
+    quantiles : array-like
+            Quantiles in [0, 1].
+    targyears, site_ids, site_lats, site_lons, attrs
+            As for StoreLocalized.
+    output_format : str
+            'netcdf' or 'zarr'.
+
+    Returns
+    -------
+    list of xarray.Dataset
+            Each summary, as written to its file.
+    """
+    ds_summaries = []
+    for summary, filename in zip(summaries, filenames):
+        ds_out = make_summary_ds(
+            summary.astype(np.float32),
+            quantiles,
+            targyears,
+            site_ids,
+            site_lats,
+            site_lons,
+            attrs,
+        )
+        if filename is not None:
+            if output_format == "zarr":
+                ds_out.to_zarr(filename, mode="w")
+            else:
+                ds_out.to_netcdf(filename)
+            logger.info(
+                "Wrote quantile summary to {}".format(os.path.basename(filename))
+            )
+        ds_summaries.append(ds_out)
+
+    return ds_summaries
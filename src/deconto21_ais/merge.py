@@ -0,0 +1,103 @@
+import logging
+
+import click
+
+from deconto21_ais.validation import ParseDiskChunks, ZarrAvailable
+
+""" merge.py
+
+Merges the lslr shard files written by deconto21-ais runs with --site-partition.
+
+Each run of a partitioned job (e.g. one SLURM array task per partition) writes
+its sites to shard files named after the lslr outputs. Once all runs are done,
+this command concatenates the shards of each output along locations into the
+output file itself. The global projections are not needed.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def ParseChunksOption(value):
+    try:
+        return ParseDiskChunks(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+@click.command()
+@click.argument("lslr_files", nargs=-1, required=True)
+@click.option(
+    "--partitions",
+    type=click.IntRange(min=1),
+    help="Number of site partitions N the runs were given as --site-partition i/N",
+    envvar="DP21_PARTITIONS",
+    required=True,
+)
+@click.option(
+    "--chunksize",
+    type=int,
+    help="Number of locations to process at a time",
+    envvar="DP21_CHUNKSIZE",
+    default=50,
+    show_default=True,
+)
+@click.option(
+    "--max-chunk-mb",
+    type=int,
+    help="Memory budget for each (samples, years, locations) chunk copied, in MB",
+    envvar="DP21_MAX_CHUNK_MB",
+    default=64,
+    show_default=True,
+)
+@click.option(
+    "--lslr-chunks",
+    type=str,
+    help="On-disk 'samples,years,locations' chunk shape of the merged files; 0 spans the whole axis, except samples, where it spans at most 4 MB of values per chunk",
+    envvar="DP21_LSLR_CHUNKS",
+    default="0,0,1",
+    show_default=True,
+    callback=lambda ctx, param, value: ParseChunksOption(value),
+)
+@click.option(
+    "--output-format",
+    type=click.Choice(["netcdf", "zarr"]),
+    help="Format of the shards and merged outputs",
+    envvar="DP21_OUTPUT_FORMAT",
+    default="netcdf",
+    show_default=True,
+)
+@click.option(
+    "--debug/--no-debug",
+    default=False,
+    envvar="DP21_DEBUG",
+)
+def main(
+    lslr_files, partitions, chunksize, max_chunk_mb, lslr_chunks, output_format, debug
+):
+    """Merge the site partition shards of each LSLR_FILES output."""
+
+    logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
+
+    if output_format == "zarr" and not ZarrAvailable():
+        raise click.UsageError(
+            "Zarr output needs the zarr package; install deconto21-ais[zarr]"
+        )
+
+    # Imported here so --help and option errors don't wait on xarray and dask
+    from deconto21_ais.deconto21_ais_postprocess import dp21_merge_lslr_shards
+
+    for lslr_file in lslr_files:
+        logger.info("Merging {} shards into {}".format(partitions, lslr_file))
+        try:
+            dp21_merge_lslr_shards(
+                lslr_file,
+                partitions,
+                chunksize=chunksize,
+                max_chunk_mb=max_chunk_mb,
+                disk_chunks=lslr_chunks,
+                output_format=output_format,
+            )
+        except (FileNotFoundError, ValueError) as e:
+            raise click.ClickException(str(e))
+        logger.info("Finished merging {}".format(lslr_file))
@@ -0,0 +1,173 @@
+import contextlib
+import json
+import resource
+import sys
+import time
+
+""" metrics.py
+
+Timing and memory instrumentation of the workflow stages.
+
+Stages are measured with MeasureStage, and nested stages are recorded under
+"parent/child" paths. Nothing is measured until StartMetrics is called, and
+WriteMetrics then writes one JSON record per stage path:
+
+    calls           - number of times the stage ran
+    wall_s, cpu_s   - wall and CPU time, summed over calls; CPU time covers
+                      all threads of this process
+    peak_rss_bytes  - peak resident memory of this process during the stage
+    read_bytes,
+    write_bytes     - bytes read and written by this process's read and write
+                      calls, summed over calls
+
+Peak memory is per stage where the kernel lets the high-water mark be reset
+(Linux), and otherwise the process peak up to the end of the stage. I/O is
+only counted where /proc/self/io exists, and neither covers work done in
+other processes, e.g. by the processes or distributed dask schedulers.
+
+Substages recorded with RecordSubstage, such as the lslr writes interleaved
+with computing the localized blocks, carry the time and the (uncompressed)
+bytes their caller tallied.
+
+"""
+
+# Stage records keyed on path while metrics are collected, None otherwise
+_records = None
+_stack = []
+
+
+def StartMetrics():
+    global _records
+    _records = {}
+    _stack.clear()
+
+
+def ReadIOCounters():
+    # Bytes passed through read and write calls by this process so far
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(":") for line in f if ":" in line)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def ResetPeakRSS():
+    # Reset the kernel's resident memory high-water mark to the current usage
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def PeakRSS():
+    # Resident memory high-water mark of this process, in bytes
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def RecordStage(path, wall_s, cpu_s, peak_rss_bytes, read_bytes, write_bytes):
+    # Add one call of a stage to its record
+    record = _records.get(path)
+    if record is None:
+        record = {
+            "stage": path,
+            "calls": 0,
+            "wall_s": 0.0,
+            "cpu_s": 0.0,
+            "peak_rss_bytes": None,
+            "read_bytes": None,
+            "write_bytes": None,
+        }
+        _records[path] = record
+    record["calls"] += 1
+    record["wall_s"] += wall_s
+    record["cpu_s"] += cpu_s
+    for key, value in (
+        ("read_bytes", read_bytes),
+        ("write_bytes", write_bytes),
+    ):
+        if value is not None:
+            record[key] = (record[key] or 0) + value
+    if peak_rss_bytes is not None:
+        record["peak_rss_bytes"] = max(record["peak_rss_bytes"] or 0, peak_rss_bytes)
+
+
+def StagePath(name):
+    return "/".join([frame["name"] for frame in _stack] + [name])
+
+
+@contextlib.contextmanager
+def MeasureStage(name):
+    """
+    Measure the enclosed code as a stage named name, nested in any enclosing
+    stage. Does nothing unless StartMetrics has been called.
+    """
+    if _records is None:
+        yield
+        return
+
+    # Keep the enclosing stage's peak before the high-water mark is reset
+    if len(_stack) > 0:
+        _stack[-1]["peak"] = max(_stack[-1]["peak"], PeakRSS())
+
+    # Stages are reported in the order they start
+    path = StagePath(name)
+    _records.setdefault(path, None)
+    frame = {"name": name, "peak": 0}
+    _stack.append(frame)
+
+    ResetPeakRSS()
+    (read0, write0) = ReadIOCounters()
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+        (read1, write1) = ReadIOCounters()
+        peak = max(frame["peak"], PeakRSS())
+        _stack.pop()
+        if len(_stack) > 0:
+            _stack[-1]["peak"] = max(_stack[-1]["peak"], peak)
+
+        RecordStage(
+            path,
+            wall,
+            cpu,
+            peak,
+            None if read0 is None else read1 - read0,
+            None if write0 is None else write1 - write0,
+        )
+
+
+def RecordSubstage(name, wall_s, cpu_s=0.0, write_bytes=None):
+    """
+    Record a substage of the current stage measured by the caller, e.g. time
+    spent in writes interleaved with other work. Does nothing unless
+    StartMetrics has been called.
+    """
+    if _records is None:
+        return
+
+    RecordStage(StagePath(name), wall_s, cpu_s, None, None, write_bytes)
+
+
+def WriteMetrics(filename, **info):
+    """
+    Write the stage records collected so far to a JSON file, along with any
+    extra information given as keyword arguments.
+    """
+    report = dict(info, stages=[r for r in _records.values() if r is not None])
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
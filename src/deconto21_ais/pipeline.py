@@ -0,0 +1,281 @@
+import logging
+
+import numpy as np
+import xarray as xr
+
+from deconto21_ais.deconto21_ais_preprocess import dp21_preprocess_icesheet
+from deconto21_ais.deconto21_ais_project import (
+    dp21_project_icesheet,
+    dp21_project_icesheet_temperaturedriven,
+    make_projection_ds,
+)
+from deconto21_ais.deconto21_ais_postprocess import dp21_postprocess_icesheet
+from deconto21_ais.metrics import MeasureStage
+from deconto21_ais.validation import (
+    ParseDiskChunks,
+    ParseQuantiles,
+    ParseSitePartition,
+    PrecisionDtype,
+)
+
+""" pipeline.py
+
+Runs the whole DP21 ice sheet workflow in-process and returns its projections.
+
+run_dp21 takes a configuration dict with the deconto21-ais option names written
+with underscores, e.g.
+
+    results = run_dp21({
+        "scenario": "ssp585",
+        "nsamps": 2000,
+        "input_eais_rcp26_file": "...",
+        ...
+        "location_file": "location.lst",
+        "fingerprint_dir": "FPRINT",
+    })
+    results["ais_lslr"]["sea_level_change"]
+
+and returns xarray Datasets laid out like the output files: "ais_gslr",
+"eais_gslr" and "wais_gslr" for the global projections, "ais_lslr",
+"eais_lslr" and "wais_lslr" for the local ones, and "<key>_quantiles" for the
+quantile summaries asked for, which are held in memory. Output files are only
+written for the output_* keys given, so an orchestrator can chain modules
+without a round trip through disk. The local projections, and the global ones
+with sample_batch, are dask-backed: those written to files are read back from
+them, and the others are computed on demand. Datasets read back keep their
+files open until the caller closes them.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+RUN_DEFAULTS = {
+    "scenario": "rcp85",
+    "baseyear": 2000,
+    "climate_data_file": "",
+    "nsamps": None,
+    "pyear_start": 2020,
+    "pyear_end": 2100,
+    "pyear_step": 10,
+    "replace": True,
+    "rngseed": 1342,
+    "sample_batch": None,
+    "pipeline_id": None,
+    "chunksize": 50,
+    "max_chunk_mb": 64,
+    "lslr_chunks": "0,0,1",
+    "site_partition": None,
+    "output_format": "netcdf",
+    "scheduler": None,
+    "dask_workers": None,
+    "memory_limit": None,
+    "summary_quantiles": None,
+    "summary_only": False,
+    "precision": "native",
+    "fingerprint_cache_dir": None,
+    "lazy_read": False,
+    "cache_dir": None,
+    "cache_max_mb": 4096,
+    "ensemble_store": None,
+    "output_ais_gslr_file": None,
+    "output_eais_gslr_file": None,
+    "output_wais_gslr_file": None,
+    "output_ais_lslr_file": None,
+    "output_eais_lslr_file": None,
+    "output_wais_lslr_file": None,
+}
+
+RUN_REQUIRED = (
+    "input_eais_rcp26_file",
+    "input_eais_rcp45_file",
+    "input_eais_rcp85_file",
+    "input_wais_rcp26_file",
+    "input_wais_rcp45_file",
+    "input_wais_rcp85_file",
+    "location_file",
+    "fingerprint_dir",
+)
+
+
+def InputPathsDict(run):
+    return {
+        "rcp26": {
+            "eais": run["input_eais_rcp26_file"],
+            "wais": run["input_wais_rcp26_file"],
+        },
+        "rcp45": {
+            "eais": run["input_eais_rcp45_file"],
+            "wais": run["input_wais_rcp45_file"],
+        },
+        "rcp85": {
+            "eais": run["input_eais_rcp85_file"],
+            "wais": run["input_wais_rcp85_file"],
+        },
+    }
+
+
+def RunConfig(config):
+    """
+    Fill in the defaults of a run configuration and check its keys.
+
+    Chunk shapes, quantiles and site partitions may be given as their option
+    strings, e.g. "0,0,1", "5,50,95" and "0/4", and are parsed here.
+
+    Raises
+    ------
+    ValueError
+            For unknown or missing keys and malformed values.
+    """
+    run = dict(RUN_DEFAULTS, **config)
+
+    unknown = set(run) - set(RUN_DEFAULTS) - set(RUN_REQUIRED)
+    if unknown:
+        raise ValueError("Unknown run keys: {}".format(", ".join(sorted(unknown))))
+    missing = [k for k in RUN_REQUIRED if k not in run]
+    if missing:
+        raise ValueError("Missing run keys: {}".format(", ".join(missing)))
+    if len(run["climate_data_file"]) == 0 and run["nsamps"] is None:
+        raise ValueError("nsamps is needed when no climate_data_file is given")
+
+    for key, parse in (
+        ("lslr_chunks", ParseDiskChunks),
+        ("summary_quantiles", ParseQuantiles),
+        ("site_partition", ParseSitePartition),
+    ):
+        if isinstance(run[key], str):
+            run[key] = parse(run[key])
+    if run["summary_only"] and run["summary_quantiles"] is None:
+        raise ValueError("summary_only needs summary_quantiles")
+    PrecisionDtype(run["precision"])
+
+    return run
+
+
+def run_dp21(config, preprocess_dict=None, site_fingerprints=None):
+    """
+    Run the preprocessing, projection and postprocessing stages in-process.
+
+    Parameters
+    ----------
+    config : dict
+            Run configuration keyed on the deconto21-ais option names with
+            underscores; see RUN_DEFAULTS and RUN_REQUIRED.
+    preprocess_dict : dict, optional
+            Output of dp21_preprocess_icesheet to use instead of preprocessing,
+            e.g. when it is shared by several runs.
+    site_fingerprints : dict, optional
+            Output of LoadSiteFingerprints to use instead of interpolating the
+            fingerprints to the sites again.
+
+    Returns
+    -------
+    dict of xarray.Dataset
+            Global ("ais_gslr", "eais_gslr", "wais_gslr") and local
+            ("ais_lslr", "eais_lslr", "wais_lslr") projections, and the
+            quantile summaries of the local projections, if asked for: those
+            written, or all three if no lslr output is set. Outputs written
+            to files are open datasets on those files, which the caller owns
+            and must close, e.g. before another run overwrites them; closing
+            the in-memory ones does nothing.
+    """
+    run = RunConfig(config)
+    temperature_driven = len(run["climate_data_file"]) > 0
+
+    # Every partition computes the same global projections; only the first
+    # writes them
+    if run["site_partition"] is not None and run["site_partition"][0] > 0:
+        for ice in ("ais", "eais", "wais"):
+            run["output_{}_gslr_file".format(ice)] = None
+
+    if preprocess_dict is None:
+        logger.info("Starting preprocessing step...")
+        with MeasureStage("preprocess"):
+            preprocess_dict = dp21_preprocess_icesheet(
+                scenario=run["scenario"],
+                baseyear=run["baseyear"],
+                input_paths_dict=InputPathsDict(run),
+                pipeline_id=run["pipeline_id"],
+                climate_data_file=run["climate_data_file"],
+                lazy=run["lazy_read"],
+                cache_dir=run["cache_dir"],
+                cache_max_mb=run["cache_max_mb"],
+                ensemble_store=run["ensemble_store"],
+                precision=run["precision"],
+            )
+        logger.info("Finished preprocessing step")
+
+    logger.info("Starting projection step...")
+    projection = dict(
+        pyear_start=run["pyear_start"],
+        pyear_end=run["pyear_end"],
+        pyear_step=run["pyear_step"],
+        pipeline_id=run["pipeline_id"],
+        replace=run["replace"],
+        rngseed=run["rngseed"],
+        preprocess_dict=preprocess_dict,
+        output_ais_gslr_file=run["output_ais_gslr_file"],
+        output_eais_gslr_file=run["output_eais_gslr_file"],
+        output_wais_gslr_file=run["output_wais_gslr_file"],
+        output_format=run["output_format"],
+        sample_batch=run["sample_batch"],
+        # Batched gslr writes share the localisation pass
+        defer_writes=True,
+    )
+    with MeasureStage("project"):
+        if temperature_driven:
+            projected_dict = dp21_project_icesheet_temperaturedriven(
+                climate_data_file=run["climate_data_file"], **projection
+            )
+        else:
+            projected_dict = dp21_project_icesheet(nsamps=run["nsamps"], **projection)
+    logger.info("Finished projection step")
+
+    logger.info("Starting postprocessing step...")
+    with MeasureStage("postprocess"):
+        results = dp21_postprocess_icesheet(
+            locationfile=run["location_file"],
+            chunksize=run["chunksize"],
+            max_chunk_mb=run["max_chunk_mb"],
+            disk_chunks=run["lslr_chunks"],
+            output_format=run["output_format"],
+            pipeline_id=run["pipeline_id"],
+            projected_dict=projected_dict,
+            fpdir=run["fingerprint_dir"],
+            fp_cache_dir=run["fingerprint_cache_dir"],
+            site_partition=run["site_partition"],
+            scheduler=run["scheduler"],
+            dask_workers=run["dask_workers"],
+            memory_limit=run["memory_limit"],
+            summary_quantiles=run["summary_quantiles"],
+            summary_only=run["summary_only"],
+            precision=run["precision"],
+            sample_batch=run["sample_batch"],
+            out_ais_lslr_file=run["output_ais_lslr_file"],
+            out_eais_lslr_file=run["output_eais_lslr_file"],
+            out_wais_lslr_file=run["output_wais_lslr_file"],
+            site_fingerprints=site_fingerprints,
+        )
+    logger.info("Finished postprocessing step")
+
+    # The global projections, laid out like the gslr files. Batched samples
+    # written to a file are read back from it rather than gathered again
+    nsamps = projected_dict["ais_samps"].shape[0]
+    engine = "zarr" if run["output_format"] == "zarr" else "netcdf4"
+    for ice in ("ais", "eais", "wais"):
+        gslr_file = run["output_{}_gslr_file".format(ice)]
+        if run["sample_batch"] is not None and gslr_file is not None:
+            results["{}_gslr".format(ice)] = xr.open_dataset(
+                gslr_file, engine=engine, chunks={}
+            )
+            continue
+        results["{}_gslr".format(ice)] = make_projection_ds(
+            ice_source=ice.upper(),
+            global_samps=projected_dict["{}_samps".format(ice)],
+            years=projected_dict["targyears"],
+            samples=np.arange(nsamps, dtype=np.int64),
+            locations=np.array([-1], dtype=np.int64),
+            scenario=projected_dict["scenario"],
+            baseyear=projected_dict["baseyear"],
+        )
+
+    return results
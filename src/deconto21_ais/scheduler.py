@@ -0,0 +1,88 @@
+import contextlib
+import logging
+
+import dask
+import dask.local
+import dask.threaded
+
+from deconto21_ais.validation import SCHEDULERS, DistributedAvailable
+
+""" scheduler.py
+
+Dask scheduler settings for the localisation (postprocess) stage.
+
+The localized projections are computed with one of dask's schedulers:
+
+    threads      - a thread pool in this process (dask's default)
+    processes    - a pool of worker processes
+    synchronous  - a single thread, one block at a time
+    distributed  - a local dask.distributed cluster of single-threaded worker
+                   processes, each held under a memory limit
+
+Thread-based schedulers write each block into the open output files as it is
+computed. With processes or a distributed cluster, blocks are computed by the
+workers and written by this process, since open netCDF files and in-memory
+summaries cannot be shared with other processes.
+
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def SchedulerInProcess():
+    # True when the active dask scheduler runs tasks in this process
+    return dask.base.get_scheduler() in (None, dask.threaded.get, dask.local.get_sync)
+
+
+@contextlib.contextmanager
+def DaskScheduler(scheduler=None, workers=None, memory_limit=None):
+    """
+    Run the enclosed dask computations on the given scheduler.
+
+    Parameters
+    ----------
+    scheduler : str, optional
+            One of "threads", "processes", "synchronous" or "distributed";
+            the scheduler already configured is kept if not given.
+    workers : int, optional
+            Number of threads or worker processes; dask's default (one per
+            core) if not given. Ignored by the synchronous scheduler.
+    memory_limit : str or int, optional
+            Memory limit per worker for the distributed scheduler, in bytes or
+            as a string such as "4GB"; dask's default share of system memory
+            if not given.
+    """
+    if scheduler is not None and scheduler not in SCHEDULERS:
+        raise ValueError(
+            "Unknown dask scheduler '{}', expected one of {}".format(
+                scheduler, ", ".join(SCHEDULERS)
+            )
+        )
+
+    if scheduler != "distributed":
+        if memory_limit is not None:
+            logger.warning("Memory limit is only applied by the distributed scheduler")
+        config = {} if scheduler is None else {"scheduler": scheduler}
+        if workers is not None:
+            config["num_workers"] = workers
+        with dask.config.set(config):
+            yield
+        return
+
+    if not DistributedAvailable():
+        raise ImportError(
+            "The distributed scheduler needs the distributed package; install deconto21-ais[distributed]"
+        )
+    from distributed import Client, LocalCluster
+
+    with (
+        LocalCluster(
+            n_workers=workers,
+            threads_per_worker=1,
+            memory_limit="auto" if memory_limit is None else memory_limit,
+        ) as cluster,
+        Client(cluster) as client,
+    ):
+        # The client is dask's default scheduler until it is closed
+        logger.info("Started local dask cluster at {}".format(client.dashboard_link))
+        yield
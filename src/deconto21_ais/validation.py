@@ -0,0 +1,167 @@
+import importlib.util
+import os
+
+import numpy as np
+
+""" validation.py
+
+Option parsing and input checks for the deconto21-ais commands.
+
+Nothing here imports xarray, dask, scipy, h5py or netCDF4, so arguments and
+inputs are checked, and --help is answered, before the workflow modules are
+loaded.
+
+"""
+
+SCHEDULERS = ("threads", "processes", "synchronous", "distributed")
+
+# native keeps the ensembles as stored and localizes in float64; float64 and
+# float32 convert the ensembles once when they are read and stay in that type
+PRECISIONS = ("native", "float64", "float32")
+
+# Scenario names accepted for the DP21 ensembles, mapped to their input files
+SCENARIO_MAP = {
+    "rcp85": "rcp85",
+    "rcp45": "rcp45",
+    "rcp26": "rcp26",
+    "ssp585": "rcp85",
+    "ssp245": "rcp45",
+    "ssp126": "rcp26",
+}
+
+# Fingerprint files read from the fingerprint directory
+FINGERPRINT_FILES = ("fprint_wais.nc", "fprint_eais.nc")
+
+
+def ParseDiskChunks(text):
+    """
+    Parse a "samples,years,locations" on-disk chunk specification.
+    """
+    try:
+        chunks = tuple(int(x) for x in text.split(","))
+    except ValueError:
+        chunks = ()
+    if len(chunks) != 3 or any(c < 0 for c in chunks):
+        raise ValueError(
+            "Chunk shape must be three non-negative integers 'samples,years,locations', got '{}'".format(
+                text
+            )
+        )
+
+    return chunks
+
+
+def ParseSitePartition(text):
+    """
+    Parse an "i/N" site partition, with 0 <= i < N.
+    """
+    try:
+        (index, count) = (int(x) for x in text.split("/"))
+    except ValueError:
+        (index, count) = (-1, 0)
+    if not 0 <= index < count:
+        raise ValueError(
+            "Site partition must be 'i/N' with 0 <= i < N, got '{}'".format(text)
+        )
+
+    return (index, count)
+
+
+def ParseQuantiles(text):
+    """
+    Parse comma-separated percentiles, e.g. "5,17,50,83,95", into quantiles.
+    """
+    try:
+        percentiles = [float(x) for x in text.split(",")]
+    except ValueError:
+        percentiles = []
+    if len(percentiles) == 0 or any(not 0 <= p <= 100 for p in percentiles):
+        raise ValueError(
+            "Quantiles must be comma-separated percentiles in [0, 100], got '{}'".format(
+                text
+            )
+        )
+
+    return np.array(percentiles) / 100
+
+
+def PrecisionDtype(precision):
+    # Type the ensembles are converted to when read; None keeps them as stored
+    if precision not in PRECISIONS:
+        raise ValueError(
+            "Precision must be one of {}, got '{}'".format(
+                ", ".join(PRECISIONS), precision
+            )
+        )
+
+    return None if precision == "native" else np.dtype(precision)
+
+
+def ZarrAvailable():
+    # zarr is an optional dependency, only needed for Zarr outputs
+    return importlib.util.find_spec("zarr") is not None
+
+
+def DistributedAvailable():
+    # distributed is an optional dependency, only needed for local clusters
+    return importlib.util.find_spec("distributed") is not None
+
+
+def ValidateInputs(
+    scenario,
+    climate_data_file,
+    input_files,
+    location_file,
+    fingerprint_dir,
+    pyear_start,
+    pyear_end,
+    pyear_step,
+):
+    """
+    Check the scenario, projection years and input paths of a run.
+
+    Parameters
+    ----------
+    scenario : str
+            Emissions scenario; one of SCENARIO_MAP unless temperature-driven.
+    climate_data_file : str
+            Climate data file, or "" for a scenario-driven run.
+    input_files : list of str
+            DP21 EAIS and WAIS ensemble files.
+    location_file : str
+            Site table.
+    fingerprint_dir : str
+            Directory holding the FINGERPRINT_FILES.
+    pyear_start, pyear_end, pyear_step : int
+            Projection years.
+
+    Raises
+    ------
+    ValueError
+            Describing the first problem found.
+    """
+    if len(climate_data_file) == 0 and scenario not in SCENARIO_MAP:
+        raise ValueError(
+            "Unknown scenario '{}', expected one of {}".format(
+                scenario, ", ".join(SCENARIO_MAP)
+            )
+        )
+
+    if pyear_step <= 0:
+        raise ValueError(
+            "Projection year step must be positive, got {}".format(pyear_step)
+        )
+    if pyear_end < pyear_start:
+        raise ValueError(
+            "Projection end year {} is before start year {}".format(
+                pyear_end, pyear_start
+            )
+        )
+
+    paths = list(input_files) + [location_file]
+    if len(climate_data_file) > 0:
+        paths.append(climate_data_file)
+    paths += [os.path.join(fingerprint_dir, f) for f in FINGERPRINT_FILES]
+    for path in paths:
+        if not os.path.exists(path):
+            raise ValueError("Input file {} does not exist".format(path))
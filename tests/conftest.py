@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy import interpolate
+
+from deconto21_ais.ReadFingerprint import ReadFingerprint
+from synthetic import write_inputs
+
+
+@pytest.fixture(scope="session")
+def inputs(tmp_path_factory):
+    # Small synthetic DP21 ensembles, fingerprints, sites and climate data
+    return write_inputs(
+        str(tmp_path_factory.mktemp("inputs")),
+        members=40,
+        nyears=62,
+        sites=12,
+        climate_members=30,
+        fp_resolution=2.0,
+    )
+
+
+def SplineAssignFP(fp_filename, qlats, qlons):
+    # Fingerprint interpolation as AssignFP originally did it
+    (fp, fp_lats, fp_lons) = ReadFingerprint(fp_filename)
+    lat_sort = np.argsort(fp_lats)
+    fp_interp = interpolate.RectBivariateSpline(
+        fp_lats[lat_sort], fp_lons, fp[lat_sort, :], kx=1, ky=1
+    )
+    return fp_interp.ev(qlats, np.mod(qlons, 360)) * 1000
+
+
+@pytest.fixture
+def spline_assign_fp():
+    return SplineAssignFP
+
+
+@pytest.fixture(scope="session")
+def projected(inputs):
+    # Global projections of the synthetic inputs, without output files
+    from deconto21_ais.deconto21_ais_preprocess import dp21_preprocess_icesheet
+    from deconto21_ais.deconto21_ais_project import dp21_project_icesheet
+
+    preprocess_dict = dp21_preprocess_icesheet(
+        scenario="rcp85",
+        baseyear=2005,
+        pipeline_id="test",
+        climate_data_file="",
+        input_paths_dict=inputs["input_paths_dict"],
+    )
+    return dp21_project_icesheet(
+        nsamps=60,
+        pyear_start=2020,
+        pyear_end=2150,
+        pyear_step=10,
+        pipeline_id="test",
+        replace=True,
+        rngseed=1342,
+        preprocess_dict=preprocess_dict,
+        output_ais_gslr_file=None,
+        output_eais_gslr_file=None,
+        output_wais_gslr_file=None,
+    )
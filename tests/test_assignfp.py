@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pytest
+
+from deconto21_ais import AssignFP as assignfp
+from deconto21_ais.AssignFP import (
+    ApplyStencil,
+    AssignFP,
+    AssignFPs,
+    FingerprintStencil,
+)
+from deconto21_ais.ReadFingerprint import ReadFingerprint, ReadFingerprintWindow
+
+
+@pytest.fixture
+def fp_files(inputs):
+    return [
+        os.path.join(inputs["fingerprint_dir"], "fprint_{}.nc".format(ice))
+        for ice in ("wais", "eais")
+    ]
+
+
+def Sites(fp_filename):
+    # Random sites, plus grid nodes, poles and sites past the last longitude
+    (_, fp_lats, fp_lons) = ReadFingerprint(fp_filename)
+    rng = np.random.default_rng(12)
+    lats = np.concatenate(
+        (rng.uniform(-90.0, 90.0, 50), fp_lats[[0, 3, -1]], [90.0, -90.0, 0.0])
+    )
+    lons = np.concatenate(
+        (rng.uniform(-180.0, 180.0, 50), fp_lons[[0, 7, -1]], [-0.5, 359.5, -180.0])
+    )
+    return (np.ma.getdata(lats), np.ma.getdata(lons))
+
+
+def test_stencil_matches_spline(fp_files, spline_assign_fp):
+    (qlats, qlons) = Sites(fp_files[0])
+    (fp, fp_lats, fp_lons) = ReadFingerprint(fp_files[0])
+
+    stencil = FingerprintStencil(fp_lats, fp_lons, qlats, qlons)
+    np.testing.assert_array_equal(
+        ApplyStencil(stencil, fp), spline_assign_fp(fp_files[0], qlats, qlons)
+    )
+    np.testing.assert_array_equal(
+        AssignFP(fp_files[0], qlats, qlons),
+        spline_assign_fp(fp_files[0], qlats, qlons),
+    )
+
+
+def test_stencil_shared_across_grids(fp_files, monkeypatch, spline_assign_fp):
+    (qlats, qlons) = Sites(fp_files[0])
+
+    # Count the stencils computed for the two files on one grid
+    stencils = []
+    fingerprint_stencil = assignfp.FingerprintStencil
+
+    def CountingStencil(*args):
+        stencils.append(args)
+        return fingerprint_stencil(*args)
+
+    monkeypatch.setattr(assignfp, "FingerprintStencil", CountingStencil)
+
+    fp_sites = AssignFPs(fp_files, qlats, qlons)
+    assert len(stencils) == 1
+    for fp_filename, these_sites in zip(fp_files, fp_sites):
+        np.testing.assert_array_equal(
+            these_sites, spline_assign_fp(fp_filename, qlats, qlons)
+        )
+
+
+@pytest.mark.parametrize(
+    "lon_range, crosses_seam",
+    [((-3.0, 3.0), True), ((357.0, 361.0), True), ((95.0, 105.0), False)],
+)
+def test_window_read(fp_files, spline_assign_fp, lon_range, crosses_seam):
+    rng = np.random.default_rng(13)
+    qlats = rng.uniform(40.0, 45.0, 20)
+    qlons = rng.uniform(*lon_range, 20)
+    (fp, fp_lats, fp_lons) = ReadFingerprint(fp_files[0])
+
+    # The window holds just the grid cells around the sites
+    stencil = FingerprintStencil(fp_lats, fp_lons, qlats, qlons)
+    index = stencil["index"]
+    (window, rows, cols) = ReadFingerprintWindow(
+        fp_files[0], index // fp_lons.size, index % fp_lons.size
+    )
+    assert window.size < fp.size // 10
+    assert (0 in cols and fp_lons.size - 1 in cols) == crosses_seam
+    np.testing.assert_array_equal(window, fp[np.ix_(rows, cols)])
+
+    np.testing.assert_array_equal(
+        AssignFP(fp_files[0], qlats, qlons),
+        spline_assign_fp(fp_files[0], qlats, qlons),
+    )
+
+
+def test_window_read_falls_back_to_full_grid(fp_files):
+    (fp, fp_lats, fp_lons) = ReadFingerprint(fp_files[0])
+    (qlats, qlons) = Sites(fp_files[0])
+    index = FingerprintStencil(fp_lats, fp_lons, qlats, qlons)["index"]
+
+    (window, rows, cols) = ReadFingerprintWindow(
+        fp_files[0], index // fp_lons.size, index % fp_lons.size
+    )
+    np.testing.assert_array_equal(rows, np.arange(fp_lats.size))
+    np.testing.assert_array_equal(cols, np.arange(fp_lons.size))
+    np.testing.assert_array_equal(window, fp)
@@ -0,0 +1,117 @@
+import json
+import os
+
+import pytest
+import xarray as xr
+from click.testing import CliRunner
+
+import deconto21_ais.batch as batch
+from deconto21_ais.batch import LoadManifest, PrepareShared, main
+from deconto21_ais.pipeline import run_dp21
+
+OUTPUTS = [
+    "{}_{}".format(ice, kind)
+    for ice in ("ais", "eais", "wais")
+    for kind in ("gslr", "lslr")
+]
+
+
+def Defaults(inputs):
+    paths = inputs["input_paths_dict"]
+    return dict(
+        {
+            "input_{}_{}_file".format(ice, scen): paths[scen][ice]
+            for scen in paths
+            for ice in ("eais", "wais")
+        },
+        location_file=inputs["location_file"],
+        fingerprint_dir=inputs["fingerprint_dir"],
+        baseyear=2005,
+        nsamps=40,
+        pyear_end=2150,
+        chunksize=5,
+    )
+
+
+def Outputs(outdir, name):
+    return {
+        "output_{}_file".format(key): os.path.join(outdir, "{}_{}.nc".format(name, key))
+        for key in OUTPUTS
+    }
+
+
+@pytest.mark.parametrize("manifest_format, workers", [("json", 1), ("yaml", 2)])
+def test_batch_runs_match_standalone_runs(inputs, tmp_path, manifest_format, workers):
+    # Two runs naming the same ensemble differently, which share its
+    # preprocessing and the site table
+    runs = [
+        dict(scenario="ssp585", rngseed=1, **Outputs(str(tmp_path), "a")),
+        dict(scenario="rcp85", rngseed=2, **Outputs(str(tmp_path), "b")),
+    ]
+    manifest = {"defaults": Defaults(inputs), "runs": runs}
+    manifest_file = str(tmp_path / "manifest.{}".format(manifest_format))
+    dump = json.dump
+    if manifest_format == "yaml":
+        dump = pytest.importorskip("yaml").safe_dump
+    with open(manifest_file, "w") as f:
+        dump(manifest, f)
+
+    shared = PrepareShared(LoadManifest(manifest_file))
+    assert len(shared["preprocessed"]) == 1
+    assert len(shared["sites"]) == 1
+
+    result = CliRunner().invoke(main, [manifest_file, "--workers", str(workers)])
+    assert result.exit_code == 0, result.output
+
+    for ii, run in enumerate(runs):
+        standalone = dict(Defaults(inputs), **run)
+        standalone.update(Outputs(str(tmp_path), "standalone{}".format(ii)))
+        run_dp21(standalone)
+        for key in OUTPUTS:
+            file_key = "output_{}_file".format(key)
+            with (
+                xr.open_dataset(run[file_key]) as batched,
+                xr.open_dataset(standalone[file_key]) as expected,
+            ):
+                xr.testing.assert_equal(
+                    batched["sea_level_change"], expected["sea_level_change"]
+                )
+
+
+@pytest.mark.skipif(
+    not os.path.isdir("/proc/self/fd"), reason="needs /proc/self/fd to list open files"
+)
+def test_batch_closes_run_outputs(inputs, tmp_path, monkeypatch):
+    manifest_file = str(tmp_path / "manifest.json")
+    with open(manifest_file, "w") as f:
+        json.dump(
+            {
+                "defaults": Defaults(inputs),
+                "runs": [
+                    dict(rngseed=ii, **Outputs(str(tmp_path), ii)) for ii in (1, 2)
+                ],
+            },
+            f,
+        )
+
+    # Hold on to the datasets each run returns, so they are not closed by
+    # being garbage collected
+    returned = []
+
+    def RecordedRun(*args, **kwargs):
+        returned.append(run_dp21(*args, **kwargs))
+        return returned[-1]
+
+    monkeypatch.setattr(batch, "run_dp21", RecordedRun)
+    result = CliRunner().invoke(main, [manifest_file])
+    assert result.exit_code == 0, result.output
+    assert len(returned) == 2
+
+    # No output file is left open by the runs' returned datasets
+    open_files = []
+    for fd in os.listdir("/proc/self/fd"):
+        try:
+            open_files.append(os.readlink(os.path.join("/proc/self/fd", fd)))
+        except OSError:
+            pass
+    assert not [f for f in open_files if f.startswith(str(tmp_path))]
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from deconto21_ais.deconto21_ais_postprocess import LocalizedChunks
+from deconto21_ais.localized_writer import (
+    DEFAULT_DISK_CHUNKS,
+    DISK_CHUNK_MB,
+    ResolveDiskChunks,
+)
+
+
+@pytest.mark.parametrize(
+    "shape, disk_chunks, max_chunk_mb",
+    [
+        ((20000, 10, 1000), DEFAULT_DISK_CHUNKS, 64),
+        ((2000, 14, 300), DEFAULT_DISK_CHUNKS, 1),
+        ((5000, 30, 700), (1000, 0, 10), 16),
+        ((5000, 30, 700), (0, 5, 50), 64),
+    ],
+)
+def test_chunks_cover_whole_disk_chunks(shape, disk_chunks, max_chunk_mb):
+    align = ResolveDiskChunks(disk_chunks, shape)
+    chunks = LocalizedChunks(*shape, 50, max_chunk_mb, itemsize=8, align=align)
+
+    assert np.prod(chunks) * 8 <= max_chunk_mb * 1024**2
+    for chunk, disk_chunk, length in zip(chunks, align, shape):
+        assert chunk % disk_chunk == 0 or chunk == length
+
+
+def test_chunks_split_disk_chunks_that_do_not_fit():
+    shape = (100000, 20, 50)
+    align = ResolveDiskChunks(DEFAULT_DISK_CHUNKS, shape)
+    chunks = LocalizedChunks(*shape, 50, 8, itemsize=8, align=align)
+
+    # Samples are split before years, one location at a time
+    assert chunks == (8 * 1024**2 // 8 // 20, 20, 1)
+
+
+@pytest.mark.parametrize("nsamps", [2000, 100000, 1000000])
+def test_default_disk_chunks_bounded_along_samples(nsamps):
+    chunks = ResolveDiskChunks(DEFAULT_DISK_CHUNKS, (nsamps, 14, 300))
+
+    # A site's samples are split into chunks of at most DISK_CHUNK_MB
+    assert chunks[1:] == (14, 1)
+    assert chunks[0] == min(nsamps, DISK_CHUNK_MB * 1024**2 // (4 * 14))
@@ -0,0 +1,113 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from deconto21_ais.deconto21_ais_preprocess import dp21_preprocess_icesheet
+from deconto21_ais.ensemble_cache import (
+    EnsembleCacheKey,
+    LoadCachedEnsemble,
+    StoreCachedEnsemble,
+)
+
+
+def Entries(cache_dir):
+    return sorted(os.listdir(cache_dir))
+
+
+def Arrays(fill, nmembers=100):
+    return {
+        "years": np.arange(2000, 2010),
+        "eais_samps": np.full((10, nmembers), fill),
+        "wais_samps": np.full((10, nmembers), fill),
+    }
+
+
+@pytest.mark.parametrize(
+    "scenario, temperature_driven", [("rcp45", False), ("ssp585", True)]
+)
+def test_cache_hit_matches_fresh_read(inputs, tmp_path, scenario, temperature_driven):
+    preprocess = dict(
+        scenario=scenario,
+        baseyear=2005,
+        pipeline_id="test",
+        climate_data_file=inputs["climate_data_file"] if temperature_driven else "",
+        input_paths_dict=inputs["input_paths_dict"],
+    )
+    cache_dir = str(tmp_path / "cache")
+    expected = dp21_preprocess_icesheet(**preprocess)
+
+    missed = dp21_preprocess_icesheet(cache_dir=cache_dir, **preprocess)
+    hit = dp21_preprocess_icesheet(cache_dir=cache_dir, **preprocess)
+
+    assert len(Entries(cache_dir)) == 1
+    for key in ("years", "eais_samps", "wais_samps"):
+        assert isinstance(hit[key], np.memmap)
+        for result in (missed, hit):
+            np.testing.assert_array_equal(
+                np.ma.getdata(result[key]), np.ma.getdata(expected[key])
+            )
+
+
+def test_cache_key_changes_with_inputs(inputs, tmp_path):
+    filepaths = []
+    for ice in ("eais", "wais"):
+        filepaths.append(str(tmp_path / "{}.nc".format(ice)))
+        shutil.copy(inputs["input_paths_dict"]["rcp45"][ice], filepaths[-1])
+    key = EnsembleCacheKey(filepaths, 2005)
+
+    # Another base year or type, or another ensemble value, is another entry
+    assert EnsembleCacheKey(filepaths, 2005) == key
+    assert EnsembleCacheKey(filepaths, 2000) != key
+    assert EnsembleCacheKey(filepaths, 2005, np.float32) != key
+    with Dataset(filepaths[1], "a") as nc:
+        nc.variables["samps"][0, 0] += 1.0
+    assert EnsembleCacheKey(filepaths, 2005) != key
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    entry_bytes = sum(a.nbytes for a in Arrays(0).values())
+
+    # Two entries fit; a third evicts the one used longest ago
+    for ii, key in enumerate(("a", "b")):
+        StoreCachedEnsemble(cache_dir, key, Arrays(ii), max_bytes=5 * entry_bytes // 2)
+        os.utime(os.path.join(cache_dir, key), (1000 * (ii + 1), 1000 * (ii + 1)))
+    assert LoadCachedEnsemble(cache_dir, "a") is not None
+    StoreCachedEnsemble(cache_dir, "c", Arrays(2), max_bytes=5 * entry_bytes // 2)
+
+    assert Entries(cache_dir) == ["a", "c"]
+    np.testing.assert_array_equal(
+        LoadCachedEnsemble(cache_dir, "c")["eais_samps"], Arrays(2)["eais_samps"]
+    )
+
+
+def test_cache_keeps_entry_just_written(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    StoreCachedEnsemble(cache_dir, "a", Arrays(0), max_bytes=1 << 30)
+    os.utime(os.path.join(cache_dir, "a"), (1000, 1000))
+
+    # An entry larger than the cap is kept for the run that wrote it
+    StoreCachedEnsemble(cache_dir, "b", Arrays(1, 2000), max_bytes=1)
+
+    assert Entries(cache_dir) == ["b"]
+
+
+def test_cache_writes_are_atomic(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    StoreCachedEnsemble(cache_dir, "a", Arrays(0), max_bytes=1 << 30)
+
+    # A second writer of the same entry leaves the first copy in place, and
+    # neither leaves its temporary directory behind
+    StoreCachedEnsemble(cache_dir, "a", Arrays(1), max_bytes=1 << 30)
+
+    assert Entries(cache_dir) == ["a"]
+    np.testing.assert_array_equal(
+        LoadCachedEnsemble(cache_dir, "a")["eais_samps"], Arrays(0)["eais_samps"]
+    )
+
+    # Entries without every array, e.g. from an interrupted copy, are misses
+    os.remove(os.path.join(cache_dir, "a", "wais_samps.npy"))
+    assert LoadCachedEnsemble(cache_dir, "a") is None
@@ -0,0 +1,69 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+from deconto21_ais.deconto21_ais_preprocess import dp21_preprocess_icesheet
+
+
+@pytest.mark.parametrize(
+    "scenario, temperature_driven", [("rcp45", False), ("ssp585", True)]
+)
+def test_lazy_read_writes_store(inputs, tmp_path, scenario, temperature_driven):
+    preprocess = dict(
+        scenario=scenario,
+        baseyear=2005,
+        pipeline_id="test",
+        climate_data_file=inputs["climate_data_file"] if temperature_driven else "",
+        input_paths_dict=inputs["input_paths_dict"],
+    )
+    expected = dp21_preprocess_icesheet(**preprocess)
+
+    # The store is written from a full read, then mapped for this run
+    store = str(tmp_path / "store")
+    written = dp21_preprocess_icesheet(lazy=True, ensemble_store=store, **preprocess)
+    reopened = dp21_preprocess_icesheet(lazy=True, ensemble_store=store, **preprocess)
+
+    for result in (written, reopened):
+        np.testing.assert_array_equal(result["years"], expected["years"])
+        for key in ("eais_samps", "wais_samps"):
+            assert isinstance(result[key], np.memmap)
+            np.testing.assert_array_equal(
+                result[key], np.ma.getdata(expected[key]).astype(np.float32)
+            )
+
+
+def test_store_rejects_changed_inputs(inputs, tmp_path):
+    # Copy the inputs so they can be changed
+    paths = {
+        scenario: {
+            ice: str(tmp_path / os.path.basename(filepath))
+            for ice, filepath in files.items()
+        }
+        for scenario, files in inputs["input_paths_dict"].items()
+    }
+    for scenario, files in inputs["input_paths_dict"].items():
+        for ice, filepath in files.items():
+            shutil.copy(filepath, paths[scenario][ice])
+
+    preprocess = dict(
+        scenario="rcp45",
+        baseyear=2005,
+        pipeline_id="test",
+        climate_data_file="",
+        input_paths_dict=paths,
+        ensemble_store=str(tmp_path / "store"),
+    )
+    dp21_preprocess_icesheet(**preprocess)
+    dp21_preprocess_icesheet(**preprocess)
+
+    # Rewrite a value, and make sure the modification time moves on even on
+    # file systems with coarse timestamps
+    with Dataset(paths["rcp45"]["wais"], "a") as nc:
+        nc.variables["samps"][0, 0] += 1.0
+    stat = os.stat(paths["rcp45"]["wais"])
+    os.utime(paths["rcp45"]["wais"], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    with pytest.raises(ValueError, match="changed or moved"):
+        dp21_preprocess_icesheet(**preprocess)
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+
+from deconto21_ais import fingerprint_cache
+from deconto21_ais.ensemble_cache import HashFile
+from deconto21_ais.fingerprint_cache import CachedAssignFPs
+
+
+def test_cached_fingerprints_match_spline(
+    inputs, tmp_path, monkeypatch, spline_assign_fp
+):
+    fp_filenames = [
+        os.path.join(inputs["fingerprint_dir"], "fprint_{}.nc".format(ice))
+        for ice in ("wais", "eais")
+    ]
+    cache_dir = str(tmp_path / "fpcache")
+    rng = np.random.default_rng(11)
+    lats = rng.uniform(-90.0, 90.0, 30)
+    lons = rng.uniform(-180.0, 180.0, 30)
+
+    # Record how many sites are interpolated on each cache miss
+    interpolated = []
+    assign_fps = fingerprint_cache.AssignFPs
+
+    def CountingAssignFPs(fp_filenames, qlats, qlons):
+        interpolated.append((len(fp_filenames), len(qlats)))
+        return assign_fps(fp_filenames, qlats, qlons)
+
+    monkeypatch.setattr(fingerprint_cache, "AssignFPs", CountingAssignFPs)
+
+    def AssertMatchSpline(sites):
+        cached = CachedAssignFPs(fp_filenames, lats[sites], lons[sites], cache_dir)
+        for fp_filename, fp in zip(fp_filenames, cached):
+            np.testing.assert_array_equal(
+                fp, spline_assign_fp(fp_filename, lats[sites], lons[sites])
+            )
+
+    # Cold cache, then a warm one; both files are filled in one call
+    for _ in range(2):
+        AssertMatchSpline(np.arange(20))
+    assert interpolated == [(2, 20)]
+
+    # Partly cached sites, in another order and with a repeated site
+    AssertMatchSpline(np.concatenate((np.arange(30)[::-1], [25])))
+    assert interpolated == [(2, 20), (2, 10)]
+    assert len(os.listdir(cache_dir)) == 2
+
+    # Sites missing from one entry only are filled in the same call
+    os.remove(os.path.join(cache_dir, "fp_{}.npz".format(HashFile(fp_filenames[1]))))
+    AssertMatchSpline(np.arange(30))
+    assert interpolated == [(2, 20), (2, 10), (2, 30)]
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from deconto21_ais.deconto21_ais_preprocess import (
+    CoalesceIndices,
+    dp21_preprocess_icesheet,
+)
+from deconto21_ais.deconto21_ais_project import (
+    GatherSamples,
+    dp21_project_icesheet,
+    dp21_project_icesheet_temperaturedriven,
+)
+
+
+def Preprocess(inputs, temperature_driven, **kwargs):
+    return dp21_preprocess_icesheet(
+        scenario="ssp585" if temperature_driven else "rcp45",
+        baseyear=2005,
+        pipeline_id="test",
+        climate_data_file=inputs["climate_data_file"] if temperature_driven else "",
+        input_paths_dict=inputs["input_paths_dict"],
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("max_gap", [0, 16])
+@pytest.mark.parametrize("temperature_driven", [False, True])
+def test_lazy_gather_matches_full_read(inputs, temperature_driven, max_gap):
+    full = Preprocess(inputs, temperature_driven)
+    lazy = Preprocess(inputs, temperature_driven, lazy=True)
+
+    # Unsorted years and members, with repeats and gaps on either side of
+    # max_gap, as drawn with replacement
+    datayr_idx = np.array([40, 3, 17, 3, 61, 18])
+    sample_idx = np.array([39, 0, 7, 7, 25, 2, 39, 11, 0, 30])
+    useScenario = None
+    if temperature_driven:
+        useScenario = np.array([2, 0, 1, 1, 2, 0, 0, 1, 2, 2])
+
+    for key in ("eais_samps", "wais_samps"):
+        lazy[key].max_gap = max_gap
+        np.testing.assert_array_equal(
+            GatherSamples(lazy[key], datayr_idx, sample_idx, useScenario),
+            GatherSamples(
+                np.ma.getdata(full[key]), datayr_idx, sample_idx, useScenario
+            ),
+        )
+
+
+@pytest.mark.parametrize("temperature_driven", [False, True])
+def test_lazy_projection_matches_full_read(inputs, temperature_driven):
+    projection = dict(
+        pyear_start=2020,
+        pyear_end=2150,
+        pyear_step=10,
+        pipeline_id="test",
+        replace=True,
+        rngseed=1342,
+        output_ais_gslr_file=None,
+        output_eais_gslr_file=None,
+        output_wais_gslr_file=None,
+    )
+    if temperature_driven:
+        project = dp21_project_icesheet_temperaturedriven
+        projection["climate_data_file"] = inputs["climate_data_file"]
+    else:
+        project = dp21_project_icesheet
+        projection["nsamps"] = 60
+
+    full = project(preprocess_dict=Preprocess(inputs, temperature_driven), **projection)
+    lazy = project(
+        preprocess_dict=Preprocess(inputs, temperature_driven, lazy=True), **projection
+    )
+
+    for key in ("eais_samps", "wais_samps", "ais_samps"):
+        np.testing.assert_array_equal(lazy[key], full[key])
+
+
+def test_coalesce_indices_cover_each_index():
+    idx = np.array([0, 1, 2, 5, 30, 31, 60])
+    ranges = CoalesceIndices(idx, max_gap=3)
+
+    assert ranges == [(0, 6, 0, 4), (30, 32, 4, 6), (60, 61, 6, 7)]
+    for start, stop, first, last in ranges:
+        assert np.all((idx[first:last] >= start) & (idx[first:last] < stop))
@@ -0,0 +1,113 @@
+import re
+
+import numpy as np
+import pytest
+
+from deconto21_ais.read_locationfile import LOCATION_COLUMNS, ReadLocationFile
+
+SITES = [
+    ("New_York", 12, 40.7, -74.01),
+    ("Honolulu", 155, 21.31, -157.87),
+    ("Cape Town", 1601, -33.92, 18.42),
+    ("Nome", 2001, 64.5, 194.6),
+]
+
+
+def RegexReadLocationFile(location_file):
+    # Location file parsing as ReadLocationFile originally did it
+    names = []
+    ids = []
+    lats = []
+    lons = []
+    comment_regex = re.compile(r"^#")
+    with open(location_file, "r") as f:
+        for line in f:
+            if re.search(comment_regex, line):
+                continue
+            (this_name, this_id, this_lat, this_lon) = line.split("\t")
+            names.append(this_name)
+            ids.append(int(this_id))
+            lats.append(float(this_lat))
+            lons.append(float(this_lon))
+
+    return (np.array(names), np.array(ids), np.array(lats), np.array(lons))
+
+
+def WriteLocationText(filename, lines):
+    with open(filename, "w") as f:
+        f.write("\n".join(lines))
+
+    return filename
+
+
+def SiteLines():
+    return ["# name\tid\tlat\tlon"] + ["{}\t{}\t{}\t{}".format(*site) for site in SITES]
+
+
+def AssertSitesEqual(sites, expected):
+    for column, expected_column in zip(sites, expected):
+        np.testing.assert_array_equal(column, expected_column)
+    assert sites[1].dtype == np.int64
+    assert sites[2].dtype == sites[3].dtype == np.float64
+
+
+def test_text_matches_regex_parser(tmp_path):
+    plain = WriteLocationText(str(tmp_path / "plain.lst"), SiteLines())
+    expected = RegexReadLocationFile(plain)
+
+    # Blank lines, whitespace-only lines and trailing newlines are skipped,
+    # which the original parser did not accept
+    lines = SiteLines()
+    lines = lines[:2] + ["", "  "] + lines[2:] + ["", "", ""]
+    padded = WriteLocationText(str(tmp_path / "padded.lst"), lines)
+
+    for location_file in (plain, padded):
+        AssertSitesEqual(ReadLocationFile(location_file), expected)
+
+
+def test_text_reports_malformed_line(tmp_path):
+    lines = SiteLines()
+    lines.insert(3, "Lisbon\t777\t38.7")
+    location_file = WriteLocationText(str(tmp_path / "bad.lst"), lines)
+
+    with pytest.raises(ValueError, match="Lisbon\t777\t38.7"):
+        ReadLocationFile(location_file)
+
+
+def test_text_without_sites(tmp_path):
+    location_file = WriteLocationText(str(tmp_path / "empty.lst"), SiteLines()[:1])
+
+    (names, ids, lats, lons) = ReadLocationFile(location_file)
+    assert names.size == ids.size == lats.size == lons.size == 0
+
+
+def SiteTable():
+    return {
+        name: np.array(values) for name, values in zip(LOCATION_COLUMNS, zip(*SITES))
+    }
+
+
+def test_npz_round_trip(tmp_path):
+    location_file = str(tmp_path / "sites.npz")
+    np.savez(location_file, **SiteTable())
+
+    AssertSitesEqual(
+        ReadLocationFile(location_file),
+        RegexReadLocationFile(
+            WriteLocationText(str(tmp_path / "sites.lst"), SiteLines())
+        ),
+    )
+
+
+def test_parquet_round_trip(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    location_file = str(tmp_path / "sites.parquet")
+    pq.write_table(pa.table(SiteTable()), location_file)
+
+    AssertSitesEqual(
+        ReadLocationFile(location_file),
+        RegexReadLocationFile(
+            WriteLocationText(str(tmp_path / "sites.lst"), SiteLines())
+        ),
+    )
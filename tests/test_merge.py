@@ -0,0 +1,72 @@
+import os
+
+import pytest
+import xarray as xr
+from click.testing import CliRunner
+
+from deconto21_ais.deconto21_ais_postprocess import dp21_postprocess_icesheet
+from deconto21_ais.localized_writer import SummaryFilename
+from deconto21_ais.merge import main as merge_main
+
+ICE_SOURCES = ("wais", "eais", "ais")
+
+
+def Postprocess(inputs, projected, outdir, output_format, site_partition=None):
+    os.makedirs(outdir, exist_ok=True)
+    ext = ".zarr" if output_format == "zarr" else ".nc"
+    out_files = {
+        "out_{}_lslr_file".format(ice): os.path.join(outdir, ice + "_lslr" + ext)
+        for ice in ICE_SOURCES
+    }
+    dp21_postprocess_icesheet(
+        chunksize=2,
+        pipeline_id="test",
+        projected_dict=projected,
+        locationfile=inputs["location_file"],
+        fpdir=inputs["fingerprint_dir"],
+        output_format=output_format,
+        site_partition=site_partition,
+        summary_quantiles=[0.05, 0.5, 0.95],
+        **out_files,
+    )
+    return list(out_files.values())
+
+
+@pytest.mark.parametrize("output_format", ["netcdf", "zarr"])
+def test_merged_shards_match_unpartitioned_run(
+    inputs, projected, tmp_path, output_format
+):
+    if output_format == "zarr":
+        pytest.importorskip("zarr")
+    engine = "zarr" if output_format == "zarr" else "netcdf4"
+
+    full_files = Postprocess(inputs, projected, str(tmp_path / "full"), output_format)
+
+    # Twelve sites in five uneven partitions, merged by deconto21-ais-merge
+    count = 5
+    for index in range(count):
+        merged_files = Postprocess(
+            inputs, projected, str(tmp_path / "parts"), output_format, (index, count)
+        )
+    merged_files += [SummaryFilename(f) for f in merged_files]
+    result = CliRunner().invoke(
+        merge_main,
+        [
+            "--partitions",
+            str(count),
+            "--output-format",
+            output_format,
+            "--chunksize",
+            "2",
+        ]
+        + merged_files,
+    )
+    assert result.exit_code == 0, result.output
+
+    full_files += [SummaryFilename(f) for f in full_files]
+    for full_file, merged_file in zip(full_files, merged_files):
+        with (
+            xr.open_dataset(full_file, engine=engine) as full,
+            xr.open_dataset(merged_file, engine=engine) as merged,
+        ):
+            xr.testing.assert_equal(merged.load(), full.load())
@@ -0,0 +1,93 @@
+import json
+import os
+
+import pytest
+from click.testing import CliRunner
+
+import deconto21_ais.metrics as metrics
+from deconto21_ais.cli import main
+
+STAGE_FIELDS = (
+    "calls",
+    "wall_s",
+    "cpu_s",
+    "peak_rss_bytes",
+    "read_bytes",
+    "write_bytes",
+)
+
+
+@pytest.mark.parametrize("sample_batch", [None, 20])
+def test_metrics_file_records_stages(inputs, tmp_path, monkeypatch, sample_batch):
+    # Stop collecting once the test is done
+    monkeypatch.setattr(metrics, "_records", None)
+
+    paths = inputs["input_paths_dict"]
+    args = [
+        "--nsamps=60",
+        "--baseyear=2005",
+        "--pyear-end=2150",
+        "--chunksize=5",
+        "--location-file={}".format(inputs["location_file"]),
+        "--fingerprint-dir={}".format(inputs["fingerprint_dir"]),
+        "--metrics-file={}".format(tmp_path / "metrics.json"),
+    ]
+    for scen in paths:
+        for ice in ("eais", "wais"):
+            args.append("--input-{}-{}-file={}".format(ice, scen, paths[scen][ice]))
+    for ice in ("ais", "eais", "wais"):
+        for kind in ("gslr", "lslr"):
+            args.append(
+                "--output-{}-{}-file={}".format(
+                    ice, kind, tmp_path / "{}_{}.nc".format(ice, kind)
+                )
+            )
+    if sample_batch is not None:
+        args.append("--sample-batch={}".format(sample_batch))
+
+    result = CliRunner().invoke(main, args)
+    assert result.exit_code == 0, result.output
+
+    with open(tmp_path / "metrics.json") as f:
+        report = json.load(f)
+    assert report["command"] == "deconto21-ais"
+    stages = {record["stage"]: record for record in report["stages"]}
+
+    # Batched gslr writes share the localisation pass
+    gslr_stage = "project" if sample_batch is None else "postprocess/localize"
+    measured = [
+        "import modules",
+        "preprocess",
+        "preprocess/read ensembles",
+        "preprocess/re-center",
+        "project",
+        "project/sample",
+        "postprocess",
+        "postprocess/read locations",
+        "postprocess/assign fingerprints",
+        "postprocess/localize",
+    ]
+    writes = [
+        "{}/write {}_{}.nc".format(stage, ice, kind)
+        for stage, kind in ((gslr_stage, "gslr"), ("postprocess/localize", "lslr"))
+        for ice in ("ais", "eais", "wais")
+    ]
+    assert set(measured + writes) <= set(stages)
+
+    for name in measured + writes:
+        record = stages[name]
+        assert set(STAGE_FIELDS) <= set(record)
+        assert record["calls"] == 1
+        assert record["wall_s"] >= 0.0
+        assert record["cpu_s"] >= 0.0
+
+    # Measured stages carry the process's memory and I/O, and writes timed
+    # within a pass the bytes handed to them
+    for name in measured:
+        assert stages[name]["peak_rss_bytes"] > 0
+        if os.path.exists("/proc/self/io"):
+            assert stages[name]["read_bytes"] >= 0
+            assert stages[name]["write_bytes"] >= 0
+    for name in writes:
+        if name.startswith("postprocess/"):
+            assert stages[name]["write_bytes"] > 0
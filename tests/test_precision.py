@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from deconto21_ais.deconto21_ais_preprocess import dp21_preprocess_icesheet
+
+
+@pytest.mark.parametrize("read", ["full", "lazy", "cache", "store"])
+def test_float64_converts_ensembles(inputs, tmp_path, read):
+    preprocess = dict(
+        scenario="rcp45",
+        baseyear=2005,
+        pipeline_id="test",
+        climate_data_file="",
+        input_paths_dict=inputs["input_paths_dict"],
+        **{
+            "full": {},
+            "lazy": {"lazy": True},
+            "cache": {"cache_dir": str(tmp_path / "cache")},
+            "store": {"ensemble_store": str(tmp_path / "store")},
+        }[read],
+    )
+    native = dp21_preprocess_icesheet(**preprocess)
+    converted = dp21_preprocess_icesheet(precision="float64", **preprocess)
+
+    # The synthetic ensembles, like the DP21 files and stores, are float32
+    for key in ("eais_samps", "wais_samps"):
+        assert native[key].dtype == np.float32
+        assert converted[key].dtype == np.float64
+
+    # A store only holds float32 values, which are converted as they are
+    if read == "store":
+        np.testing.assert_array_equal(converted["eais_samps"], native["eais_samps"])
@@ -0,0 +1,87 @@
+import h5py
+import numpy as np
+import pytest
+
+from deconto21_ais.deconto21_ais_project import GatherSamples, IntegratedSAT
+
+
+def FullReadIntegratedSAT(fname, scenario):
+    # Temperatures read in full and integrated over 2000-2099, as
+    # pickScenario originally did it through GetSATData
+    with h5py.File(fname, "r") as df_ssp:
+        sat_ssp = df_ssp[scenario]["surface_temperature"]
+        sat_years = df_ssp["year"][()]
+        refyear_start_idx = np.flatnonzero(sat_years == 1850)[0]
+        refyear_end_idx = np.flatnonzero(sat_years == 1900)[0]
+        year_start_idx = np.flatnonzero(sat_years == 1900)[0]
+        year_end_idx = np.flatnonzero(sat_years == 2300)[0] + 1
+        Time = np.arange(1900, 2300 + 1)
+        SATave = np.mean(sat_ssp[refyear_start_idx:refyear_end_idx, :], axis=0)
+        SAT = sat_ssp[year_start_idx:year_end_idx, :] - SATave
+
+    x2 = np.where((Time[:] < 2100) * (Time[:] >= 2000))
+    return SAT[x2].sum(axis=0)
+
+
+def test_integrated_sat_matches_full_read(inputs):
+    for scenario in ("ssp126", "ssp245", "ssp585"):
+        np.testing.assert_array_equal(
+            IntegratedSAT(inputs["climate_data_file"], scenario),
+            FullReadIntegratedSAT(inputs["climate_data_file"], scenario),
+        )
+
+
+@pytest.mark.parametrize(
+    "nens, chunks, slab_members",
+    [
+        # Hyperslabs of five members, the last of them one member wide
+        (31, None, 5),
+        (31, 5, 5),
+        # Ten members rounded down to two on-disk chunks of four
+        (25, 4, 10),
+        (24, 4, 10),
+    ],
+)
+def test_integrated_sat_windows_match_full_read(tmp_path, nens, chunks, slab_members):
+    fname = str(tmp_path / "climate.h5")
+    years = np.arange(1750, 2301)
+    rng = np.random.default_rng(7)
+    with h5py.File(fname, "w") as h5:
+        h5["year"] = years
+        h5.create_dataset(
+            "ssp245/surface_temperature",
+            data=rng.normal(1.0, 0.5, (years.size, nens)),
+            chunks=None if chunks is None else (years.size, chunks),
+        )
+
+    # Budget for the reference and integration rows of slab_members members
+    max_chunk_mb = slab_members * (50 + 100) * 8 / 1024**2
+
+    np.testing.assert_array_equal(
+        IntegratedSAT(fname, "ssp245", max_chunk_mb=max_chunk_mb),
+        FullReadIntegratedSAT(fname, "ssp245"),
+    )
+
+
+def LoopGatherSamples(ensemble, datayr_idx, sample_idx, useScenario):
+    # Temperature-driven gather as GatherSamples originally did it
+    samps0 = ensemble[datayr_idx[:, np.newaxis], sample_idx[np.newaxis, :], :]
+    samps = samps0[:, :, 0]
+    for ii in range(1, 3):
+        samps[:, useScenario == ii] = samps0[:, useScenario == ii, ii]
+
+    return samps.T
+
+
+def test_gather_by_scenario_matches_loop():
+    rng = np.random.default_rng(3)
+    ensemble = rng.normal(size=(20, 15, 3))
+    datayr_idx = np.array([2, 5, 5, 19, 0])
+    sample_idx = rng.integers(0, 15, 40)
+    useScenario = rng.integers(0, 3, 40)
+    assert set(useScenario) == {0, 1, 2}
+
+    np.testing.assert_array_equal(
+        GatherSamples(ensemble, datayr_idx, sample_idx, useScenario),
+        LoopGatherSamples(ensemble, datayr_idx, sample_idx, useScenario),
+    )
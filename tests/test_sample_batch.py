@@ -0,0 +1,136 @@
+import collections
+import os
+
+import pytest
+import xarray as xr
+
+import deconto21_ais.deconto21_ais_project as project
+import deconto21_ais.localized_writer as localized_writer
+from deconto21_ais.pipeline import run_dp21
+
+OUTPUTS = [
+    "{}_{}".format(ice, kind)
+    for ice in ("ais", "eais", "wais")
+    for kind in ("gslr", "lslr")
+]
+
+
+def Run(inputs, outdir, output_format, nsamps=60, **config):
+    os.makedirs(outdir, exist_ok=True)
+    ext = ".zarr" if output_format == "zarr" else ".nc"
+    paths = inputs["input_paths_dict"]
+    config = dict(
+        {
+            "input_{}_{}_file".format(ice, scen): paths[scen][ice]
+            for scen in paths
+            for ice in ("eais", "wais")
+        },
+        location_file=inputs["location_file"],
+        fingerprint_dir=inputs["fingerprint_dir"],
+        nsamps=nsamps,
+        pyear_end=2150,
+        chunksize=5,
+        output_format=output_format,
+        **{
+            "output_{}_file".format(key): os.path.join(outdir, key + ext)
+            for key in OUTPUTS
+        },
+        **config,
+    )
+    results = run_dp21(config)
+    return ([config["output_{}_file".format(key)] for key in OUTPUTS], results)
+
+
+def CountGathers(monkeypatch):
+    # Count the sample batches gathered, keyed on ensemble and sample indices
+    gathers = collections.Counter()
+    gather = project.GatherSamples
+
+    def CountedGather(ensemble, datayr_idx, sample_idx, useScenario=None):
+        # dask also calls it on empty arrays to infer its output
+        if sample_idx.size > 0:
+            gathers[(id(ensemble), sample_idx.tobytes())] += 1
+        return gather(ensemble, datayr_idx, sample_idx, useScenario)
+
+    monkeypatch.setattr(project, "GatherSamples", CountedGather)
+    return gathers
+
+
+@pytest.mark.parametrize("output_format", ["netcdf", "zarr"])
+def test_batches_gathered_once(inputs, tmp_path, monkeypatch, output_format):
+    if output_format == "zarr":
+        pytest.importorskip("zarr")
+    engine = "zarr" if output_format == "zarr" else "netcdf4"
+
+    gathers = CountGathers(monkeypatch)
+    (batched_files, _) = Run(
+        inputs,
+        str(tmp_path / "batched"),
+        output_format,
+        sample_batch=20,
+        summary_quantiles="5,50,95",
+    )
+
+    # Three batches of WAIS and EAIS samples, each gathered once for the gslr
+    # and lslr outputs and the summaries
+    assert len(gathers) == 6
+    assert set(gathers.values()) == {1}
+
+    monkeypatch.undo()
+    (full_files, _) = Run(inputs, str(tmp_path / "full"), output_format)
+    for full_file, batched_file in zip(full_files, batched_files):
+        with (
+            xr.open_dataset(full_file, engine=engine) as full,
+            xr.open_dataset(batched_file, engine=engine) as batched,
+        ):
+            xr.testing.assert_equal(
+                batched["sea_level_change"], full["sea_level_change"]
+            )
+
+
+def test_returned_projections_read_back(inputs, tmp_path, monkeypatch):
+    gathers = CountGathers(monkeypatch)
+    (files, results) = Run(inputs, str(tmp_path), "netcdf", sample_batch=20)
+
+    # Written outputs are read from their files, without gathering again
+    gathers.clear()
+    for key, filename in zip(OUTPUTS, files):
+        with xr.open_dataset(filename) as written:
+            xr.testing.assert_equal(
+                results[key]["sea_level_change"].load(), written["sea_level_change"]
+            )
+        results[key].close()
+    assert len(gathers) == 0
+
+
+def test_chunk_cache_bounded_with_sample_batch(inputs, tmp_path, monkeypatch):
+    # Record the on-disk chunks and chunk cache size of each lslr file
+    files = []
+    create = localized_writer.CreateLocalizedWriters
+
+    def RecordedCreate(*args, **kwargs):
+        writers = create(*args, **kwargs)
+        files.extend(
+            (writer.var.chunking(), writer.var.get_var_chunk_cache()[0])
+            for writer in writers
+        )
+        return writers
+
+    monkeypatch.setattr(localized_writer, "CreateLocalizedWriters", RecordedCreate)
+    for nsamps in (60, 240):
+        Run(
+            inputs,
+            str(tmp_path / str(nsamps)),
+            "netcdf",
+            nsamps=nsamps,
+            sample_batch=20,
+            max_chunk_mb=1,
+        )
+
+    # Each on-disk chunk holds one batch, and neither it nor the cache grows
+    # with the number of samples
+    assert len(files) == 6
+    assert files[:3] == files[3:]
+    for chunking, cache_bytes in files:
+        assert chunking[0] == 20
+        assert cache_bytes <= 1024**2
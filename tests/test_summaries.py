@@ -0,0 +1,87 @@
+import dask.array as da
+import numpy as np
+import pytest
+import xarray as xr
+
+from deconto21_ais.deconto21_ais_postprocess import dp21_postprocess_icesheet
+from deconto21_ais.localized_writer import SummaryFilename
+
+ICE_SOURCES = ("wais", "eais", "ais")
+QUANTILES = [0.05, 0.5, 0.95]
+
+
+def CountedSamples(projected, calls):
+    # The samples as dask arrays that count how often each block is computed
+    def Counted(block, block_info=None):
+        calls.append(block_info[0]["chunk-location"])
+        return block
+
+    return dict(
+        projected,
+        **{
+            "{}_samps".format(ice): da.from_array(
+                projected["{}_samps".format(ice)], chunks=(20, -1)
+            ).map_blocks(Counted, dtype=projected["{}_samps".format(ice)].dtype)
+            for ice in ("wais", "eais")
+        },
+    )
+
+
+def Postprocess(inputs, projected, out_files, **kwargs):
+    return dp21_postprocess_icesheet(
+        chunksize=5,
+        pipeline_id="test",
+        projected_dict=projected,
+        locationfile=inputs["location_file"],
+        fpdir=inputs["fingerprint_dir"],
+        summary_quantiles=QUANTILES,
+        **{"out_{}_lslr_file".format(ice): out_files.get(ice) for ice in ICE_SOURCES},
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("output_format", ["netcdf", "zarr"])
+def test_summaries_taken_in_the_same_pass(inputs, projected, tmp_path, output_format):
+    if output_format == "zarr":
+        pytest.importorskip("zarr")
+    engine = "zarr" if output_format == "zarr" else "netcdf4"
+    ext = ".zarr" if output_format == "zarr" else ".nc"
+    out_files = {ice: str(tmp_path / (ice + "_lslr" + ext)) for ice in ICE_SOURCES}
+
+    calls = []
+    Postprocess(
+        inputs,
+        CountedSamples(projected, calls),
+        out_files,
+        output_format=output_format,
+        scheduler="synchronous",
+    )
+
+    # Each WAIS and EAIS sample block is computed once for every output
+    assert sorted(calls) == sorted(2 * [(ii, 0) for ii in range(3)])
+
+    for out_file in out_files.values():
+        with (
+            xr.open_dataset(out_file, engine=engine) as lslr,
+            xr.open_dataset(SummaryFilename(out_file), engine=engine) as summary,
+        ):
+            np.testing.assert_allclose(
+                summary["sea_level_change"].values,
+                np.quantile(lslr["sea_level_change"].values, QUANTILES, axis=0),
+                rtol=1e-6,
+            )
+
+
+def test_summaries_kept_in_memory_without_lslr_files(inputs, projected):
+    output = Postprocess(inputs, projected, {})
+
+    for ice in ICE_SOURCES:
+        np.testing.assert_allclose(
+            output["{}_lslr_quantiles".format(ice)]["sea_level_change"].values,
+            np.quantile(
+                output["{}_lslr".format(ice)]["sea_level_change"].values,
+                QUANTILES,
+                axis=0,
+            ),
+            rtol=1e-6,
+        )